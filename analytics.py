@@ -0,0 +1,369 @@
+"""
+Streaming statistics over recorded games.
+
+Recordings (see recording) are read record by record through their memory
+map, decoded with the codec of the recorded subprotocol and applied to a
+Game with `update` and `apply_delta`, so snapshots and deltas of every
+encoding are understood.
+Every state of a started game that differs from the one before is one
+row (lobby snapshots between games are not): the move inferred from the
+previous state (app.Position), the seat that made it, the board after it,
+the turn number and the time since the previous state. Rows are packed into fixed size NumPy chunks and each chunk is
+folded into fixed size counters with bincount, so memory stays the same
+whatever the number of games.
+
+The statistics are move types (passes among them) per seat, the turn time
+per seat, the game length in turns and the cards of each suit on the board
+after each turn. Turn times are as seen by the recording client: from the
+state before the move to the state with it. A state that follows its
+predecessor by more than one move (e.g. after a reconnect) counts as one
+turn whose move is unknown.
+
+    python analytics.py recordings/
+    python analytics.py recordings/ --workers 8 --json stats.json
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from app import Game, GameMove, GameState, NUM_CARDS_PER_SUIT, NUM_SUITS, Suit
+from codec import GAME_DELTA, MessageDecoder
+from recording import IN, OPEN, MessageLog
+
+MAX_PLAYERS = 8
+MAX_TURNS = 256
+CHUNK_ROWS = 1 << 16
+FILES_PER_TASK = 32
+# turn times are counted in quarter powers of two of microseconds
+TIME_STEPS = 4
+TIME_BUCKETS = 128
+PASS = -1
+UNKNOWN = -2
+# move kinds are the GameMove values and this one for moves that could not be inferred
+UNKNOWN_MOVE = len(GameMove)
+KINDS = UNKNOWN_MOVE + 1
+
+ROW = np.dtype([
+    ("seat", np.int8),
+    ("card", np.int8),
+    ("board", np.uint64),
+    ("turn", np.int16),
+    ("elapsed_ns", np.int64),
+    ("game_ns", np.int64),
+    ("ended", np.bool_),
+])
+
+_ONE = np.uint64(1)
+_SUIT_BITS = np.uint64((1 << NUM_CARDS_PER_SUIT) - 1)
+_SUIT_SHIFTS = np.arange(NUM_SUITS, dtype=np.uint64) * np.uint64(NUM_CARDS_PER_SUIT)
+
+
+class RecordedSession(object):
+    """
+    Replays one recording into a Game, like SessionHandler but with deltas
+    applied to that Game directly; `rows()` yields a ROW tuple for every
+    move, i.e. every change from a STARTED state. A `game_start`, or a
+    STARTED state after a lobby or an ended game, begins a new game, and
+    after a gap in the deltas they are dropped until the snapshot the app
+    asked for.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.decoder = MessageDecoder()
+        self.state = None
+        self.resyncing = False
+        self.turn = 0
+        self.started_ts = 0
+        self.last_ts = 0
+        self.messages = 0
+        self.gaps = 0
+
+    def rows(self):
+        for ts, kind, payload in MessageLog(self.path):
+            if kind == OPEN:
+                self.decoder = MessageDecoder.for_subprotocol(payload or None)
+                self.resyncing = False
+            elif kind == IN:
+                self.messages += 1
+                row = self.on_message(ts, payload)
+                if row is not None:
+                    yield row
+
+    def on_message(self, ts, message):
+        message_type, game_json = self.decoder.decode(message)
+        if message_type != GAME_DELTA and (self.state is None or message_type == "game_start"):
+            self.state = Game.from_json(game_json)
+            self.resyncing = False
+            self.turn = 0
+            self.started_ts = self.last_ts = ts
+            return None
+        if self.state is None:
+            return None
+        parent = self.state.position
+        if message_type != GAME_DELTA:
+            self.state.update(game_json, message_type)
+            self.resyncing = False
+        elif self.resyncing:
+            return None
+        else:
+            try:
+                self.state.apply_delta(game_json)
+            except ValueError:
+                self.gaps += 1
+                self.resyncing = True
+                return None
+        position = self.state.position
+        if position is parent:
+            return None
+        if parent.state != GameState.STARTED:
+            # lobby snapshots and the deal are no moves; a game that was not announced starts here
+            if position.state == GameState.STARTED:
+                self.turn = 0
+                self.started_ts = self.last_ts = ts
+            return None
+        if position.move is None:
+            seat, card = UNKNOWN, UNKNOWN
+        else:
+            seat = position.seat
+            card = position.move.bit_length() - 1 if position.move else PASS
+        self.turn += 1
+        elapsed = ts - self.last_ts
+        self.last_ts = ts
+        row = (seat, card, position.board, min(self.turn, MAX_TURNS - 1), elapsed, ts - self.started_ts,
+               position.state == GameState.ENDED)
+        if position.state == GameState.ENDED:
+            self.turn = 0
+            self.started_ts = ts
+        return row
+
+
+def recording_paths(paths):
+    """Recordings named by `paths`, with directories walked lazily for *.rec files."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, _, names in os.walk(path):
+            for name in sorted(names):
+                if name.endswith(".rec"):
+                    yield os.path.join(directory, name)
+
+
+def chunks(rows, size=CHUNK_ROWS):
+    """ROW arrays of at most `size` rows from an iterator of row tuples."""
+    rows = iter(rows)
+    while True:
+        chunk = np.fromiter(itertools.islice(rows, size), dtype=ROW)
+        if not len(chunk):
+            return
+        yield chunk
+
+
+def move_kinds(card, board):
+    """GameMove value (or UNKNOWN_MOVE) of each row, from the card played and the board after it."""
+    kinds = np.full(len(card), UNKNOWN_MOVE, dtype=np.int64)
+    kinds[card == PASS] = GameMove.MOVE_PASS
+    placed = card >= 0
+    index = card[placed].astype(np.uint64)
+    bit = _ONE << index
+    before = board[placed] & ~bit
+    rank = index % np.uint64(NUM_CARDS_PER_SUIT)
+    suit_range = (before >> (index - rank)) & _SUIT_BITS
+    lowest = suit_range & (~suit_range + _ONE)
+    kinds[placed] = np.where(before == 0, GameMove.MOVE_FIRST,
+                             np.where(suit_range == 0, GameMove.MOVE_FIRST_SUIT,
+                                      np.where((_ONE << rank) < lowest, GameMove.MOVE_MIN, GameMove.MOVE_MAX)))
+    return kinds
+
+
+def time_buckets(elapsed_ns):
+    us = np.maximum(elapsed_ns, 0) / 1000.0
+    return np.minimum((np.log2(us + 1) * TIME_STEPS).astype(np.int64), TIME_BUCKETS - 1)
+
+
+def bucket_us(bucket):
+    """Turn time in microseconds at the (geometric) middle of a bucket."""
+    return 2 ** ((bucket + 0.5) / TIME_STEPS) - 1
+
+
+class GameStats(object):
+    """Fixed size counters that chunks are folded into; stats of separate files merge by addition."""
+    def __init__(self):
+        self.files = 0
+        self.messages = 0
+        self.gaps = 0
+        self.rows = 0
+        self.games = 0
+        self.game_ns = 0
+        # move kinds per seat (a seat of -1 is not known)
+        self.moves = np.zeros((MAX_PLAYERS, KINDS), dtype=np.int64)
+        self.unknown_moves = 0
+        self.suit_moves = np.zeros((NUM_SUITS, KINDS), dtype=np.int64)
+        self.turn_times = np.zeros((MAX_PLAYERS, TIME_BUCKETS), dtype=np.int64)
+        self.turn_ns = np.zeros(MAX_PLAYERS, dtype=np.int64)
+        self.lengths = np.zeros(MAX_TURNS, dtype=np.int64)
+        # cards of each suit on the board after each turn, summed over states, and the states summed
+        self.suit_cards = np.zeros((MAX_TURNS, NUM_SUITS), dtype=np.int64)
+        self.turn_states = np.zeros(MAX_TURNS, dtype=np.int64)
+
+    def add(self, chunk):
+        self.rows += len(chunk)
+        seat = chunk["seat"].astype(np.int64)
+        card = chunk["card"]
+        board = chunk["board"]
+        turn = chunk["turn"].astype(np.int64)
+        kinds = move_kinds(card, board)
+        known = seat >= 0
+        self.unknown_moves += len(chunk) - int(known.sum())
+        seat, known_kinds, elapsed = seat[known], kinds[known], chunk["elapsed_ns"][known]
+        self.moves += np.bincount(seat * KINDS + known_kinds, minlength=MAX_PLAYERS * KINDS).reshape(
+            MAX_PLAYERS, KINDS)
+        self.turn_times += np.bincount(seat * TIME_BUCKETS + time_buckets(elapsed),
+                                       minlength=MAX_PLAYERS * TIME_BUCKETS).reshape(MAX_PLAYERS, TIME_BUCKETS)
+        self.turn_ns += np.bincount(seat, weights=elapsed, minlength=MAX_PLAYERS).astype(np.int64)
+        placed = card >= 0
+        suits = card[placed].astype(np.int64) // NUM_CARDS_PER_SUIT
+        self.suit_moves += np.bincount(suits * KINDS + kinds[placed], minlength=NUM_SUITS * KINDS).reshape(
+            NUM_SUITS, KINDS)
+        counts = np.bitwise_count((board[:, None] >> _SUIT_SHIFTS) & _SUIT_BITS)
+        for suit in range(NUM_SUITS):
+            self.suit_cards[:, suit] += np.bincount(turn, weights=counts[:, suit], minlength=MAX_TURNS).astype(np.int64)
+        self.turn_states += np.bincount(turn, minlength=MAX_TURNS)
+        ended = chunk["ended"]
+        self.games += int(ended.sum())
+        self.game_ns += int(chunk["game_ns"][ended].sum())
+        self.lengths += np.bincount(turn[ended], minlength=MAX_TURNS)
+
+    def add_file(self, path):
+        session = RecordedSession(path)
+        for chunk in chunks(session.rows()):
+            self.add(chunk)
+        self.files += 1
+        self.messages += session.messages
+        self.gaps += session.gaps
+        return self
+
+    def merge(self, other):
+        for name, value in vars(other).items():
+            setattr(self, name, getattr(self, name) + value)
+        return self
+
+    def summary(self):
+        """Plain numbers for printing or json."""
+        moves = self.moves[:, :UNKNOWN_MOVE]
+        turns = moves.sum(axis=1)
+        seats = np.flatnonzero(turns)
+        per_seat = {}
+        for seat in seats:
+            times = self.turn_times[seat]
+            per_seat[int(seat)] = {
+                "turns": int(turns[seat]),
+                "pass_rate": float(moves[seat, GameMove.MOVE_PASS] / turns[seat]),
+                "moves": {move.name: int(moves[seat, move]) for move in GameMove},
+                "turn_ms_mean": float(self.turn_ns[seat] / turns[seat] / 1e6),
+                "turn_ms_p50": percentile(times, 50) / 1000.0,
+                "turn_ms_p90": percentile(times, 90) / 1000.0,
+            }
+        states = np.maximum(self.turn_states, 1)[:, None]
+        last_turn = int(np.flatnonzero(self.turn_states)[-1]) + 1 if self.turn_states.any() else 0
+        return {
+            "files": self.files,
+            "messages": self.messages,
+            "delta_gaps": self.gaps,
+            "games": self.games,
+            "turns": int(turns.sum()) + self.unknown_moves,
+            "unknown_moves": self.unknown_moves,
+            "pass_rate": float(moves[:, GameMove.MOVE_PASS].sum() / turns.sum()) if turns.any() else 0.0,
+            "game_turns_mean": float((self.lengths * np.arange(MAX_TURNS)).sum() / self.games) if self.games else 0.0,
+            "game_turns_p50": percentile(self.lengths, 50, linear=True),
+            "game_turns_p90": percentile(self.lengths, 90, linear=True),
+            "game_s_mean": self.game_ns / self.games / 1e9 if self.games else 0.0,
+            "seats": per_seat,
+            "suit_moves": {suit.name: {move.name: int(self.suit_moves[suit.val, move]) for move in GameMove
+                                       if move != GameMove.MOVE_PASS}
+                           for suit in Suit},
+            # mean cards of each suit (in Suit.val order) on the board after turn n
+            "suit_growth": (self.suit_cards[:last_turn] / states[:last_turn]).round(2).tolist(),
+        }
+
+
+def percentile(counts, pct, linear=False):
+    """Value at `pct` of a bincount; turn time buckets are mapped back to microseconds."""
+    total = counts.sum()
+    if not total:
+        return 0.0
+    index = int(np.searchsorted(np.cumsum(counts), total * pct / 100.0))
+    return float(index if linear else bucket_us(index))
+
+
+def analyze_files(paths):
+    """GameStats of a list of recordings; the unit of work of the process pool."""
+    stats = GameStats()
+    for path in paths:
+        stats.add_file(path)
+    return stats
+
+
+def analyze(paths, workers=0, files_per_task=FILES_PER_TASK):
+    """
+    GameStats over every recording in `paths`. With `workers` the files are
+    handed out in batches to a process pool, keeping only a few batches in
+    flight so that the list of files is never materialized.
+    """
+    paths = recording_paths(paths)
+    if not workers:
+        return analyze_files(paths)
+    stats = GameStats()
+    batches = iter(lambda: list(itertools.islice(paths, files_per_task)), [])
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        running = set()
+        for batch in batches:
+            running.add(pool.submit(analyze_files, batch))
+            if len(running) >= 2 * workers:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stats.merge(future.result())
+        for future in running:
+            stats.merge(future.result())
+    return stats
+
+
+def report(summary, seconds):
+    print("{} games, {} messages from {} files in {:.2f}s ({:.0f} games/s)".format(
+        summary["games"], summary["messages"], summary["files"], seconds, summary["games"] / seconds if seconds else 0))
+    print("pass rate {:.1%}  game length mean {:.1f} p50 {:.0f} p90 {:.0f} turns, {:.1f}s  unknown moves {}".format(
+        summary["pass_rate"], summary["game_turns_mean"], summary["game_turns_p50"], summary["game_turns_p90"],
+        summary["game_s_mean"], summary["unknown_moves"]))
+    for seat, stats in summary["seats"].items():
+        print("seat {} turns {:7d}  pass rate {:6.1%}  turn ms mean {:8.1f} p50 {:8.1f} p90 {:8.1f}".format(
+            seat, stats["turns"], stats["pass_rate"], stats["turn_ms_mean"], stats["turn_ms_p50"],
+            stats["turn_ms_p90"]))
+    growth = summary["suit_growth"]
+    for turn in range(0, len(growth), 10):
+        print("after turn {:3d}  cards per suit {}".format(turn, "  ".join("{:5.2f}".format(n) for n in growth[turn])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate statistics over recorded games")
+    parser.add_argument("paths", nargs="+", help="recordings, or directories searched for *.rec")
+    parser.add_argument("--workers", type=int, default=0, help="process pool size (default: this process only)")
+    parser.add_argument("--files-per-task", type=int, default=FILES_PER_TASK)
+    parser.add_argument("--json", default=None, help="also write the statistics to this file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    summary = analyze(args.paths, args.workers, args.files_per_task).summary()
+    report(summary, time.perf_counter() - start)
+    if args.json:
+        with open(args.json, "w") as fd:
+            json.dump(summary, fd, indent=2)
+
+
+if __name__ == "__main__":
+    main()
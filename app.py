@@ -13,47 +13,44 @@ class Suit(Enum):
 
     @property
     def val(self):
-        return {
-            Suit.HEART: 0,
-            Suit.DIAMOND: 1,
-            Suit.SPADE: 2,
-            Suit.CLUB: 3
-        }.get(self, 0)
+        return _SUIT_VAL[self]
 
     @property
     def char(self):
-        return {
-            Suit.HEART: 'H',
-            Suit.DIAMOND: 'D',
-            Suit.SPADE: 'S',
-            Suit.CLUB: 'C'
-        }.get(self, 'H')
+        return _SUIT_CHAR[self]
 
     @staticmethod
     def from_str(string):
-        return {
-            'H': Suit.HEART,
-            'D': Suit.DIAMOND,
-            'S': Suit.SPADE,
-            'C': Suit.CLUB
-        }.get(string, Suit.HEART)
+        return _SUIT_BY_CHAR.get(string, Suit.HEART)
 
     @staticmethod
     def from_val(val):
-        return {
-            0: Suit.HEART,
-            1: Suit.DIAMOND,
-            2: Suit.SPADE,
-            3: Suit.CLUB
-        }.get(val, Suit.HEART)
+        return _SUIT_BY_VAL.get(val, Suit.HEART)
 
     def get_color(self):
-        return {
-            Suit.HEART: [1, 0, 0, 1],
-            Suit.DIAMOND: [0, 1, 0, 1],
-            Suit.SPADE: [0, 0, 1, 1],
-            Suit.CLUB: [1, 0, 1, 1]
-        }.get(self, [1, 1, 1, 0])
+        return list(_SUIT_COLOR.get(self, [1, 1, 1, 0]))
+
+
+_SUIT_VAL = {
+    Suit.HEART: 0,
+    Suit.DIAMOND: 1,
+    Suit.SPADE: 2,
+    Suit.CLUB: 3
+}
+_SUIT_CHAR = {
+    Suit.HEART: 'H',
+    Suit.DIAMOND: 'D',
+    Suit.SPADE: 'S',
+    Suit.CLUB: 'C'
+}
+_SUIT_BY_CHAR = {char: suit for suit, char in _SUIT_CHAR.items()}
+_SUIT_BY_VAL = {val: suit for suit, val in _SUIT_VAL.items()}
+_SUIT_COLOR = {
+    Suit.HEART: [1, 0, 0, 1],
+    Suit.DIAMOND: [0, 1, 0, 1],
+    Suit.SPADE: [0, 0, 1, 1],
+    Suit.CLUB: [1, 0, 1, 1]
+}
 
 
 class Number(IntEnum):
@@ -76,43 +73,64 @@ class Number(IntEnum):
 
     @property
     def char(self):
-        if self not in [Number.ACE, Number.JACK, Number.QUEEN, Number.KING]:
-            return str(self.value)
-        return {
-            Number.ACE: 'A',
-            Number.JACK: 'J',
-            Number.QUEEN: 'Q',
-            Number.KING: 'K'
-        }.get(self, '')
+        return _NUMBER_CHAR[self]
 
     @staticmethod
     def from_str(string):
-        if string not in ['A', 'J', 'Q', 'K']:
-            val = int(string)
-            return Number(val)
-
-        return {
-            'A': Number.ACE,
-            'J': Number.JACK,
-            'Q': Number.QUEEN,
-            'K': Number.KING
-        }.get(string, Number.ACE)
+        number = _NUMBER_BY_CHAR.get(string)
+        if number is None:
+            return Number(int(string))
+        return number
+
+
+_NUMBER_CHAR = {
+    number: str(number.value) for number in Number
+}
+_NUMBER_CHAR.update({
+    Number.ACE: 'A',
+    Number.JACK: 'J',
+    Number.QUEEN: 'Q',
+    Number.KING: 'K'
+})
+_NUMBER_BY_CHAR = {char: number for number, char in _NUMBER_CHAR.items()}
+
+NUM_SUITS = 4
+NUM_CARDS_PER_SUIT = 13
+NUM_CARDS = NUM_SUITS * NUM_CARDS_PER_SUIT
+FULL_MASK = (1 << NUM_CARDS) - 1
+SUIT_MASKS = [((1 << NUM_CARDS_PER_SUIT) - 1) << (suit * NUM_CARDS_PER_SUIT) for suit in range(NUM_SUITS)]
 
 
 class Card(object):
-    def __init__(self, suit, number):
-        self.suit = suit
-        self.number = number
+    """
+    Cards are interned: there is exactly one instance per (suit, number),
+    indexed 0..51 as suit.val * 13 + number - 1, so equality is identity and
+    a set of cards can be kept as a 52 bit integer mask.
+    """
+    __slots__ = ("suit", "number", "index", "mask")
+
+    def __new__(cls, suit, number):
+        card = _CARDS[_SUIT_VAL[suit] * NUM_CARDS_PER_SUIT + number - 1]
+        if card is None:
+            card = object.__new__(cls)
+            card.suit = suit
+            card.number = Number(number)
+            card.index = _SUIT_VAL[suit] * NUM_CARDS_PER_SUIT + number - 1
+            card.mask = 1 << card.index
+            _CARDS[card.index] = card
+        return card
+
+    def __reduce__(self):
+        return Card, (self.suit, self.number)
 
     def __repr__(self):
         return "{}:{}".format(str(self.suit), str(self.number))
 
     def __eq__(self, other):
-        return other and (self.suit == other.suit) and \
-               (self.number == other.number)
+        return self is other or (isinstance(other, Card) and self.index == other.index)
 
     def __le__(self, other):
-        return other and (self.suit == other.suit) and \
+        return isinstance(other, Card) and (self.suit == other.suit) and \
                (self.number <= other.number)
 
     # def __cmp__(self, other):
@@ -123,62 +141,163 @@ class Card(object):
     #     return self.number.value - other.number.value
 
     def get_next_card(self):
-        if self.number.value == 13:
+        if self.number == NUM_CARDS_PER_SUIT:
             return None
-        else:
-            return self.__class__(self.suit, Number(self.number + 1))
+        return _CARDS[self.index + 1]
 
     def get_prev_card(self):
-        if self.number.value == 1:
+        if self.number == 1:
             return None
-        else:
-            return self.__class__(self.suit, Number(self.number - 1))
+        return _CARDS[self.index - 1]
 
     @property
     def str(self):
-        return "{}:{}".format(self.number.char, self.suit.char)
+        return _CARD_STR[self.index]
 
     @property
     def image_name(self):
         return "{}{}".format(self.number.char, self.suit.char)
 
-
     def __hash__(self):
-        return self.suit.val * 13 + self.number.value - 1
+        return self.index
+
+    @staticmethod
+    def from_index(index):
+        return _CARDS[index]
 
     @staticmethod
     def from_str(string):
-        parts = string.split(":")
-        number = Number.from_str(parts[0])
-        suit = Suit.from_str(parts[1])
-        return Card(suit, number)
+        card = _CARD_BY_STR.get(string)
+        if card is None:
+            parts = string.split(":")
+            card = Card(Suit.from_str(parts[1]), Number.from_str(parts[0]))
+        return card
+
+
+_CARDS = [None] * NUM_CARDS
+ALL_CARDS = tuple(Card(suit, number) for suit in Suit for number in Number)
+_CARD_STR = tuple("{}:{}".format(card.number.char, card.suit.char) for card in ALL_CARDS)
+_CARD_BY_STR = {string: card for string, card in zip(_CARD_STR, ALL_CARDS)}
+
+
+def cards_to_mask(cards):
+    mask = 0
+    for card in cards:
+        mask |= card.mask
+    return mask
+
+
+def mask_to_cards(mask):
+    cards = []
+    while mask:
+        low = mask & -mask
+        cards.append(_CARDS[low.bit_length() - 1])
+        mask ^= low
+    return cards
+
+
+def range_mask(start, end):
+    """Mask of the cards from start to end (inclusive) of a single suit."""
+    if start is None or end is None or start.suit != end.suit or start.index > end.index:
+        return 0
+    return ((1 << (end.index + 1)) - 1) ^ (start.mask - 1)
+
+
+def card_map_to_mask(card_map):
+    mask = 0
+    for suit_range in card_map or []:
+        if len(suit_range) > 0:
+            mask |= range_mask(Card.from_str(suit_range[0]), Card.from_str(suit_range[1]))
+    return mask
+
+
+def mask_to_card_map(mask):
+    card_map = []
+    for suit_mask in SUIT_MASKS:
+        suit_range = mask & suit_mask
+        if suit_range:
+            low = _CARDS[(suit_range & -suit_range).bit_length() - 1]
+            high = _CARDS[suit_range.bit_length() - 1]
+            card_map.append([low.str, high.str])
+        else:
+            card_map.append([])
+    return card_map
+
+
+SEVEN_INDEX = Number.SEVEN - 1
+FIRST_MOVE_CARD = Card(Suit.HEART, Number.SEVEN)
+
+
+def _build_suit_moves():
+    """
+    Playable cards for every reachable board of a single suit, as 13 bit
+    patterns: an empty suit opens with its seven, otherwise the range
+    around the seven grows by one card at either end.
+    """
+    moves = {0: 1 << SEVEN_INDEX}
+    for low in range(SEVEN_INDEX + 1):
+        for high in range(SEVEN_INDEX, NUM_CARDS_PER_SUIT):
+            playable = 0
+            if low > 0:
+                playable |= 1 << (low - 1)
+            if high < NUM_CARDS_PER_SUIT - 1:
+                playable |= 1 << (high + 1)
+            moves[((1 << (high + 1)) - 1) ^ ((1 << low) - 1)] = playable
+    return moves
+
+
+_SUIT_MOVES = _build_suit_moves()
+_SUIT_SHIFTS = [suit * NUM_CARDS_PER_SUIT for suit in range(NUM_SUITS)]
+_SUIT_PATTERN = (1 << NUM_CARDS_PER_SUIT) - 1
+
+
+def playable_mask(board_mask):
+    """Every card that may be placed next on `board_mask`, regardless of who holds it."""
+    if not board_mask:
+        return FIRST_MOVE_CARD.mask
+    mask = 0
+    for shift in _SUIT_SHIFTS:
+        mask |= _SUIT_MOVES.get((board_mask >> shift) & _SUIT_PATTERN, 0) << shift
+    return mask
+
+
+def update_playable(playable, board_mask, card_mask):
+    """`playable_mask(board_mask)` given the playable mask from before `card_mask` was placed on the board."""
+    if playable == FIRST_MOVE_CARD.mask and board_mask == card_mask:
+        return playable_mask(board_mask)
+    shift = (card_mask.bit_length() - 1) // NUM_CARDS_PER_SUIT * NUM_CARDS_PER_SUIT
+    suit_moves = _SUIT_MOVES.get((board_mask >> shift) & _SUIT_PATTERN, 0)
+    return (playable & ~(_SUIT_PATTERN << shift)) | (suit_moves << shift)
 
 
 class CardIterator:
     def __init__(self, start, end):
         self.start = start
         self.end = end
-        self.cur = start
+        self.mask = range_mask(start, end)
+
+    @classmethod
+    def from_mask(cls, mask):
+        self = cls.__new__(cls)
+        self.start = self.end = None
+        self.mask = mask
+        return self
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self.cur and self.cur <= self.end:
-            next = self.cur.get_next_card()
-            cur = self.cur
-            self.cur = next
-            return cur
+        mask = self.mask
+        if mask:
+            low = mask & -mask
+            self.mask = mask ^ low
+            return _CARDS[low.bit_length() - 1]
         raise StopIteration
 
 
 class Deck(object):
     def __init__(self):
-        self.cards = []
-        for suit in Suit:
-            for num in Number:
-                card = Card(suit, num)
-                self.cards.append(card)
+        self.cards = list(ALL_CARDS)
 
     def shuffle(self):
         random.shuffle(self.cards)
@@ -192,11 +311,11 @@ class Deck(object):
 
     @property
     def num_suits(self):
-        return 4
+        return NUM_SUITS
 
     @property
     def num_cards_per_suit(self):
-        return 13
+        return NUM_CARDS_PER_SUIT
 
 
 class Player:
@@ -205,22 +324,41 @@ class Player:
 
 
 class GamePlayer:
+    """
+    A hand is kept as a card mask; `cards` is the same hand in card index
+    order so that positions can be computed from the mask.
+    """
     def __init__(self, player, cards):
         self.player = player
-        self.cards = cards
+        self.update_cards(cards)
 
     @classmethod
     def from_json(cls, json):
         cards = json.get("cards",[])
+        if isinstance(cards, int):
+            # already decoded to a card mask
+            self = cls(json, [])
+            self.update_mask(cards)
+            return self
         cards = [Card.from_str(card) for card in cards]
         self = cls(json, cards)
         return self
 
     def update_cards(self, cards):
-        self.cards = cards
+        self.mask = cards_to_mask(cards)
+        self.cards = mask_to_cards(self.mask)
+
+    def update_mask(self, mask):
+        self.mask = mask
+        self.cards = mask_to_cards(mask)
+
+    def has_card(self, card):
+        return bool(self.mask & card.mask)
 
     def find_card_index(self, card):
-        return self.cards.index(card)
+        if not self.mask & card.mask:
+            raise ValueError("{} is not in hand".format(card))
+        return (self.mask & (card.mask - 1)).bit_count()
 
     def get_cards(self):
         return self.cards
@@ -240,15 +378,236 @@ class GameMove(IntEnum):
     MOVE_PASS = 4
 
 
+class Position(object):
+    """
+    One immutable position as seen from my seat, and a node of the history
+    it belongs to: `parent` is the position before it and `move` the card
+    mask played to get here (0 for a pass), or None when the position came
+    from a server snapshot rather than a known move. Nodes are never
+    changed, so any number of histories, forks and analyses share them.
+
+    `jump` is a skew binary jump pointer to an earlier ancestor, which makes
+    `ancestor` O(log n) in the length of the line.
+    """
+    __slots__ = ("parent", "jump", "index", "move", "seat", "me", "my_name", "players", "hand", "board", "current",
+                 "state", "card_count", "seq")
+
+    def __init__(self, parent, move, seat, me, my_name, players, hand, board, current, state, card_count, seq):
+        self.parent = parent
+        if parent is None:
+            self.index = 0
+            self.jump = self
+        else:
+            self.index = parent.index + 1
+            jump = parent.jump
+            if parent.index - jump.index == jump.index - jump.jump.index:
+                self.jump = jump.jump
+            else:
+                self.jump = parent
+        self.move = move
+        self.seat = seat
+        self.me = me
+        self.my_name = my_name
+        # (name, cards left or -1 where unknown) per seat
+        self.players = players
+        self.hand = hand
+        self.board = board
+        self.current = current
+        self.state = state
+        self.card_count = card_count
+        self.seq = seq
+
+    @classmethod
+    def from_game(cls, game, parent=None, move=None, seat=None):
+        players = tuple([(player.player.get("name"), player.player.get("card_count", -1))
+                         for player in game.game_players])
+        me = game.me.player
+        return cls(parent, move, seat, me["index"], me.get("name"), players, game.me.mask, game.board_mask,
+                   game.current_player_index, game.state, game.card_count, game.seq)
+
+    @property
+    def counts(self):
+        return tuple([count for name, count in self.players])
+
+    def same_state(self, other):
+        return other is not None and self.hand == other.hand and self.board == other.board \
+            and self.current == other.current and self.state == other.state and self.players == other.players
+
+    def ancestor(self, index):
+        """The position `index` moves into this line, in O(log n)."""
+        if not 0 <= index <= self.index:
+            raise IndexError("position {} is not in a line of {}".format(index, self.index + 1))
+        node = self
+        while node.index > index:
+            node = node.jump if node.jump.index >= index else node.parent
+        return node
+
+    def legal_moves_mask(self):
+        if self.state != GameState.STARTED or self.current != self.me:
+            return 0
+        return playable_mask(self.board) & self.hand
+
+    def play(self, card=None):
+        """The position after the player to move plays `card`, or passes; this one is unchanged."""
+        seat = self.current
+        is_me = seat == self.me
+        if self.state != GameState.STARTED:
+            raise ValueError("the game is not running")
+        if card is None:
+            if is_me and self.legal_moves_mask():
+                raise ValueError("cannot pass with a playable card")
+            return Position(self, 0, seat, self.me, self.my_name, self.players, self.hand, self.board,
+                            (seat + 1) % len(self.players), self.state, self.card_count, self.seq)
+        if not playable_mask(self.board) & card.mask:
+            raise ValueError("{} cannot be played".format(card))
+        if is_me and not self.hand & card.mask:
+            raise ValueError("{} is not in hand".format(card))
+        hand = self.hand ^ card.mask if is_me else self.hand
+        players = list(self.players)
+        name, count = players[seat]
+        if count > 0:
+            players[seat] = name, count - 1
+        remaining = hand.bit_count() if is_me else players[seat][1]
+        state, current = (GameState.ENDED, seat) if remaining == 0 else (self.state, (seat + 1) % len(players))
+        return Position(self, card.mask, seat, self.me, self.my_name, tuple(players), hand, self.board | card.mask,
+                        current, state, self.card_count + 1, self.seq)
+
+    def to_json(self):
+        """The position in the decoded snapshot form accepted by `Game.from_json`."""
+        players = []
+        for index, (name, count) in enumerate(self.players):
+            player = {"index": index, "name": name}
+            if count >= 0:
+                player["card_count"] = count
+            players.append(player)
+        possible = mask_to_cards(self.legal_moves_mask())
+        return {
+            "players": players,
+            "me": {"index": self.me, "name": self.my_name, "cards": self.hand},
+            "current_player_id": self.current,
+            "state": self.state.value,
+            "card_map": mask_to_card_map(self.board),
+            "board": self.board,
+            "card_count": self.card_count,
+            "possible_moves": possible,
+            "seq": self.seq,
+        }
+
+    def __repr__(self):
+        return "Position(#{}, move={}, board={:#x}, current={})".format(self.index, self.move, self.board,
+                                                                        self.current)
+
+
+class History(object):
+    """
+    A line of positions, held by its newest one. Positions are shared, so
+    `fork` is O(1); `history[i]` is O(log n).
+    """
+    def __init__(self, tip=None):
+        self.tip = tip
+
+    def append(self, position):
+        """Make `position` the tip; it need not descend from the old tip, which forks taken earlier keep."""
+        self.tip = position
+        return position
+
+    def fork(self):
+        return History(self.tip)
+
+    def __len__(self):
+        return 0 if self.tip is None else self.tip.index + 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if self.tip is None or index < 0:
+            raise IndexError("history index out of range")
+        return self.tip.ancestor(index)
+
+    def __iter__(self):
+        line = []
+        node = self.tip
+        while node is not None:
+            line.append(node)
+            node = node.parent
+        return reversed(line)
+
+    def moves(self):
+        """(seat, card or None for a pass) of every known move in the line, oldest first."""
+        return [(node.seat, _CARDS[node.move.bit_length() - 1] if node.move else None)
+                for node in self if node.move is not None]
+
+
 class Game:
-    def __init__(self, players, me, current_player_id, state, card_map, card_count=0, possible_moves=[]):
+    def __init__(self, players, me, current_player_id, state, card_map, card_count=0, possible_moves=[], board=None,
+                 seq=None):
         self.game_players = sorted([Player(player) for player in players], key=lambda x: x.player["index"])
         self.me = GamePlayer.from_json(me)
         self.current_player_index = current_player_id
         self.state = GameState(state)
         self.card_map = card_map
+        self.board_mask = card_map_to_mask(card_map) if board is None else board
         self.card_count = card_count
-        self.possible_moves = possible_moves
+        self.set_possible_moves(possible_moves)
+        # server sequence number of the last snapshot or delta applied
+        self.seq = seq
+        self.move_seq = 0
+        self.pending_moves = {}
+        # server seq of the state my pending moves were made on
+        self.pending_base = None
+        self.rejected_moves = []
+        # every position this game has been in; `confirmed` is the newest one from the server
+        self.history = History()
+        self.confirmed = None
+        self.record()
+
+    @property
+    def position(self):
+        return self.history.tip
+
+    def record(self, move=None, seat=None, confirmed=True, new_game=False):
+        """
+        Add the current state to the history. States from the server follow
+        the last state from the server, so optimistic moves it has not
+        confirmed are left on a side branch; my own moves follow the tip.
+        A new game (`new_game`, or a board that lost cards) starts a new root.
+        """
+        parent = self.confirmed if confirmed else self.history.tip
+        if confirmed and parent is not None:
+            if new_game or self.board_mask & parent.board != parent.board:
+                parent = None
+            elif move is None:
+                move, seat = self.infer_move(parent)
+        position = Position.from_game(self, parent, move, seat)
+        if confirmed:
+            if position.same_state(parent):
+                position = parent
+            self.confirmed = position
+        return self.history.append(position)
+
+    def infer_move(self, parent):
+        """(card mask or 0 for a pass, seat) of the single move from `parent` to now, or (None, None)."""
+        if self.board_mask & parent.board != parent.board:
+            return None, None
+        added = self.board_mask & ~parent.board
+        if added and not added & (added - 1):
+            return added, parent.current
+        if not added and self.me.mask == parent.hand and self.current_player_index == (parent.current + 1) % len(
+                parent.players):
+            return 0, parent.current
+        return None, None
+
+    @classmethod
+    def from_position(cls, position):
+        """A Game at `position` whose history is that position's line; nothing is copied."""
+        self = cls.from_json(position.to_json())
+        self.history = History(position)
+        self.confirmed = position
+        return self
+
+    def fork(self):
+        """An independent Game at the current position, sharing the history so far."""
+        return Game.from_position(self.position)
 
     @property
     def players(self):
@@ -256,6 +615,7 @@ class Game:
 
     def set_possible_moves(self, possible_moves):
         self.possible_moves = possible_moves
+        self.possible_moves_mask = cards_to_mask(possible_moves or [])
 
     def get_possible_moves(self):
         return self.possible_moves
@@ -267,15 +627,130 @@ class Game:
     def set_current_player(self, current_player_index):
         self.current_player_index = current_player_index
 
+    def legal_moves_mask(self, hand_mask=None):
+        """Cards of `hand_mask` (default: my hand) that can be played on the current board."""
+        if self.state != GameState.STARTED:
+            return 0
+        if hand_mask is None:
+            hand_mask = self.me.mask
+        return playable_mask(self.board_mask) & hand_mask
+
+    def get_legal_moves(self):
+        """Local equivalent of the server's `possible_moves`: empty unless it is my turn."""
+        if not self.is_your_turn():
+            return []
+        return mask_to_cards(self.legal_moves_mask())
+
+    def get_move_type(self, card=None):
+        if card is None:
+            return GameMove.MOVE_PASS
+        if not self.board_mask:
+            return GameMove.MOVE_FIRST
+        suit_range = self.board_mask & SUIT_MASKS[card.suit.val]
+        if not suit_range:
+            return GameMove.MOVE_FIRST_SUIT
+        if card.mask < suit_range & -suit_range:
+            return GameMove.MOVE_MIN
+        return GameMove.MOVE_MAX
+
     def make_move(self, card=None, pass_move=False):
-        pass
+        """
+        Play `card` (or pass) for the current player and advance the turn.
+        Only my own hand is known, so other players' moves just update the
+        board and their card counts. Returns the GameMove that was applied.
+        """
+        player = self.current_player.player
+        is_me = player["index"] == self.me.player["index"]
+        if pass_move or card is None:
+            if is_me and self.legal_moves_mask():
+                raise ValueError("cannot pass with a playable card")
+            move = GameMove.MOVE_PASS
+        else:
+            if self.state != GameState.STARTED or not playable_mask(self.board_mask) & card.mask:
+                raise ValueError("{} cannot be played".format(card))
+            if is_me and not self.me.has_card(card):
+                raise ValueError("{} is not in hand".format(card))
+            move = self.get_move_type(card)
+            self.board_mask |= card.mask
+            self.card_map = mask_to_card_map(self.board_mask)
+            self.card_count += 1
+            if is_me:
+                self.me.update_mask(self.me.mask ^ card.mask)
+                remaining = len(self.me.cards)
+            elif "card_count" in player:
+                remaining = player["card_count"] - 1
+            else:
+                remaining = None
+            if remaining is not None:
+                player["card_count"] = remaining
+            if remaining == 0:
+                self.state = GameState.ENDED
+                self.set_possible_moves([])
+                self.record(card.mask, player["index"], confirmed=False)
+                return move
+        self.current_player_index = (self.current_player_index + 1) % len(self.game_players)
+        self.set_possible_moves(self.get_legal_moves())
+        self.record(0 if move == GameMove.MOVE_PASS else card.mask, player["index"], confirmed=False)
+        return move
+
+    def apply_optimistic_move(self, card=None, pass_move=False):
+        """
+        Apply my own move before the server has seen it and remember it as
+        pending until `reconcile` confirms or rejects it. Returns the move's
+        sequence number.
+        """
+        if not self.is_your_turn():
+            raise ValueError("not your turn")
+        self.make_move(card, pass_move)
+        if not self.pending_moves:
+            self.pending_base = self.seq
+        self.move_seq += 1
+        self.pending_moves[self.move_seq] = None if pass_move else card
+        return self.move_seq
+
+    def reconcile(self, message_type=None):
+        """
+        Called after `update` replaced the state with the server's. Moves the
+        server has applied are dropped: a card once it has left my hand, a
+        pass once the turn has moved past me (or, as states may be skipped,
+        the server's seq has moved past the state it was made on; nothing but
+        my move can move it on while it is my turn). Moves it refused (an
+        `invalid_move` reply, or the turn moved on without the card) are
+        rolled back, and moves it has not processed yet, e.g. while the
+        state is one sent before my move reached it, are applied again on top.
+        """
+        rejected = []
+        moved_on = self.seq is not None and self.pending_base is not None and self.seq > self.pending_base
+        for seq, card in sorted(self.pending_moves.items()):
+            del self.pending_moves[seq]
+            if message_type == "invalid_move":
+                rejected.append((seq, card))
+            elif not self.is_your_turn() or self.state != GameState.STARTED:
+                if card is not None and self.me.has_card(card):
+                    rejected.append((seq, card))
+            elif card is None and moved_on or card is not None and not self.me.has_card(card):
+                continue
+            else:
+                try:
+                    self.make_move(card, card is None)
+                    self.pending_moves[seq] = card
+                except ValueError:
+                    rejected.append((seq, card))
+        self.rejected_moves = rejected
+        return rejected
 
     def is_valid_move(self, card):
-        return self.me.player["index"] == self.current_player_index
+        return self.is_your_turn() and bool(self.legal_moves_mask() & card.mask)
 
     @property
     def is_ended(self):
-        self.state == GameState.ENDED
+        return self.state == GameState.ENDED
+
+    @property
+    def winner(self):
+        if not self.is_ended:
+            return None
+        return self.current_player
 
     def is_your_turn(self):
         return self.me.player["index"] == self.current_player_index
@@ -284,12 +759,60 @@ class Game:
     def from_json(cls, json):
         return cls(**json)
 
-    def update(self, json):
+    def update(self, json, message_type=None):
+        """Apply a decoded snapshot; a `game_start` begins a new history."""
+        if "players" in json:
+            self.game_players = sorted([Player(player) for player in json["players"]], key=lambda x: x.player["index"])
         self.me = GamePlayer.from_json(json["me"])
         self.current_player_index = json["current_player_id"]
         self.state = GameState(json["state"])
         self.card_map = json["card_map"]
-        self.card_count = json["card_count"]
-        self.possible_moves = json["possible_moves"]
+        board = json.get("board")
+        self.board_mask = card_map_to_mask(self.card_map) if board is None else board
+        self.card_count = json.get("card_count", 0)
+        self.set_possible_moves(json.get("possible_moves") or [])
+        self.seq = json.get("seq")
+        self.record(new_game=message_type == "game_start")
         return self
 
+    def apply_delta(self, delta):
+        """
+        Patch the state in place with a decoded `game_delta`. Raises
+        ValueError if it does not directly follow the last applied seq, in
+        which case a full snapshot is needed.
+        """
+        if self.seq is None or delta["seq"] != self.seq + 1:
+            raise ValueError("delta {} does not follow {}".format(delta["seq"], self.seq))
+        board = delta.get("board", 0)
+        if board & ~self.board_mask:
+            self.board_mask |= board
+            self.card_map = mask_to_card_map(self.board_mask)
+        removed = delta.get("removed", 0)
+        if removed:
+            self.me.update_mask(self.me.mask & ~removed)
+        for player in self.game_players:
+            count = delta.get("players", {}).get(player.player["index"])
+            if count is not None:
+                player.player["card_count"] = count
+        self.current_player_index = delta["current_player_id"]
+        self.state = GameState(delta["state"])
+        self.card_count = delta.get("card_count", self.card_count)
+        self.set_possible_moves(self.get_legal_moves())
+        self.seq = delta["seq"]
+        self.record()
+        return self
+
+    def to_json(self):
+        """The state in the decoded snapshot form accepted by `from_json` and `update`."""
+        return {
+            "players": [dict(player.player) for player in self.game_players],
+            "me": dict(self.me.player, cards=self.me.mask),
+            "current_player_id": self.current_player_index,
+            "state": self.state.value,
+            "card_map": self.card_map,
+            "board": self.board_mask,
+            "card_count": self.card_count,
+            "possible_moves": list(self.possible_moves),
+            "seq": self.seq,
+        }
+
@@ -0,0 +1,424 @@
+"""
+Microbenchmarks for the client's hot paths, with saved baselines.
+
+Every benchmark times one operation; the reported figure is the best of
+`--repeat` runs in ns per operation. `--save` stores the results as the
+baseline for this machine and later runs compare against it, exiting with
+status 1 when a benchmark is slower than its threshold (current / baseline,
+default 1.25). Widget benchmarks run Kivy on its mock GL backend, so no
+display is needed.
+
+    python benchmarks.py --save                  # record a baseline
+    python benchmarks.py                         # compare, fail on regressions
+    python benchmarks.py --filter card --threshold card.from_str=1.5
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import timeit
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BASE_DIR, ".cache", "bench-baseline.json")
+DEFAULT_THRESHOLD = 1.25
+# noisier benchmarks get more slack
+THRESHOLDS = {
+    "widget.suit_widget": 1.5,
+    "widget.game_player_widget": 1.5,
+}
+
+BENCHMARKS = []
+
+
+def benchmark(name, needs_kivy=False):
+    """Register `setup`, which prepares state and returns the operation to time."""
+    def register(setup):
+        BENCHMARKS.append((name, setup, needs_kivy))
+        return setup
+    return register
+
+
+def simulated_game(seed=0, players=4):
+    """Yield the stand-in server's Table before every move of a simulated game, and once at the end."""
+    from app import mask_to_cards
+    from server import Table
+
+    rng = random.Random(seed)
+    table = Table("bench", players, seed)
+    for index in range(players):
+        table.join("player{}".format(index), None)
+    table.deal()
+    while True:
+        yield table
+        if not table.seats[table.current].hand:
+            return
+        seat = table.seats[table.current]
+        legal = mask_to_cards(table.legal_mask(seat))
+        table.play(seat, rng.choice(legal).str if legal else "pass")
+
+
+def game_payloads(seat_index=0, games=3):
+    payloads = []
+    for seed in range(games):
+        for table in simulated_game(seed):
+            payloads.append(table.message_for(table.seats[seat_index], "game_update"))
+    return payloads
+
+
+def decoded_states(games=3):
+    from codec import JSON, MessageDecoder
+
+    states = []
+    for payload in game_payloads(games=games):
+        # a fresh decoder each time so every state is decoded in full
+        states.append(MessageDecoder(JSON).decode(payload)[1])
+    return states
+
+
+def cycle(items):
+    """Cheap endless iteration for operations that take one item per call."""
+    items = list(items)
+    state = {"i": 0}
+    size = len(items)
+
+    def next_item():
+        i = state["i"]
+        state["i"] = i + 1 if i + 1 < size else 0
+        return items[i]
+    return next_item
+
+
+def use_shared_state():
+    from handler import GameHandler
+    from shared_state import SharedGameState
+
+    if GameHandler.get_game_data() is None:
+        GameHandler.set_game_data(SharedGameState.create())
+    GameHandler.invalidate()
+
+
+@benchmark("card.from_str")
+def bench_card_from_str():
+    from app import ALL_CARDS, Card
+
+    next_str = cycle(card.str for card in ALL_CARDS)
+    return lambda: Card.from_str(next_str())
+
+
+@benchmark("card.hash_eq")
+def bench_card_hash_eq():
+    from app import ALL_CARDS
+
+    next_pair = cycle(zip(ALL_CARDS, reversed(ALL_CARDS)))
+
+    def op():
+        a, b = next_pair()
+        return hash(a), a == b
+    return op
+
+
+@benchmark("card_iterator.full_suit")
+def bench_card_iterator():
+    from app import Card, CardIterator, Number, Suit
+
+    next_range = cycle((Card(suit, Number.ACE), Card(suit, Number.KING)) for suit in Suit)
+
+    def op():
+        start, end = next_range()
+        return list(CardIterator(start, end))
+    return op
+
+
+@benchmark("deck.construct_shuffle")
+def bench_deck():
+    from app import Deck
+
+    def op():
+        deck = Deck()
+        deck.shuffle()
+        return deck
+    return op
+
+
+@benchmark("game_player.from_json")
+def bench_game_player_from_json():
+    from app import GamePlayer
+
+    hands = cycle(dict(state["me"], cards=[card.str for card in GamePlayer.from_json(state["me"]).cards])
+                  for state in decoded_states(games=1))
+    return lambda: GamePlayer.from_json(hands())
+
+
+@benchmark("game.from_json")
+def bench_game_from_json():
+    from app import Game
+
+    next_state = cycle(decoded_states())
+    return lambda: Game.from_json(next_state())
+
+
+@benchmark("game.update")
+def bench_game_update():
+    from app import Game
+
+    states = decoded_states()
+    game = Game.from_json(states[0])
+    next_state = cycle(states)
+    return lambda: game.update(next_state())
+
+
+class Collector(object):
+    """Stands in for a seat's websocket and keeps what the table sends it."""
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, message):
+        self.messages.append(message)
+
+
+def server_stream(encoding, delta=False, games=3):
+    """Every message seat 0 receives over some simulated games, as the stand-in server sends them."""
+    import asyncio
+
+    messages = []
+    for seed in range(games):
+        collector = None
+        for table in simulated_game(seed):
+            if collector is None:
+                collector = Collector()
+                for seat in table.seats:
+                    seat.ws = collector if seat.index == 0 else Collector()
+                    seat.encoding, seat.delta = encoding, delta
+                message_type = "game_start"
+            else:
+                message_type = "game_end" if table.state.value == "ENDED" else "game_update"
+            asyncio.run(table.broadcast(message_type))
+        messages.extend(collector.messages)
+    return messages
+
+
+def bench_on_message(encoding, delta=False):
+    from codec import subprotocol_for
+    from handler import GameHandler
+    from recording import ReplayConnection
+    from socket_client import SocketHandler
+
+    use_shared_state()
+    handler = SocketHandler.get_instance()
+    connection = ReplayConnection(subprotocol_for(encoding, delta))
+    handler.on_open(connection)
+    # each game starts with a snapshot, so cycling around is a valid delta stream too
+    next_payload = cycle(server_stream(encoding, delta))
+
+    def op():
+        handler.on_message(connection, next_payload())
+        return GameHandler.get_game_instance()
+    return op
+
+
+def register_on_message():
+    from codec import ENCODINGS, JSON
+
+    for encoding in ENCODINGS:
+        benchmark("socket.on_message[{}]".format(encoding))(lambda encoding=encoding: bench_on_message(encoding))
+    benchmark("socket.on_message[{}+delta]".format(JSON))(lambda: bench_on_message(JSON, True))
+
+
+register_on_message()
+
+
+@benchmark("hints.rollout")
+def bench_hint_rollout():
+    from app import playable_mask
+    from hints import dealt_game, deal, position_for, rollout
+
+    rng = random.Random(0)
+    positions = []
+    for seed in range(8):
+        position = position_for(dealt_game(seed))
+        positions.append((position, playable_mask(position[2])))
+    next_position = cycle(positions)
+
+    def op():
+        position, playable = next_position()
+        me, hand, board, counts = position
+        return rollout(deal(position, rng), board, playable, me, rng)
+    return op
+
+
+@benchmark("endgame.solve")
+def bench_endgame_solve():
+    from endgame import EndgameSolver, dealt_position
+
+    positions = [position for position in (dealt_position(seed, 20) for seed in range(16)) if position]
+    next_position = cycle(positions)
+
+    def op():
+        hands, board, current = next_position()
+        # a fresh table each time, so this is the cost of a cold solve
+        return EndgameSolver(current, table_bits=10).solve(hands, board, current)
+    return op
+
+
+@benchmark("analytics.message")
+def bench_analytics_message():
+    from analytics import RecordedSession
+
+    session = RecordedSession(None)
+    next_payload = cycle(game_payloads())
+    return lambda: session.on_message(0, next_payload())
+
+
+@benchmark("widget.suit_widget", needs_kivy=True)
+def bench_suit_widget():
+    from app import SUIT_MASKS, Suit
+    from main import SuitWidget
+
+    next_suit = cycle(enumerate(Suit))
+
+    def op():
+        index, suit = next_suit()
+        widget = SuitWidget(suit, [])
+        widget.update_cards(SUIT_MASKS[index])
+        return widget
+    return op
+
+
+@benchmark("widget.game_player_widget", needs_kivy=True)
+def bench_game_player_widget():
+    from handler import GameHandler
+    from main import GamePlayerWidget
+
+    use_shared_state()
+    state = decoded_states(games=1)[0]
+    GameHandler.set_game_state("game_start", state)
+    game = GameHandler.get_game_instance()
+    return lambda: GamePlayerWidget(player=game.me)
+
+
+def use_headless_kivy():
+    # must happen before kivy is first imported
+    os.environ.setdefault("KIVY_GL_BACKEND", "mock")
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+
+def measure(op, repeat, min_time):
+    timer = timeit.Timer(op)
+    number, elapsed = timer.autorange()
+    # scale up so every run lasts at least min_time
+    number = max(number, int(number * min_time / elapsed) if elapsed else number)
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e9
+
+
+def run(names, repeat, min_time):
+    results = {}
+    for name, setup, needs_kivy in BENCHMARKS:
+        if name not in names:
+            continue
+        if needs_kivy:
+            use_headless_kivy()
+        results[name] = measure(setup(), repeat, min_time)
+        print("{:<34} {:>12.0f} ns/op".format(name, results[name]), flush=True)
+    return results
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as fd:
+        return json.load(fd)
+
+
+def save_baseline(path, results):
+    baseline = load_baseline(path) or {}
+    baseline.update({
+        "time": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+    })
+    baseline.setdefault("results", {}).update(results)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as fd:
+        json.dump(baseline, fd, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def compare(results, baseline, thresholds):
+    """Print current / baseline per benchmark; returns the names over their threshold."""
+    regressions = []
+    print("{:<34} {:>12} {:>12} {:>7} {:>9}".format("benchmark", "baseline ns", "current ns", "ratio", "threshold"))
+    for name, current in results.items():
+        previous = baseline["results"].get(name)
+        threshold = thresholds.get(name, DEFAULT_THRESHOLD)
+        if previous is None:
+            print("{:<34} {:>12} {:>12.0f}".format(name, "-", current))
+            continue
+        ratio = current / previous
+        flag = ""
+        if ratio > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<34} {:>12.0f} {:>12.0f} {:>7.2f} {:>9.2f}{}".format(name, previous, current, ratio, threshold, flag))
+    return regressions
+
+
+def parse_thresholds(values, default):
+    thresholds = dict(THRESHOLDS)
+    for value in values:
+        name, _, ratio = value.partition("=")
+        thresholds[name] = float(ratio)
+    if default is not None:
+        for name, _, _ in BENCHMARKS:
+            thresholds.setdefault(name, default)
+    return thresholds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Client microbenchmarks")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--no-widgets", action="store_true", help="skip the Kivy widget benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.1, help="seconds per timed run")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--default-threshold", type=float, default=None,
+                        help="allowed current/baseline ratio (default {})".format(DEFAULT_THRESHOLD))
+    parser.add_argument("--threshold", action="append", default=[], metavar="NAME=RATIO",
+                        help="allowed current/baseline ratio for one benchmark")
+    parser.add_argument("--list", action="store_true")
+    args = parser.parse_args()
+
+    names = [name for name, _, needs_kivy in BENCHMARKS
+             if args.filter in name and not (needs_kivy and args.no_widgets)]
+    if args.list:
+        print("\n".join(names))
+        return 0
+    try:
+        results = run(names, args.repeat, args.min_time)
+    finally:
+        from handler import GameHandler
+        if GameHandler.get_game_data() is not None:
+            GameHandler.get_game_data().close()
+    if args.save:
+        save_baseline(args.baseline, results)
+        print("baseline saved to", args.baseline)
+        return 0
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print("no baseline at {}; run with --save first".format(args.baseline))
+        return 0
+    print()
+    regressions = compare(results, baseline, parse_thresholds(args.threshold, args.default_threshold))
+    if regressions:
+        print("{} benchmark(s) regressed: {}".format(len(regressions), ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+import json
+import os
+import threading
+import weakref
+
+from kivy.atlas import Atlas
+from kivy.cache import Cache
+from kivy.clock import Clock
+from kivy.core.image import Image as CoreImage, ImageLoader
+from kivy.graphics.texture import TextureRegion
+
+import log
+from app import ALL_CARDS
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CARDS_DIR = os.path.join(BASE_DIR, "cards")
+CACHE_DIR = os.path.join(BASE_DIR, ".cache")
+ATLAS_NAME = "cards"
+BACK_NAME = "red_back"
+# the source pngs are 691x1056, far larger than a card is ever drawn; this
+# keeps the whole deck in a single 1024x1372 texture
+CARD_SIZE = (128, 196)
+ATLAS_COLUMNS = 8
+
+
+def card_names():
+    return [card.image_name for card in ALL_CARDS] + [BACK_NAME]
+
+
+def card_source(name):
+    return os.path.join(CARDS_DIR, "{}.png".format(name))
+
+
+def atlas_path(cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, ATLAS_NAME + ".atlas")
+
+
+def is_atlas_stale(cache_dir=CACHE_DIR):
+    path = atlas_path(cache_dir)
+    if not os.path.exists(path):
+        return True
+    built = os.path.getmtime(path)
+    return any(os.path.getmtime(card_source(name)) > built for name in card_names())
+
+
+def build_card_atlas(cache_dir=CACHE_DIR, card_size=CARD_SIZE):
+    """
+    Pack every card into one png plus a kivy `.atlas` index. Files are
+    written to a temporary name first so a killed build never leaves a
+    half written atlas behind.
+    """
+    from PIL import Image
+
+    names = card_names()
+    width, height = card_size
+    rows = (len(names) + ATLAS_COLUMNS - 1) // ATLAS_COLUMNS
+    sheet_size = (ATLAS_COLUMNS * width, rows * height)
+    sheet = Image.new("RGBA", sheet_size)
+    image_name = "{}-0.png".format(ATLAS_NAME)
+    ids = {}
+    for i, name in enumerate(names):
+        with Image.open(card_source(name)) as image:
+            image = image.convert("RGBA").resize(card_size, Image.LANCZOS)
+        x = (i % ATLAS_COLUMNS) * width
+        top = (i // ATLAS_COLUMNS) * height
+        sheet.paste(image, (x, top))
+        # kivy textures have their origin at the bottom left
+        ids[name] = [x, sheet_size[1] - top - height, width, height]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    image_path = os.path.join(cache_dir, image_name)
+    sheet.save(image_path + ".tmp", format="PNG")
+    os.replace(image_path + ".tmp", image_path)
+    path = atlas_path(cache_dir)
+    with open(path + ".tmp", "w") as fd:
+        json.dump({image_name: ids}, fd)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+class CardTextures(object):
+    """
+    Card textures shared by every widget. `load_async` builds the atlas if
+    needed and decodes it on a background thread; only the texture upload
+    runs on the main thread. Until then (or when no atlas can be built,
+    e.g. without Pillow) the individual pngs are used.
+    """
+    textures = None
+    atlas_uri = None
+    sheets = []
+    _thread = None
+    _listeners = []
+
+    @classmethod
+    def load_async(cls, cache_dir=CACHE_DIR):
+        if cls._thread is not None:
+            return
+        cls._thread = threading.Thread(target=cls._load, args=(cache_dir,), daemon=True)
+        cls._thread.start()
+
+    @classmethod
+    def _load(cls, cache_dir):
+        images = None
+        try:
+            if is_atlas_stale(cache_dir):
+                build_card_atlas(cache_dir)
+            path = atlas_path(cache_dir)
+            with open(path) as fd:
+                meta = json.load(fd)
+            images = [(ImageLoader.load(os.path.join(cache_dir, image_name), keep_data=True), ids)
+                      for image_name, ids in meta.items()]
+        except (ImportError, OSError, ValueError) as e:
+            log.warning("card_atlas_unavailable", error=str(e))
+        Clock.schedule_once(lambda dt: cls._on_loaded(cache_dir, images), 0)
+
+    @classmethod
+    def _on_loaded(cls, cache_dir, images):
+        textures = {}
+        sheets = []
+        if images:
+            for image, ids in images:
+                texture = image.texture
+                sheets.append(texture)
+                for name, coords in ids.items():
+                    textures[name] = texture.get_region(*coords)
+            # register the decoded atlas so `atlas://` sources resolve to the
+            # same texture instead of loading it a second time
+            uri = atlas_path(cache_dir)[:-len(".atlas")]
+            Cache.append("kv.atlas", uri, PreloadedAtlas(uri + ".atlas", textures))
+            cls.atlas_uri = "atlas://" + uri
+        if not images:
+            # every card is then decoded from its full size png on the main thread
+            log.warning("card_atlas_fallback", cards=len(card_names()))
+        cls.textures = textures
+        cls.sheets = sheets
+        listeners, cls._listeners = cls._listeners, []
+        for ref in listeners:
+            callback = ref()
+            if callback is not None:
+                callback()
+
+    @classmethod
+    def bind(cls, callback):
+        """
+        Call `callback` once textures are ready, or now if they already are.
+        A bound method is only weakly held, so waiting for textures does not
+        keep an unloaded widget alive.
+        """
+        if cls.is_loaded():
+            callback()
+        elif hasattr(callback, "__self__"):
+            cls._listeners.append(weakref.WeakMethod(callback))
+        else:
+            cls._listeners.append(lambda: callback)
+
+    @classmethod
+    def is_loaded(cls):
+        return cls.textures is not None
+
+    @classmethod
+    def get(cls, name):
+        if cls.textures is None:
+            return None
+        texture = cls.textures.get(name)
+        if texture is None:
+            log.debug("card_png_loaded", card=name)
+            texture = cls.textures[name] = CoreImage(card_source(name)).texture
+        return texture
+
+    @classmethod
+    def release(cls):
+        """
+        Forget the textures so their memory can be freed once no widget
+        draws them; `load_async` loads them again.
+        """
+        if cls.textures is None:
+            return
+        if cls.atlas_uri is not None:
+            Cache.remove("kv.atlas", cls.atlas_uri[len("atlas://"):])
+        cls.textures = None
+        cls.atlas_uri = None
+        cls.sheets = []
+        cls._thread = None
+
+    @classmethod
+    def texture_bytes(cls):
+        """Estimated memory of the loaded card textures at 4 bytes a pixel."""
+        if cls.textures is None:
+            return 0
+        pixels = sum(texture.width * texture.height for texture in cls.sheets)
+        # cards missing from the atlas are whole textures of their own
+        pixels += sum(texture.width * texture.height for texture in cls.textures.values()
+                      if not isinstance(texture, TextureRegion))
+        return pixels * 4
+
+    @classmethod
+    def source(cls, name):
+        if cls.atlas_uri is not None:
+            return "{}/{}".format(cls.atlas_uri, name)
+        return "cards/{}.png".format(name)
+
+
+class PreloadedAtlas(Atlas):
+    def __init__(self, filename, textures):
+        self._preloaded = textures
+        super(PreloadedAtlas, self).__init__(filename)
+
+    def _load(self):
+        self.textures = self._preloaded
+
+
+if __name__ == "__main__":
+    print(build_card_atlas())
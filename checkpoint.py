@@ -0,0 +1,124 @@
+"""
+On disk checkpoint of the latest game state, so that an app killed by the
+OS comes back showing the game straight away instead of after a new
+handshake and game_start.
+
+The file is a shared_state snapshot (hand, board and possible move masks,
+turn, state, seq, card counts and names) behind a small header: a magic,
+a checksum of the shared_state layout it was taken with and one of the
+snapshot itself. Anything that doesn't check out is ignored. Saves are
+handed to a writer thread that only keeps the newest one, and each write
+goes to a temporary file that is fsynced and renamed over the old one, so
+a kill mid write leaves the previous checkpoint intact.
+"""
+import os
+import struct
+import threading
+import time
+import zlib
+
+import log
+from shared_state import LAYOUT, SNAPSHOT_SIZE
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CHECKPOINT_DIR = os.environ.get("PATTA_CHECKPOINT_DIR", os.path.join(BASE_DIR, ".cache"))
+# older checkpoints are from a game the server has long forgotten
+MAX_AGE = 6 * 3600
+
+MAGIC = b"PATTACK1"
+_HEADER = struct.Struct("<8sII")
+_LAYOUT_CRC = zlib.crc32(LAYOUT)
+
+
+def checkpoint_path(name):
+    return os.path.join(CHECKPOINT_DIR, "state-{}.bin".format(name))
+
+
+def load(path, max_age=MAX_AGE):
+    """The snapshot saved at `path`, or None if there is none or it is stale, corrupt or from another layout."""
+    try:
+        if time.time() - os.path.getmtime(path) > max_age:
+            return None
+        with open(path, "rb") as fd:
+            data = fd.read()
+    except OSError:
+        return None
+    if len(data) != _HEADER.size + SNAPSHOT_SIZE:
+        return None
+    magic, layout_crc, crc = _HEADER.unpack_from(data)
+    snapshot = data[_HEADER.size:]
+    if magic != MAGIC or layout_crc != _LAYOUT_CRC or zlib.crc32(snapshot) != crc:
+        log.warning("checkpoint_invalid", path=path)
+        return None
+    return snapshot
+
+
+class Checkpointer(object):
+    """
+    Writes snapshots to `path` on a daemon thread. `save` never blocks on
+    the disk; a save made while a write is in progress replaces any other
+    waiting one. The thread is started by the first save, so a checkpointer
+    created before the socket process is forked runs in that process.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.condition = threading.Condition()
+        self.pending = None
+        self.writing = False
+        self.thread = None
+        self.writes = 0
+
+    def save(self, snapshot):
+        self._submit(snapshot)
+
+    def clear(self):
+        """Forget the checkpoint, e.g. once the game is over."""
+        self._submit(b"")
+
+    def _submit(self, snapshot):
+        with self.condition:
+            self.pending = snapshot
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def flush(self, timeout=1.0):
+        """Wait until everything saved so far is on disk; False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.pending is not None or self.writing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                snapshot, self.pending = self.pending, None
+                self.writing = True
+            try:
+                if snapshot:
+                    self.write(snapshot)
+                elif os.path.exists(self.path):
+                    os.remove(self.path)
+            except OSError as e:
+                log.warning("checkpoint_failed", path=self.path, error=repr(e))
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def write(self, snapshot):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as fd:
+            fd.write(_HEADER.pack(MAGIC, _LAYOUT_CRC, zlib.crc32(snapshot)))
+            fd.write(snapshot)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp, self.path)
+        self.writes += 1
@@ -0,0 +1,236 @@
+"""
+Wire formats for server messages.
+
+`json` is the original format: cards as "7:H" strings and card_map as
+[low, high] string pairs. The `mask` formats carry the same message with
+every set of cards as a 52 bit card mask (hand, board and possible moves),
+either as JSON or, when msgpack is installed, as msgpack. The format is
+negotiated with a websocket subprotocol; servers that do not know about it
+simply keep sending `json`.
+
+A `+delta` subprotocol additionally lets the server follow a snapshot with
+`game_delta` messages: sequence numbered patches holding only the cards
+added to the board, the cards that left my hand, the turn, the state and
+the changed card counts. A delta whose seq does not follow the last one
+applied means something was missed and the client asks for a snapshot.
+
+    python codec.py            # decode benchmark over a simulated game
+"""
+import json
+
+from app import Card, SUIT_MASKS, cards_to_mask, card_map_to_mask, mask_to_cards, mask_to_card_map
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "json"
+MASK_JSON = "mask+json"
+MASK_MSGPACK = "mask+msgpack"
+
+GAME_DELTA = "game_delta"
+
+SUBPROTOCOL_PREFIX = "patta.v1."
+DELTA_SUFFIX = "+delta"
+ENCODINGS = [MASK_MSGPACK, MASK_JSON, JSON] if msgpack is not None else [MASK_JSON, JSON]
+
+
+def subprotocol_for(encoding, delta=False):
+    return SUBPROTOCOL_PREFIX + encoding + (DELTA_SUFFIX if delta else "")
+
+
+SUBPROTOCOLS = [subprotocol_for(encoding, True) for encoding in ENCODINGS] + \
+               [subprotocol_for(encoding) for encoding in ENCODINGS]
+
+
+def parse_subprotocol(subprotocol):
+    """Returns (encoding, delta) for a negotiated subprotocol."""
+    if subprotocol and subprotocol.startswith(SUBPROTOCOL_PREFIX):
+        encoding = subprotocol[len(SUBPROTOCOL_PREFIX):]
+        delta = encoding.endswith(DELTA_SUFFIX)
+        if delta:
+            encoding = encoding[:-len(DELTA_SUFFIX)]
+        if encoding in ENCODINGS:
+            return encoding, delta
+    return JSON, False
+
+
+def encoding_for_subprotocol(subprotocol):
+    return parse_subprotocol(subprotocol)[0]
+
+
+def _dumps(message, encoding):
+    if encoding == MASK_MSGPACK:
+        return msgpack.packb(message)
+    if encoding == MASK_JSON:
+        return json.dumps(message, separators=(",", ":"))
+    return json.dumps(message)
+
+
+def encode_message(message_type, game, me, hand_mask, board_mask, possible_mask, encoding=JSON, seq=None):
+    """
+    Serialize one server message. `game` holds the scalar game fields
+    (players, current_player_id, state, card_count) and `me` the player
+    fields other than the cards.
+    """
+    if encoding == JSON:
+        message = {
+            "type": message_type,
+            "game": dict(game, card_map=mask_to_card_map(board_mask)),
+            "me": dict(me, cards=[card.str for card in mask_to_cards(hand_mask)]),
+            "possible_moves": [card.str for card in mask_to_cards(possible_mask)],
+        }
+    else:
+        message = {
+            "type": message_type,
+            "game": dict(game, board=board_mask),
+            "me": dict(me, cards=hand_mask),
+            "possible_moves": possible_mask,
+        }
+    if seq is not None:
+        message["seq"] = seq
+    return _dumps(message, encoding)
+
+
+def encode_delta(seq, board_mask, added_mask, removed_mask, current_player_id, state, card_count,
+                 player_counts=None, encoding=JSON):
+    """
+    Serialize a `game_delta`. In JSON the board change is sent as the new
+    [low, high] range of every suit that grew, keyed by suit index.
+    """
+    delta = {
+        "current_player_id": current_player_id,
+        "state": state,
+        "card_count": card_count,
+    }
+    if player_counts:
+        delta["players"] = {str(index): count for index, count in player_counts.items()}
+    if encoding == JSON:
+        if added_mask:
+            card_map = mask_to_card_map(board_mask)
+            delta["card_map"] = {str(suit): card_map[suit] for suit, suit_mask in enumerate(SUIT_MASKS)
+                                 if added_mask & suit_mask}
+        if removed_mask:
+            delta["removed"] = [card.str for card in mask_to_cards(removed_mask)]
+    else:
+        if added_mask:
+            delta["board"] = added_mask
+        if removed_mask:
+            delta["removed"] = removed_mask
+    return _dumps({"type": GAME_DELTA, "seq": seq, "delta": delta}, encoding)
+
+
+class MessageDecoder(object):
+    """
+    Turns raw server messages into (type, game_json) in the shape Game
+    expects, with hands as masks and possible moves as Cards. Card fields
+    that did not change since the previous message are not parsed again;
+    every message is decoded, even one identical to the last (a repeated
+    `invalid_move` still has to reach the client).
+    """
+    def __init__(self, encoding=JSON):
+        self.encoding = encoding
+        if encoding == MASK_MSGPACK:
+            self.loads = msgpack.unpackb
+        else:
+            self.loads = json.loads
+        self._cache = {}
+
+    @classmethod
+    def for_subprotocol(cls, subprotocol):
+        return cls(encoding_for_subprotocol(subprotocol))
+
+    def _cached(self, field, raw, parse):
+        key = tuple(raw) if isinstance(raw, list) else raw
+        cached = self._cache.get(field)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        value = parse(raw)
+        self._cache[field] = (key, value)
+        return value
+
+    def decode(self, raw):
+        message = self.loads(raw)
+        if message["type"] == GAME_DELTA:
+            return GAME_DELTA, self.decode_delta(message)
+        game_json = message["game"]
+        me = message["me"]
+        possible_moves = message.get("possible_moves") or 0
+        if self.encoding == JSON:
+            me["cards"] = self._cached("hand", me.get("cards") or [],
+                                       lambda cards: cards_to_mask([Card.from_str(card) for card in cards]))
+            game_json["board"] = self._cached("board", [tuple(suit) for suit in game_json["card_map"]],
+                                              card_map_to_mask)
+            possible_moves = self._cached("possible_moves", possible_moves or [],
+                                          lambda cards: [Card.from_str(card) for card in cards])
+        else:
+            game_json["card_map"] = self._cached("board", game_json["board"], mask_to_card_map)
+            possible_moves = self._cached("possible_moves", possible_moves, mask_to_cards)
+        game_json["me"] = me
+        # callers may keep and mutate the list
+        game_json["possible_moves"] = list(possible_moves)
+        game_json["seq"] = message.get("seq")
+        return message["type"], game_json
+
+    def decode_delta(self, message):
+        """Normalize a delta to masks: `board` is a superset of the added cards, `removed` left my hand."""
+        delta = message["delta"]
+        delta["seq"] = message["seq"]
+        if self.encoding == JSON:
+            if "card_map" in delta:
+                delta["board"] = card_map_to_mask(delta.pop("card_map").values())
+            if "removed" in delta:
+                delta["removed"] = cards_to_mask([Card.from_str(card) for card in delta["removed"]])
+        if "players" in delta:
+            delta["players"] = {int(index): count for index, count in delta["players"].items()}
+        return delta
+
+
+def bench(games=20, repeat=5):
+    """Encode every message of some simulated games in each format and time decoding them."""
+    import random
+    import time
+    import zlib
+
+    from server import Table
+
+    rng = random.Random(0)
+    states = []
+    for seed in range(games):
+        table = Table("bench", 4, seed)
+        for index in range(4):
+            table.join("player{}".format(index), None)
+        table.deal()
+        while True:
+            game = table.game_json()
+            for seat in table.seats:
+                me = {"index": seat.index, "name": seat.name}
+                states.append((game, me, seat.hand, table.board, table.legal_mask(seat)))
+            if not table.seats[table.current].hand:
+                break
+            seat = table.seats[table.current]
+            legal = mask_to_cards(table.legal_mask(seat))
+            table.play(seat, rng.choice(legal).str if legal else "pass")
+
+    print("{:<14} {:>10} {:>12} {:>14}".format("encoding", "bytes/msg", "deflated/msg", "decode us/msg"))
+    for encoding in ENCODINGS:
+        payloads = [encode_message("game_update", game, me, hand, board, possible, encoding)
+                    for game, me, hand, board, possible in states]
+        size = sum(len(payload) for payload in payloads)
+        deflated = sum(len(zlib.compress(payload if isinstance(payload, bytes) else payload.encode()))
+                       for payload in payloads)
+        best = None
+        for _ in range(repeat):
+            decoder = MessageDecoder(encoding)
+            start = time.perf_counter()
+            for payload in payloads:
+                decoder.decode(payload)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("{:<14} {:>10.0f} {:>12.0f} {:>14.2f}".format(
+            encoding, size / len(payloads), deflated / len(payloads), best / len(payloads) * 1e6))
+
+
+if __name__ == "__main__":
+    bench()
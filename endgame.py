@@ -0,0 +1,233 @@
+"""
+Exact endgame search.
+
+Once most cards are on the board a position (board mask, every hand, the
+player to move) is small enough to solve outright. The value is whether I
+win: the player to move picks the best move for themselves if it is me and
+the worst for me otherwise, so the opponents are treated as one coalition.
+With a win / loss value alpha-beta reduces to "stop at the first winning
+move" for me and "stop at the first losing one" for them, and every value
+the search returns is exact.
+
+Positions are keyed by Zobrist hashing of who holds each card (a card not in
+a hand is on the board) and whose turn it is, updated incrementally per
+move. The transposition table is a fixed number of slots indexed by the low
+bits of the key; a slot is kept for the position with more cards left
+(depth preferred), unless it is from an earlier search. Moves are tried
+by GameMove category, extending a suit before opening a new one, and
+within that a card next to another of the mover's own first.
+
+    python endgame.py --cards 20      # solve dealt positions with 20 cards in hand
+"""
+import argparse
+import random
+import time
+
+from app import GameMove, NUM_CARDS_PER_SUIT, SUIT_MASKS, playable_mask, update_playable
+
+MAX_PLAYERS = 8
+TABLE_BITS = 18
+
+# try the cheapest categories first; MOVE_FIRST (the opening 7:H) is always alone
+_CATEGORY_ORDER = {
+    GameMove.MOVE_FIRST: 0,
+    GameMove.MOVE_MIN: 0,
+    GameMove.MOVE_MAX: 0,
+    GameMove.MOVE_FIRST_SUIT: 1,
+}
+
+_keys = random.Random(0x5EE5)
+ZOBRIST = [[_keys.getrandbits(64) for _ in range(52)] for _ in range(MAX_PLAYERS)]
+TURN = [_keys.getrandbits(64) for _ in range(MAX_PLAYERS)]
+
+
+def move_type(card, board):
+    """GameMove of placing the card mask `card` on `board`, like Game.get_move_type."""
+    if not board:
+        return GameMove.MOVE_FIRST
+    suit_range = board & SUIT_MASKS[(card.bit_length() - 1) // NUM_CARDS_PER_SUIT]
+    if not suit_range:
+        return GameMove.MOVE_FIRST_SUIT
+    if card < suit_range & -suit_range:
+        return GameMove.MOVE_MIN
+    return GameMove.MOVE_MAX
+
+
+def zobrist(hands, current):
+    key = TURN[current]
+    for seat, hand in enumerate(hands):
+        while hand:
+            low = hand & -hand
+            key ^= ZOBRIST[seat][low.bit_length() - 1]
+            hand ^= low
+    return key
+
+
+class EndgameSolver(object):
+    """
+    Solves positions for seat `me`. The table survives between `solve`
+    calls, so successive positions of one game (or many deals of the same
+    position) share work; `stats()` covers everything searched so far.
+    """
+    def __init__(self, me, table_bits=TABLE_BITS):
+        self.me = me
+        self.table_mask = (1 << table_bits) - 1
+        # slot: (key, cards left, generation, value, best move)
+        self.table = [None] * (1 << table_bits)
+        self.generation = 0
+        self.nodes = 0
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        self.elapsed = 0.0
+
+    def order(self, legal, hand, board):
+        if not legal & (legal - 1):
+            return (legal,)
+        moves = []
+        while legal:
+            card = legal & -legal
+            legal ^= card
+            suit = SUIT_MASKS[(card.bit_length() - 1) // NUM_CARDS_PER_SUIT]
+            # holding the next card of the suit keeps my run going
+            continues = hand & ((card >> 1) | (card << 1)) & suit
+            moves.append((_CATEGORY_ORDER[move_type(card, board)], not continues, card))
+        moves.sort()
+        return [move[2] for move in moves]
+
+    def search(self, hands, board, playable, current, key, left):
+        """1 if `me` wins from here with best play on both sides, else 0. `hands` is restored on return."""
+        players = len(hands)
+        # forced passes need no node of their own
+        while not playable & hands[current]:
+            following = current + 1 if current + 1 < players else 0
+            key ^= TURN[current] ^ TURN[following]
+            current = following
+        self.nodes += 1
+        slot = key & self.table_mask
+        entry = self.table[slot]
+        self.probes += 1
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[3]
+        hand = hands[current]
+        legal = playable & hand
+        mine = current == self.me
+        following = current + 1 if current + 1 < players else 0
+        turn = TURN[current] ^ TURN[following]
+        value = 0 if mine else 1
+        best = 0
+        for card in self.order(legal, hand, board):
+            if hand == card:
+                # playing the last card wins outright
+                child = 1 if mine else 0
+            else:
+                hands[current] = hand ^ card
+                after = board | card
+                child = self.search(hands, after, update_playable(playable, after, card), following,
+                                    key ^ ZOBRIST[current][card.bit_length() - 1] ^ turn, left - 1)
+                hands[current] = hand
+            if child == mine:
+                # a win for me when I move, a loss for me when they do: nothing can beat it
+                value, best = child, card
+                break
+        if entry is None or entry[2] != self.generation or left >= entry[1]:
+            self.table[slot] = (key, left, self.generation, value, best)
+            self.stores += 1
+        return value
+
+    def solve(self, hands, board, current):
+        """(value, best move mask or 0) of the position; hands is a list of card masks per seat."""
+        self.generation += 1
+        start = time.perf_counter()
+        hands = list(hands)
+        playable = playable_mask(board)
+        left = sum(hand.bit_count() for hand in hands)
+        value = self.search(hands, board, playable, current, zobrist(hands, current), left)
+        self.elapsed += time.perf_counter() - start
+        while not playable & hands[current]:
+            current = (current + 1) % len(hands)
+        key = zobrist(hands, current)
+        entry = self.table[key & self.table_mask]
+        return value, entry[4] if entry is not None and entry[0] == key else 0
+
+    def rank(self, hands, board):
+        """{card mask: value} for each legal move of `me`, who is to move."""
+        hands = list(hands)
+        hand = hands[self.me]
+        following = (self.me + 1) % len(hands)
+        values = {}
+        legal = playable_mask(board) & hand
+        while legal:
+            card = legal & -legal
+            legal ^= card
+            if hand == card:
+                values[card] = 1
+                continue
+            hands[self.me] = hand ^ card
+            values[card] = self.solve(hands, board | card, following)[0]
+        hands[self.me] = hand
+        return values
+
+    def stats(self):
+        return {
+            "nodes": self.nodes,
+            "nodes_per_s": self.nodes / self.elapsed if self.elapsed else 0.0,
+            "tt_hit_rate": self.hits / self.probes if self.probes else 0.0,
+            "tt_fill": sum(1 for entry in self.table if entry is not None) / len(self.table),
+            "seconds": self.elapsed,
+        }
+
+
+def dealt_position(seed, cards, players=4):
+    """(hands, board, player to move) once random play has left `cards` cards in hands, or None if it ended first."""
+    from app import mask_to_cards
+    from server import Table
+
+    rng = random.Random(seed)
+    table = Table("endgame", players, seed)
+    for index in range(players):
+        table.join("player{}".format(index), None)
+    table.deal()
+    while sum(seat.hand.bit_count() for seat in table.seats) > cards:
+        seat = table.seats[table.current]
+        legal = mask_to_cards(table.legal_mask(seat))
+        table.play(seat, rng.choice(legal).str if legal else "pass")
+        if not seat.hand:
+            return None
+    return [seat.hand for seat in table.seats], table.board, table.current
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solve dealt endgames and report search speed")
+    parser.add_argument("--cards", type=int, default=24, help="cards left in hands")
+    parser.add_argument("--positions", type=int, default=100)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--table-bits", type=int, default=TABLE_BITS)
+    args = parser.parse_args()
+
+    solvers = {}
+    wins = 0
+    solved = 0
+    for seed in range(args.positions):
+        position = dealt_position(seed, args.cards, args.players)
+        if position is None:
+            continue
+        hands, board, current = position
+        solver = solvers.get(current)
+        if solver is None:
+            solver = solvers[current] = EndgameSolver(current, args.table_bits)
+        wins += solver.solve(hands, board, current)[0]
+        solved += 1
+    nodes = sum(solver.nodes for solver in solvers.values())
+    seconds = sum(solver.elapsed for solver in solvers.values())
+    probes = sum(solver.probes for solver in solvers.values())
+    hits = sum(solver.hits for solver in solvers.values())
+    print("{} positions with {} cards left, the player to move wins {}".format(solved, args.cards, wins))
+    print("{} nodes in {:.3f}s: {:.0f} nodes/s, {:.0f} us per position, tt hit rate {:.1%}".format(
+        nodes, seconds, nodes / seconds if seconds else 0, seconds * 1e6 / solved if solved else 0,
+        hits / probes if probes else 0))
+
+
+if __name__ == "__main__":
+    main()
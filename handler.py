@@ -1,7 +1,58 @@
-from app import Game
+import multiprocessing
+import threading
+
+import log
+from app import Game, GameState
+from shared_state import WriterStalled
+from telemetry import Telemetry
+
+
+class StateNotifier(object):
+    """
+    One way pipe from the socket process to the UI process. The socket side
+    sends the new state version after every write; the UI side drains the
+    pipe on a daemon thread and hands only the newest version to `callback`,
+    so a burst of messages results in a single render.
+    """
+    def __init__(self):
+        self.reader, self.writer = multiprocessing.Pipe(duplex=False)
+        self.thread = None
+
+    def notify(self, version):
+        self.writer.send(version)
+
+    def listen(self, callback):
+        self.thread = threading.Thread(target=self._run, args=(callback,), daemon=True)
+        self.thread.start()
+
+    def _run(self, callback):
+        while True:
+            try:
+                version = self.reader.recv()
+                while self.reader.poll():
+                    version = self.reader.recv()
+            except (EOFError, OSError):
+                return
+            callback(version)
+
 
 
 class GameHandler(object):
+    """
+    Holds the shared game state block (see shared_state). The socket side
+    publishes every decoded message into it, which bumps its version; the
+    materialized Game is only rebuilt when the version moves.
+    """
+    game = None
+    notifier = None
+    checkpointer = None
+    _game_instance = None
+    _game_version = None
+    # version the writer was found stuck at, so a dead writer is only waited for once
+    _stalled_version = None
+    cache_hits = 0
+    cache_misses = 0
+
     @classmethod
     def get_game_data(cls):
         return cls.game
@@ -11,15 +62,98 @@ class GameHandler(object):
         cls.game = game
 
     @classmethod
-    def update_data(cls, key, data):
-        cls.game[key] = data
+    def get_version(cls):
+        return cls.game.version
+
+    @classmethod
+    def set_notifier(cls, notifier):
+        cls.notifier = notifier
+
+    @classmethod
+    def set_checkpointer(cls, checkpointer):
+        """Save every state written from now on to disk (see checkpoint)."""
+        cls.checkpointer = checkpointer
+
+    @classmethod
+    def set_game_state(cls, message_type, data, received_ns=0):
+        cls.published(cls.game.write(message_type, data, received_ns), data["state"])
+
+    @classmethod
+    def apply_delta(cls, delta, received_ns=0):
+        """Patch the shared state with a decoded delta; raises ValueError if a snapshot is needed instead."""
+        cls.published(cls.game.apply_delta(delta, received_ns), delta["state"])
+
+    @classmethod
+    def published(cls, version, state):
+        if cls.notifier is not None:
+            cls.notifier.notify(version)
+        if cls.checkpointer is not None:
+            if GameState(state) == GameState.ENDED:
+                cls.checkpointer.clear()
+            else:
+                cls.checkpointer.save(cls.game.snapshot())
+
+    @classmethod
+    def restore(cls, snapshot):
+        """Publish a checkpointed state as if it had just been received."""
+        version = cls.game.restore(snapshot)
+        if cls.notifier is not None:
+            cls.notifier.notify(version)
 
     @classmethod
     def get_game_instance(cls):
-        game_data = cls.game.get("data")
-        if not game_data:
-            return game_data
-        return Game.from_json(game_data)
+        version = cls.get_version()
+        if cls._game_instance is not None and version == cls._game_version:
+            cls.cache_hits += 1
+            return cls._game_instance
+        if version == cls._stalled_version:
+            return cls._game_instance
+        cls.cache_misses += 1
+        try:
+            state = cls.game.read()
+        except WriterStalled as e:
+            # the socket process died mid write; keep showing the last good state
+            cls._stalled_version = version
+            log.warning("shared_state_stalled", error=str(e))
+            return cls._game_instance
+        if state is None:
+            return None
+        version, message_type, game_data, received_ns = state
+        if cls._game_instance is None:
+            cls._game_instance = Game.from_json(game_data)
+        else:
+            cls._game_instance.update(game_data, message_type)
+            pending = list(cls._game_instance.pending_moves)
+            if pending:
+                rejected = cls._game_instance.reconcile(message_type)
+                cls.record_confirmed(pending, rejected, received_ns)
+        cls._game_version = version
+        return cls._game_instance
+
+    @classmethod
+    def record_confirmed(cls, pending, rejected, received_ns):
+        """Stamp the move spans this state answered: echo when it was received, applied now."""
+        rejected = {seq for seq, card in rejected}
+        still_pending = cls._game_instance.pending_moves
+        for seq in pending:
+            if seq in rejected:
+                Telemetry.drop_span(seq)
+            elif seq not in still_pending:
+                Telemetry.mark(seq, "echo", received_ns or None)
+                Telemetry.mark(seq, "applied")
+
+    @classmethod
+    def invalidate(cls):
+        cls._game_instance = None
+        cls._game_version = None
+
+    @classmethod
+    def cache_stats(cls):
+        return {
+            "hits": cls.cache_hits,
+            "misses": cls.cache_misses,
+            "version": cls._game_version
+        }
 
 class WSHandler():
     @classmethod
@@ -32,4 +166,8 @@ class WSHandler():
 
     @classmethod
     def send_message(cls, message):
-        cls.ws.send(message)
\ No newline at end of file
+        cls.ws.send(message)
+
+    @classmethod
+    def close(cls):
+        cls.ws.close()
@@ -0,0 +1,427 @@
+"""
+Monte Carlo move hints.
+
+A hint ranks my legal moves by how often I go on to win. Opponents' hands
+are hidden, so each rollout first deals the unseen cards (not on the board,
+not in my hand) to the opponents according to their card counts, then
+plays every candidate move out to the end of the game with random legal
+moves for everybody. One deal is shared by all candidates of a rollout, so
+they are compared on the same hidden hands.
+
+Once no more than ENDGAME_CARDS are left in hands, each deal is solved
+exactly by the endgame solver instead of played out at random.
+
+Rollouts are pure card mask arithmetic and run in a process pool, in
+batches sized from the measured throughput: the first wave is small enough
+to answer within `first_ms` and later waves keep refining until
+`think_ms` runs out or the search is cancelled. Where worker processes
+cannot be spawned (python-for-android), or the pool fails to start or
+breaks, they run on a single background thread instead. Nothing here
+touches Kivy; `on_update` is called from the pool's result thread, so a
+UI has to hand it over to its own loop.
+
+    python hints.py --seed 3 --think-ms 2000     # rank the moves of a dealt game
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import log
+from app import FULL_MASK, mask_to_cards, playable_mask, update_playable
+from endgame import EndgameSolver
+from telemetry import Telemetry
+
+FIRST_MS = 150
+THINK_MS = 10000
+# later waves return about this often
+SLICE_MS = 100
+# rollouts per second of one worker until a batch has been timed
+DEFAULT_RATE = 2000
+# with this many cards left in hands a deal is solved exactly instead of played out at random
+ENDGAME_CARDS = 24
+# deals solved per move by `solved_move`
+SOLVED_DEALS = 8
+
+# one solver per seat, kept for the life of the process so its table carries over between batches
+_solvers = {}
+
+
+def solver_for(me):
+    solver = _solvers.get(me)
+    if solver is None:
+        solver = _solvers[me] = EndgameSolver(me)
+    return solver
+
+
+def mask_bits(mask):
+    bits = []
+    while mask:
+        low = mask & -mask
+        bits.append(low)
+        mask ^= low
+    return bits
+
+
+def pick(mask, rng):
+    """A uniformly random card of a non empty card mask."""
+    for _ in range(rng.randrange(mask.bit_count())):
+        mask &= mask - 1
+    return mask & -mask
+
+
+def deal(position, rng):
+    """One assignment of the unseen cards to the opponents consistent with their card counts."""
+    me, hand, board, counts = position
+    unseen = mask_bits(FULL_MASK & ~board & ~hand)
+    rng.shuffle(unseen)
+    opponents = [index for index in range(len(counts)) if index != me]
+    wanted = [counts[index] for index in opponents]
+    if min(wanted) < 0 or sum(wanted) != len(unseen):
+        # counts are missing or stale (e.g. a move not yet echoed); share the cards out evenly
+        wanted = [len(unseen) // len(opponents) + (i < len(unseen) % len(opponents)) for i in range(len(opponents))]
+    hands = [0] * len(counts)
+    hands[me] = hand
+    start = 0
+    for index, count in zip(opponents, wanted):
+        for card in unseen[start:start + count]:
+            hands[index] |= card
+        start += count
+    return hands
+
+
+def rollout(hands, board, playable, current, rng):
+    """Play random legal moves from `current` on until a hand is empty; returns that player's index. Mutates `hands`."""
+    players = len(hands)
+    while True:
+        legal = playable & hands[current]
+        if legal:
+            card = pick(legal, rng)
+            hands[current] ^= card
+            if not hands[current]:
+                return current
+            board |= card
+            playable = update_playable(playable, board, card)
+        current += 1
+        if current == players:
+            current = 0
+
+
+def play_out(position, candidates, rollouts, seed):
+    """
+    Worker: `rollouts` deals, each played out once after every candidate
+    (a card mask, or 0 for a pass), or solved exactly once few enough cards
+    are left. Returns (wins per candidate, rollouts, ns spent).
+    """
+    start = time.perf_counter_ns()
+    rng = random.Random(seed)
+    me, hand, board, counts = position
+    players = len(counts)
+    solver = solver_for(me) if FULL_MASK.bit_count() - board.bit_count() <= ENDGAME_CARDS else None
+    wins = [0] * len(candidates)
+    for _ in range(rollouts):
+        hands = deal(position, rng)
+        for i, card in enumerate(candidates):
+            if card and hand == card:
+                wins[i] += 1
+                continue
+            after = board | card
+            played = list(hands)
+            played[me] ^= card
+            if solver is not None:
+                wins[i] += solver.solve(played, after, (me + 1) % players)[0]
+            elif rollout(played, after, playable_mask(after), (me + 1) % players, rng) == me:
+                wins[i] += 1
+    return wins, rollouts, time.perf_counter_ns() - start
+
+
+def position_for(game):
+    """(my index, hand mask, board mask, card count per seat) of `game`'s position, picklable for the workers."""
+    position = game.position
+    counts = list(position.counts)
+    counts[position.me] = position.hand.bit_count()
+    return position.me, position.hand, position.board, tuple(counts)
+
+
+def solved_move(game, rng, deals=SOLVED_DEALS):
+    """
+    My move by solving `deals` deals of the hidden cards and taking the one
+    that wins most of them; None if there are too many cards left to solve
+    or nothing to play. Runs in the calling process.
+    """
+    if FULL_MASK.bit_count() - game.board_mask.bit_count() > ENDGAME_CARDS or not game.possible_moves:
+        return None
+    if len(game.possible_moves) == 1:
+        return game.possible_moves[0]
+    position = position_for(game)
+    solver = solver_for(position[0])
+    wins = {}
+    for _ in range(deals):
+        for card, value in solver.rank(deal(position, rng), game.board_mask).items():
+            wins[card] = wins.get(card, 0) + value
+    return max(game.possible_moves, key=lambda card: wins.get(card.mask, 0))
+
+
+def _warm():
+    return os.getpid()
+
+
+def can_spawn():
+    """Whether worker processes can be started here; python-for-android's bootstrap cannot spawn them."""
+    if "ANDROID_ARGUMENT" in os.environ:
+        return False
+    try:
+        multiprocessing.get_context("spawn")
+    except ValueError:
+        return False
+    return True
+
+
+class HintSearch(object):
+    """
+    One anytime search. `ranking()` is the current [(card, win rate, rollouts)]
+    best first (card None for a pass); it is refined by every finished batch
+    until the deadline or `cancel()`.
+    """
+    def __init__(self, engine, position, candidates, first_ms, think_ms, on_update):
+        self.engine = engine
+        self.position = position
+        self.candidates = candidates
+        self.masks = [card.mask if card is not None else 0 for card in candidates]
+        self.on_update = on_update
+        # reentrant: a batch that is already done runs on_batch inside submit
+        self.lock = threading.RLock()
+        self.wins = [0] * len(candidates)
+        self.rollouts = 0
+        self.in_flight = 0
+        self.cancelled = False
+        self.reported = False
+        self.started = time.perf_counter()
+        self.deadline = self.started + think_ms / 1000.0
+        self.first_ms = first_ms
+        self.first_answer_ms = None
+        self.seeds = random.Random()
+
+    @property
+    def done(self):
+        return self.cancelled or (self.in_flight == 0 and time.perf_counter() >= self.deadline)
+
+    def batch_size(self, ms):
+        per_candidate = self.engine.rate * ms / 1000.0 / max(1, len(self.candidates))
+        return max(1, int(per_candidate))
+
+    def submit(self, ms):
+        future = self.engine.executor().submit(play_out, self.position, self.masks, self.batch_size(ms),
+                                                self.seeds.getrandbits(64))
+        self.in_flight += 1
+        future.add_done_callback(self.on_batch)
+
+    def start(self):
+        # the first wave has to come back within first_ms, pool overhead included
+        with self.lock:
+            for _ in range(self.engine.workers):
+                self.submit(self.first_ms / 2)
+        return self
+
+    def on_batch(self, future):
+        with self.lock:
+            self.in_flight -= 1
+            error = None if future.cancelled() else future.exception()
+            if isinstance(error, BrokenProcessPool):
+                # a worker died or could not start: carry on in this process
+                self.engine.use_threads(repr(error))
+                if not self.cancelled and time.perf_counter() < self.deadline:
+                    self.submit(min(SLICE_MS, (self.deadline - time.perf_counter()) * 1000))
+                return
+            if future.cancelled() or error is not None:
+                if error is not None:
+                    log.error("hint_batch_failed", error=repr(error))
+                return
+            wins, rollouts, elapsed_ns = future.result()
+            for i, count in enumerate(wins):
+                self.wins[i] += count
+            self.rollouts += rollouts
+            self.engine.measured(rollouts * len(self.candidates), elapsed_ns)
+            if self.first_answer_ms is None:
+                self.first_answer_ms = (time.perf_counter() - self.started) * 1000
+                Telemetry.record("hints.first_answer", self.first_answer_ms * 1000)
+            if not self.cancelled and time.perf_counter() < self.deadline:
+                self.submit(min(SLICE_MS, (self.deadline - time.perf_counter()) * 1000))
+            finished = self.done and not self.reported
+            self.reported = self.reported or finished
+        if finished:
+            self.engine.finished(self)
+        if not self.cancelled and self.on_update is not None:
+            self.on_update(self)
+
+    def ranking(self):
+        with self.lock:
+            rollouts = self.rollouts
+            rates = [(card, wins / rollouts if rollouts else 0.0, rollouts)
+                     for card, wins in zip(self.candidates, self.wins)]
+        return sorted(rates, key=lambda rate: -rate[1])
+
+    def best(self):
+        ranking = self.ranking()
+        return ranking[0][0] if ranking and ranking[0][2] else None
+
+    def rollouts_per_s(self):
+        elapsed = time.perf_counter() - self.started
+        return self.rollouts * len(self.candidates) / elapsed if elapsed else 0.0
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            finished = not self.reported
+            self.reported = True
+        if finished:
+            self.engine.finished(self)
+
+
+class HintEngine(object):
+    """
+    Owns the worker pool, which is started on first use (or by `warm`) with
+    the spawn method so no worker inherits the UI's window or threads.
+    Without `processes` (by default when `can_spawn()` is false), or once
+    the process pool fails, a one thread pool is used instead.
+    `rate` is the measured rollouts per second of one worker and sizes the
+    batches; `stats()` reports throughput over every search so far.
+    """
+    def __init__(self, workers=None, processes=None):
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.processes = can_spawn() if processes is None else processes
+        self.pool = None
+        self.rate = DEFAULT_RATE
+        self.rollouts = 0
+        self.busy_ns = 0
+        self.searches = 0
+        self.current = None
+
+    def executor(self):
+        if self.pool is None and self.processes:
+            try:
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            except (OSError, NotImplementedError, ValueError) as e:
+                self.use_threads(repr(e))
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(1, thread_name_prefix="hints")
+        return self.pool
+
+    def use_threads(self, reason):
+        """Give up on worker processes for good and play rollouts on one thread of this process."""
+        if not self.processes:
+            return
+        log.warning("hint_pool_fallback", reason=reason)
+        self.processes = False
+        self.workers = 1
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def warm(self):
+        """Start the workers now rather than on the first hint; returns futures of their pids."""
+        return [self.executor().submit(_warm) for _ in range(self.workers)]
+
+    def start(self, game, first_ms=FIRST_MS, think_ms=THINK_MS, on_update=None):
+        """Search `game`'s possible moves (or the pass if there are none), cancelling any running search."""
+        self.cancel()
+        candidates = list(game.possible_moves) or [None]
+        self.searches += 1
+        self.current = HintSearch(self, position_for(game), candidates, first_ms, think_ms, on_update)
+        return self.current.start()
+
+    def measured(self, played, elapsed_ns):
+        """Account for a batch that played `played` games out in `elapsed_ns` of one worker."""
+        self.rollouts += played
+        self.busy_ns += elapsed_ns
+        Telemetry.counters["hints.rollouts"] = Telemetry.counters.get("hints.rollouts", 0) + played
+        if elapsed_ns:
+            # smoothed, so one slow batch (a worker starting up) doesn't shrink the next ones much
+            self.rate = 0.7 * self.rate + 0.3 * played * 1e9 / elapsed_ns
+
+    def finished(self, search):
+        if search is self.current:
+            self.current = None
+        log.info("hint_search", candidates=len(search.candidates), rollouts=search.rollouts,
+                 rollouts_per_s=round(search.rollouts_per_s()), cancelled=search.cancelled,
+                 first_answer_ms=None if search.first_answer_ms is None else round(search.first_answer_ms, 1))
+
+    def cancel(self):
+        if self.current is not None:
+            self.current.cancel()
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "processes": self.processes,
+            "searches": self.searches,
+            "rollouts": self.rollouts,
+            "rollouts_per_s": self.rollouts * 1e9 / self.busy_ns if self.busy_ns else 0.0,
+            "worker_rollouts_per_s": self.rate,
+        }
+
+    def shutdown(self):
+        self.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+
+def dealt_game(seed, players=4, moves=8):
+    """My Game (seat 0) after `moves` random moves of a game dealt by the stand-in server."""
+    from app import Game
+    from codec import JSON, MessageDecoder
+    from server import Table
+
+    rng = random.Random(seed)
+    table = Table("hints", players, seed)
+    for index in range(players):
+        table.join("player{}".format(index), None)
+    table.deal()
+    while moves > 0 or table.current != 0:
+        seat = table.seats[table.current]
+        legal = mask_to_cards(table.legal_mask(seat))
+        table.play(seat, rng.choice(legal).str if legal else "pass")
+        moves -= 1
+    return Game.from_json(MessageDecoder(JSON).decode(table.message_for(table.seats[0], "game_update"))[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank the moves of a dealt game and report rollout throughput")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--moves", type=int, default=8, help="random moves played before the hint")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--first-ms", type=float, default=FIRST_MS)
+    parser.add_argument("--think-ms", type=float, default=2000)
+    args = parser.parse_args()
+
+    game = dealt_game(args.seed, moves=args.moves)
+    print("hand", " ".join(card.str for card in game.me.cards))
+    print("moves", " ".join(card.str for card in game.possible_moves) or "pass")
+    engine = HintEngine(args.workers)
+    for future in engine.warm():
+        future.result()
+    done = threading.Event()
+
+    def on_update(search):
+        if search.done:
+            done.set()
+
+    search = engine.start(game, args.first_ms, args.think_ms, on_update)
+    done.wait(args.think_ms / 1000.0 + 5)
+    for card, rate, rollouts in search.ranking():
+        print("{:>5} {:6.1%} over {} rollouts".format(card.str if card else "pass", rate, rollouts))
+    stats = engine.stats()
+    print("first answer {:.0f} ms, {:.0f} rollouts/s over {} workers ({:.0f} per worker)".format(
+        search.first_answer_ms or 0, search.rollouts_per_s(), stats["workers"], stats["rollouts_per_s"]))
+    engine.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Headless load test: starts the stand-in server (unless --url is given) and
+N bot clients, each in its own process, built on SocketHandler and Game
+without importing Kivy. Reports throughput, per message handling latency,
+CPU time and peak RSS per client.
+
+    python loadtest.py --clients 16 --games 5 --policy random
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import time
+
+import websockets
+
+from app import GameState, cards_to_mask
+from codec import ENCODINGS, JSON, subprotocol_for
+from handler import GameHandler
+from shared_state import SharedGameState
+from telemetry import StartupTrace
+
+POLICIES = {
+    "first": lambda game, rng: game.possible_moves[0],
+    "last": lambda game, rng: game.possible_moves[-1],
+    "random": lambda game, rng: rng.choice(game.possible_moves),
+}
+
+
+def choose_move(game, policy, rng):
+    if not game.possible_moves:
+        return "pass"
+    return POLICIES[policy](game, rng).str
+
+
+class BotConnection(object):
+    """What SocketHandler expects of a connection: a plain `send` and the negotiated subprotocol."""
+    def __init__(self, ws, handler):
+        self.ws = ws
+        self.handler = handler
+        self.subprotocol = ws.subprotocol
+
+    def send(self, message):
+        asyncio.ensure_future(self._send(message))
+
+    async def _send(self, message):
+        await self.ws.send(message)
+        self.handler.on_send(self, message)
+
+
+async def play_games(url, games, policy, rng, latencies, mismatches, encoding, compression, delta):
+    from socket_client import SocketHandler
+
+    handler = SocketHandler.get_instance()
+    messages = 0
+    GameHandler.set_game_data(SharedGameState.create())
+    try:
+        for _ in range(games):
+            GameHandler.invalidate()
+            async with websockets.connect(url, subprotocols=[subprotocol_for(encoding, delta)],
+                                          compression=compression) as ws:
+                connection = BotConnection(ws, handler)
+                handler.on_open(connection)
+                async for raw in ws:
+                    start = time.perf_counter()
+                    handler.on_message(connection, raw)
+                    game = GameHandler.get_game_instance()
+                    latencies.append(time.perf_counter() - start)
+                    messages += 1
+                    if mismatches is not None and cards_to_mask(game.get_legal_moves()) != game.possible_moves_mask:
+                        mismatches.append(raw)
+                    if game.state == GameState.ENDED:
+                        break
+                    if game.state == GameState.STARTED and game.is_your_turn():
+                        connection.send(json.dumps({"message": choose_move(game, policy, rng)}))
+    finally:
+        GameHandler.get_game_data().close()
+    return messages
+
+
+def run_client(index, url, games, policy, seed, timeout, verify, encoding, compression, delta, record, results):
+    # log echoes warnings (resyncs, socket errors) with print; keep them out of the report
+    sys.stdout = open(os.devnull, "w")
+    StartupTrace.reset()
+    rng = random.Random(None if seed is None else seed + index)
+    if record is not None:
+        from recording import MessageRecorder
+        from socket_client import SocketHandler
+
+        os.makedirs(record, exist_ok=True)
+        SocketHandler.get_instance().set_recorder(MessageRecorder(os.path.join(record, "bot{}.rec".format(index))))
+    latencies = []
+    mismatches = [] if verify else None
+    error = None
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        messages = asyncio.run(asyncio.wait_for(play_games(url, games, policy, rng, latencies, mismatches,
+                                                                encoding, compression, delta),
+                                              timeout))
+    except Exception as e:
+        # report every client, even one that failed, so the run never hangs
+        messages = len(latencies)
+        error = repr(e)
+    results.put({
+        "client": index,
+        "messages": messages,
+        "latencies": latencies,
+        "wall": time.perf_counter() - wall,
+        "cpu": time.process_time() - cpu,
+        "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "error": error,
+        "mismatches": len(mismatches) if verify else None,
+        "startup_ms": StartupTrace.marks.get("socket_open"),
+    })
+
+
+def run_server(port, players, seed):
+    from server import PattaServer
+
+    sys.stdout = open(os.devnull, "w")
+    asyncio.run(PattaServer(players=players, seed=seed).serve(port=port))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("server did not start on port {}".format(port))
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def report(results, wall):
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+    messages = sum(result["messages"] for result in results)
+    print("clients: {}  messages: {}  wall: {:.2f}s  throughput: {:.0f} msg/s".format(
+        len(results), messages, wall, messages / wall if wall else 0))
+    print("handling latency ms  p50 {:.3f}  p90 {:.3f}  p99 {:.3f}  max {:.3f}".format(
+        *[percentile(latencies, pct) * 1000 for pct in (50, 90, 99, 100)]))
+    if results and results[0]["mismatches"] is not None:
+        print("rules engine mismatches with server possible_moves: {}".format(
+            sum(result["mismatches"] for result in results)))
+    startups = sorted(result["startup_ms"] for result in results if result["startup_ms"] is not None)
+    if startups:
+        print("bot spin-up to socket open ms  p50 {:.1f}  max {:.1f}".format(
+            percentile(startups, 50), startups[-1]))
+    print("{:>6} {:>9} {:>9} {:>9} {:>9}  {}".format("client", "messages", "cpu s", "msg/cpu s", "rss MB", "error"))
+    for result in sorted(results, key=lambda result: result["client"]):
+        print("{:>6} {:>9} {:>9.3f} {:>9.0f} {:>9.1f}  {}".format(
+            result["client"], result["messages"], result["cpu"],
+            result["messages"] / result["cpu"] if result["cpu"] else 0,
+            result["rss_kb"] / 1024.0, result["error"] or ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless multi-client load test")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--players", type=int, default=4, help="players per table on the stand-in server")
+    parser.add_argument("--games", type=int, default=1, help="games played by each client")
+    parser.add_argument("--policy", choices=sorted(POLICIES), default="first")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--verify", action="store_true",
+                        help="check Game.get_legal_moves against the server's possible_moves")
+    parser.add_argument("--encoding", choices=ENCODINGS, default=JSON)
+    parser.add_argument("--no-deflate", action="store_true", help="disable permessage-deflate")
+    parser.add_argument("--delta", action="store_true", help="ask for game_delta patches instead of full updates")
+    parser.add_argument("--record", default=None, metavar="DIR",
+                        help="record each client's messages to DIR/bot<N>.rec for recording.py")
+    parser.add_argument("--url", default=None, help="server url prefix; starts a local stand-in server if omitted")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        server = multiprocessing.Process(target=run_server, args=(port, args.players, args.seed), daemon=True)
+        server.start()
+        wait_for_port(port)
+        url = "ws://127.0.0.1:{}/ws/game/patta/".format(port)
+
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=run_client,
+                                       args=(i, "{}bot{}/".format(url, i), args.games, args.policy, args.seed,
+                                             args.timeout, args.verify, args.encoding,
+                                             None if args.no_deflate else "deflate", args.delta, args.record, results))
+               for i in range(args.clients)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    collected = [results.get() for _ in clients]
+    wall = time.perf_counter() - start
+    for client in clients:
+        client.join()
+    if server is not None:
+        server.terminate()
+    report(collected, wall)
+
+
+if __name__ == "__main__":
+    main()
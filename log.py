@@ -0,0 +1,136 @@
+"""
+Leveled event log. Every event is a name plus keyword fields, kept as is
+(not formatted) in a per process ring buffer; only events at or above
+`echo_level` are formatted and printed. A call below `level` returns after
+one comparison, so debug events cost next to nothing when disabled. Guard
+fields that are expensive to compute with `Log.enabled(DEBUG)`.
+
+The buffer is written out as JSON lines by `Log.dump`, which the crash hooks
+call on an uncaught exception:
+
+    PATTA_LOG_LEVEL=DEBUG PATTA_LOG_ECHO=INFO python socket_client.py <name>
+"""
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_DIR = os.path.join(BASE_DIR, "logs")
+RING_SIZE = 2048
+
+
+def _level_from_env(key, default):
+    return LEVELS.get(os.environ.get(key, "").upper(), default)
+
+
+class Log(object):
+    level = _level_from_env("PATTA_LOG_LEVEL", INFO)
+    echo_level = _level_from_env("PATTA_LOG_ECHO", WARNING)
+    ring = collections.deque(maxlen=RING_SIZE)
+    _hooks_installed = False
+
+    @classmethod
+    def enabled(cls, level):
+        return level >= cls.level
+
+    @classmethod
+    def set_level(cls, level, echo_level=None):
+        cls.level = level
+        if echo_level is not None:
+            cls.echo_level = echo_level
+
+    @classmethod
+    def log(cls, level, event, fields):
+        if level < cls.level:
+            return
+        record = (time.time(), level, event, fields)
+        cls.ring.append(record)
+        if level >= cls.echo_level:
+            print(cls.format(record))
+
+    @classmethod
+    def format(cls, record):
+        timestamp, level, event, fields = record
+        text = " ".join("{}={}".format(key, value) for key, value in fields.items())
+        return "{:.3f} {:<7} {} {}".format(timestamp, LEVEL_NAMES.get(level, level), event, text).rstrip()
+
+    @classmethod
+    def dump(cls, path=None, reason=None):
+        """Write the ring buffer to `path` (default logs/<process>-<pid>-<time>.jsonl) and return the path."""
+        if path is None:
+            os.makedirs(LOG_DIR, exist_ok=True)
+            path = os.path.join(LOG_DIR, "{}-{}-{}.jsonl".format(
+                _process_name(), os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        records = list(cls.ring)
+        with open(path, "w") as fd:
+            for timestamp, level, event, fields in records:
+                fd.write(json.dumps({"time": timestamp, "level": LEVEL_NAMES.get(level, level),
+                                     "event": event, **fields}, default=repr))
+                fd.write("\n")
+            if reason is not None:
+                fd.write(json.dumps({"time": time.time(), "level": "ERROR", "event": "dump",
+                                     "reason": reason}, default=repr))
+                fd.write("\n")
+        return path
+
+    @classmethod
+    def install_crash_hooks(cls):
+        """Dump the buffer on any uncaught exception, in the main thread or any other."""
+        if cls._hooks_installed:
+            return
+        cls._hooks_installed = True
+        previous_hook = sys.excepthook
+        previous_thread_hook = threading.excepthook
+
+        def excepthook(exc_type, exc, tb):
+            cls.crashed(exc)
+            previous_hook(exc_type, exc, tb)
+
+        def thread_excepthook(args):
+            cls.crashed(args.exc_value, thread=args.thread.name if args.thread else None)
+            previous_thread_hook(args)
+
+        sys.excepthook = excepthook
+        threading.excepthook = thread_excepthook
+
+    @classmethod
+    def crashed(cls, exc, **fields):
+        cls.log(ERROR, "crash", dict(fields, error=repr(exc)))
+        try:
+            print("event log written to", cls.dump(reason=repr(exc)))
+        except OSError as e:
+            print("could not write event log:", e)
+
+
+def _process_name():
+    import multiprocessing
+    return multiprocessing.current_process().name.replace(" ", "_")
+
+
+def debug(event, **fields):
+    if DEBUG >= Log.level:
+        Log.log(DEBUG, event, fields)
+
+
+def info(event, **fields):
+    if INFO >= Log.level:
+        Log.log(INFO, event, fields)
+
+
+def warning(event, **fields):
+    Log.log(WARNING, event, fields)
+
+
+def error(event, **fields):
+    Log.log(ERROR, event, fields)
@@ -1,32 +1,34 @@
+# Only what the first frame needs is imported here; animations, popups and
+# labels are imported where they are first used.
 import json
-import multiprocessing
-import random
+import os
 from functools import partial
 
 import kivy
-import websocket
 from kivy.app import App
 from kivy.clock import Clock
 from kivy.graphics.context_instructions import Color
 from kivy.graphics.vertex_instructions import Rectangle
 from kivy.uix.floatlayout import FloatLayout
-from kivy.uix.label import Label
-from kivy.uix.popup import Popup
 from kivy.uix.tabbedpanel import TabbedPanel, TabbedPanelHeader
 from kivy.uix.widget import Widget
 from kivy.uix.button import Button
 from kivy.uix.boxlayout import BoxLayout
-from kivy.properties import ListProperty, BooleanProperty, ObjectProperty
+from kivy.properties import BooleanProperty, ObjectProperty
 from kivy.utils import get_color_from_hex
 
-from app import Card, Suit, Number, CardIterator, Game, GamePlayer, GameState
-from socket_client import SocketHandler
+from app import Card, Suit, Number, CardIterator, Game, GamePlayer, SUIT_MASKS, cards_to_mask
 from handler import GameHandler, WSHandler
+from card_atlas import CardTextures
+import log
+import memory
+import telemetry
+from log import Log, DEBUG
+from memory import MemoryBudget
+from telemetry import StartupTrace, Telemetry
 
 kivy.require('1.0.7')
 
-from kivy.config import Config
-
 # 0 being off 1 being on as in true / false
 # you can use 0 or 1 && True or False
 # Config.set('graphics', 'resizable', True)
@@ -40,13 +42,14 @@ purple = [1, 0, 1, 1]
 class CardWidget(BoxLayout):
     is_selected = BooleanProperty()
     is_highlighted = BooleanProperty()
+    pending_seq = ObjectProperty(None, allownone=True)
 
     def __init__(self, card, is_selected, is_clickable, **kwargs):
         super(CardWidget, self).__init__(**kwargs)
         self.colors = [red, green, blue, purple]
         self.card = card
         # self.id = str(uuid.uuid4())
-        button = Button(background_normal='cards/{}.png'.format(card.image_name))
+        button = Button(background_normal=CardTextures.source(card.image_name))
         if is_clickable:
             button.bind(on_press=self.button_click)
         self.add_widget(button)
@@ -58,7 +61,7 @@ class CardWidget(BoxLayout):
         game = GameHandler.get_game_instance()
         card = self.card
         if self.is_selected:
-            print("invalid move")
+            log.debug("invalid_click", card=card.str, reason="on board")
             return
         if self.is_highlighted:
             self.is_highlighted = False
@@ -66,9 +69,9 @@ class CardWidget(BoxLayout):
         flag = game.is_valid_move(card)
         if flag:
             self.is_highlighted = True
-            print("Current Player", game.current_player_index)
+            log.debug("card_highlighted", card=card.str, current_player=game.current_player_index)
         else:
-            print("invalid move")
+            log.debug("invalid_click", card=card.str, reason="not playable")
 
     def select(self):
         self.is_selected = True
@@ -80,29 +83,49 @@ class CardWidget(BoxLayout):
         self.is_highlighted = False
 
 
-class SuitWidget(FloatLayout):
+class SuitWidget(Widget):
+    """
+    Draws the 13 slots of a suit straight onto the canvas from the shared
+    card atlas; placing a card only changes the tint of its Color.
+    """
     def __init__(self, suit, selected_cards, **kwargs):
         super(SuitWidget, self).__init__(**kwargs)
         self.suit = suit
         # self.id = str(uuid.uuid4())
-        pos_y = 0
-        for i, card in enumerate(CardIterator(Card(suit, Number.ACE), Card(suit, Number.KING))):
-            card_widget = CardWidget(card=card, is_selected=True, is_clickable=False,
-                                     padding=[0, -100, 0, 0], size_hint=(0.8, 0.1), pos_hint={'x': 0, 'y': pos_y})
-            card_widget.bind(is_selected=self.on_is_selected)
-            self.add_widget(card_widget, index=i + 1)
-            if card in selected_cards:
-                card_widget.is_selected = False
-            pos_y += 0.05
-
-    def on_is_selected(self, instance: CardWidget, pos):
-        if not instance.is_selected:
-            instance.button.background_color = instance.card.suit.get_color()
+        self.cards = list(CardIterator(Card(suit, Number.ACE), Card(suit, Number.KING)))
+        self.colors = {}
+        self.rects = {}
+        self.mask = 0
+        with self.canvas:
+            # kings first so that each card overlaps the one above it
+            for card in reversed(self.cards):
+                self.colors[card] = Color(1, 1, 1, 1)
+                self.rects[card] = Rectangle(texture=CardTextures.get(card.image_name))
+        self.bind(pos=self.layout_cards, size=self.layout_cards)
+        CardTextures.bind(self.on_textures)
+        self.update_cards(cards_to_mask(selected_cards))
+
+    def layout_cards(self, *args):
+        size = (self.width * 0.8, self.height * 0.1 + 100)
+        for i, card in enumerate(self.cards):
+            rect = self.rects[card]
+            rect.pos = (self.x, self.y + self.height * 0.05 * i)
+            rect.size = size
+
+    def on_textures(self):
+        for card in self.cards:
+            self.rects[card].texture = CardTextures.get(card.image_name)
+
+    def update_cards(self, mask):
+        """Mark the cards in `mask` as placed, touching only the cards that changed."""
+        changed = self.mask ^ mask
+        self.mask = mask
+        for card in CardIterator.from_mask(changed):
+            self.colors[card].rgba = card.suit.get_color() if mask & card.mask else [1, 1, 1, 1]
 
     def select_card(self, card):
-        for card_widget in self.children:
-            if card_widget.card == card:
-                card_widget.unselect()
+        if card in self.colors:
+            self.update_cards(self.mask | card.mask)
 
 
 class GamePlayerWidget(FloatLayout):
@@ -110,30 +133,104 @@ class GamePlayerWidget(FloatLayout):
 
     def __init__(self, player: GamePlayer, **kwargs):
         super(GamePlayerWidget, self).__init__(**kwargs)
-        self.player = player
+        self.player = None
+        self.hand_mask = 0
+        self.card_widgets = {}
+        self.pending = {}
+        self.pool = {}
         game = GameHandler.get_game_instance()
-        possible_moves = game.get_possible_moves()
-        print(possible_moves)
-        pos_y = 0
-        for i, card in enumerate(player.get_cards()):
+        self.update_player(player, game.possible_moves_mask)
+
+    def get_card_widget(self, card):
+        card_widget = self.pool.pop(card, None)
+        if card_widget is None:
             card_widget = CardWidget(card=card, is_selected=True, is_clickable=True, padding=[0, -100, 20, 0],
-                                     size_hint=(1, 0.1), pos_hint={'x': 0, 'y': pos_y})
+                                     size_hint=(1, 0.1), pos_hint={'x': 0, 'y': 0})
             card_widget.bind(is_selected=self.on_is_selected)
             card_widget.bind(is_highlighted=self.on_is_highlighted)
-            if card in possible_moves:
-                card_widget.is_selected = False
-            pos_y += 0.06
-            self.add_widget(card_widget, index=i + 1)
+        return card_widget
+
+    def update_player(self, player, possible_moves_mask):
+        """Reconcile the hand widgets with `player`, reusing pooled widgets."""
+        old_mask = self.hand_mask
+        self.player = player
+        self.hand_mask = player.mask
+        for card in CardIterator.from_mask(old_mask & ~player.mask):
+            card_widget = self.card_widgets.pop(card, None)
+            if card_widget is None:
+                continue
+            card_widget.unhighlight()
+            self.remove_widget(card_widget)
+            self.pool[card] = card_widget
+        for i, card in enumerate(player.get_cards()):
+            card_widget = self.card_widgets.get(card)
+            if card_widget is None and card in self.pending:
+                card_widget = self.card_widgets[card] = self.rollback_card(card)
+            elif card_widget is None:
+                card_widget = self.get_card_widget(card)
+                self.card_widgets[card] = card_widget
+                self.add_widget(card_widget, index=min(i, len(self.children)))
+            pos_y = 0.06 * i
+            if card_widget.pos_hint.get('y') != pos_y:
+                card_widget.pos_hint = {'x': 0, 'y': pos_y}
+            is_selected = not possible_moves_mask & card.mask
+            if is_selected and card_widget.is_highlighted:
+                card_widget.unhighlight()
+            card_widget.is_selected = is_selected
+
+    def play_card(self, card, seq):
+        """Animate `card` out of the hand right away; it stays pending until the server answers."""
+        card_widget = self.card_widgets.pop(card, None)
+        if card_widget is None:
+            return
+        card_widget.pending_seq = seq
+        card_widget.unhighlight()
+        self.pending[card] = card_widget
+        from kivy.animation import Animation
+        Animation(opacity=0, pos_hint={'x': 0.5, 'y': card_widget.pos_hint.get('y', 0)},
+                  duration=0.15).start(card_widget)
+
+    def rollback_card(self, card):
+        card_widget = self.pending.pop(card)
+        card_widget.pending_seq = None
+        from kivy.animation import Animation
+        Animation.cancel_all(card_widget)
+        Animation(opacity=1, duration=0.15).start(card_widget)
+        self.on_is_selected(card_widget, None)
+        return card_widget
+
+    def resolve_pending(self, pending_moves):
+        """Drop widgets of moves the server has confirmed."""
+        still_pending = set(pending_moves.values())
+        for card, card_widget in list(self.pending.items()):
+            if card not in still_pending and not self.hand_mask & card.mask:
+                del self.pending[card]
+                card_widget.pending_seq = None
+                from kivy.animation import Animation
+                Animation.cancel_all(card_widget)
+                card_widget.opacity = 1
+                self.remove_widget(card_widget)
+                self.pool[card] = card_widget
+
+    def get_highlighted_card(self):
+        for card_widget in self.card_widgets.values():
+            if card_widget.is_highlighted:
+                return card_widget.card
+        return None
 
     def on_is_selected(self, instance, pos):
         if not instance.is_selected:
             instance.button.background_color = get_color_from_hex("#808080")
+        else:
+            instance.button.background_color = [1, 1, 1, 1]
 
     def on_is_highlighted(self, instance, pos):
+        if instance.card not in self.card_widgets:
+            return
         if instance.is_highlighted:
             instance.button.background_color = instance.card.suit.get_color()
-            for child in self.children:
-                if isinstance(child, CardWidget) and child.uid != instance.uid and not child.is_selected:
+            for child in self.card_widgets.values():
+                if child is not instance and not child.is_selected:
                     child.unhighlight()
             index = 0
         else:
@@ -143,140 +240,372 @@ class GamePlayerWidget(FloatLayout):
         self.remove_widget(instance)
         self.add_widget(instance, index=index)
 
+    def show_hint(self, ranking):
+        """Label the cards of `ranking` ([(card, win rate, rollouts)], best first) with their win rates."""
+        rates = {card: rate for card, rate, rollouts in ranking if card is not None and rollouts}
+        best = ranking[0][0] if rates else None
+        for card, card_widget in self.card_widgets.items():
+            rate = rates.get(card)
+            if rate is None:
+                card_widget.button.text = ""
+            else:
+                card_widget.button.text = "{}{:.0%}".format("best " if card == best else "", rate)
+
+    def clear_hint(self):
+        for card_widget in self.card_widgets.values():
+            card_widget.button.text = ""
+
     def select_card(self):
         card = self.selected_card
-        for child in self.children:
-            if isinstance(child, CardWidget) and child.card == card:
-                self.remove_widget(child)
+        card_widget = self.card_widgets.pop(card, None)
+        if card_widget is not None:
+            self.remove_widget(card_widget)
+            self.pool[card] = card_widget
 
 
 class RootWidget(FloatLayout):
     def __init__(self, **kwargs):
         super(RootWidget, self).__init__(**kwargs)
-        socket_handler = SocketHandler()
-        ws = websocket.WebSocketApp("ws://127.0.0.1:8081/ws/game/patta/{}/".format(GameHandler.get_game_data()["name"]),
-                                    on_message=lambda ws, msg: socket_handler.on_message(ws, msg),
-                                    on_error=lambda ws, msg: socket_handler.on_error(ws, msg),
-                                    on_close=lambda ws: socket_handler.on_close(ws))
-        ws.on_open = lambda ws:socket_handler.on_open(ws)
-        self.ws = ws
-        p1 = multiprocessing.Process(target=ws.run_forever, args=())
-        p1.start()
-        Clock.schedule_interval(self.update_game, 5)
+        self.rendered_version = None
+        self.update_pending = False
+        self.state_header = None
+        self.suit_widgets = []
+        self.player_widget = None
+        self.click_time = None
+        # move spans applied to the rendered state, stamped on the next flip
+        self.render_pending = []
+        self.sampling_frames = False
+        self.overlay = None
+        self.hints = None
+        self.hint_search = None
+        GameHandler.notifier.listen(self.on_state_changed)
+        self.schedule_update()
+        from kivy.core.window import Window
+        # the startup trace is kept whether or not telemetry is on
+        Window.bind(on_flip=self.on_first_flip)
+        if Telemetry.enabled:
+            Window.bind(on_flip=self.on_flip)
+        if (Telemetry.enabled and os.environ.get("PATTA_TELEMETRY_OVERLAY")) or MemoryBudget.show_gauge:
+            from kivy.uix.label import Label
+            self.overlay = Label(size_hint=(0.4, 0.08), pos_hint={'right': 1, 'top': 1}, halign='right')
+            self.add_widget(self.overlay)
+            Clock.schedule_interval(self.update_overlay, 1)
+
+    def sample_frames(self):
+        """Time every frame until no move is in flight, so an idle app has no per frame work."""
+        if self.sampling_frames or not Telemetry.enabled:
+            return
+        self.sampling_frames = True
+        Clock.schedule_interval(self.on_frame, 0)
+
+    def on_frame(self, dt):
+        if not Telemetry.in_flight():
+            self.sampling_frames = False
+            Telemetry.stop_frames()
+            return False
+        Telemetry.frame()
+
+    def on_first_flip(self, window):
+        StartupTrace.mark("first_frame")
+        window.unbind(on_flip=self.on_first_flip)
+
+    def on_flip(self, window):
+        if self.render_pending:
+            ts = telemetry.now()
+            for seq in self.render_pending:
+                Telemetry.end_span(seq, "rendered", ts)
+            self.render_pending = []
+
+    def update_overlay(self, dt):
+        lines = []
+        if Telemetry.enabled:
+            move = Telemetry.histogram(telemetry.MOVE_TOTAL)
+            frame = Telemetry.histogram(telemetry.FRAME)
+            lines.append("move p50 {:.0f} p99 {:.0f} ms  frame p99 {:.1f} ms".format(
+                move.percentile(50) / 1000.0, move.percentile(99) / 1000.0, frame.percentile(99) / 1000.0))
+        if MemoryBudget.show_gauge:
+            MemoryBudget.sample()
+            lines.append(MemoryBudget.gauge())
+        self.overlay.text = "\n".join(lines)
+
+    def on_state_changed(self, version):
+        # called from the notifier thread
+        self.schedule_update()
+
+    def schedule_update(self):
+        if self.update_pending:
+            return
+        self.update_pending = True
+        Clock.schedule_once(self.update_game, -1)
 
     def create_game_widgets(self):
         pos_x = 0.2
         tp = Tab(size_hint=(0.8, 0.75), pos_hint={'x': pos_x, 'y': 0.25})
-        th = TabbedPanelHeader(text='Game State')
-        tp.add_widget(th)
-        layout = FloatLayout()
-        pos_x = 0.1
         game = GameHandler.get_game_instance()
-        print(game.__dict__)
-        for index, suit in enumerate(Suit):
-            card_map = game.card_map[index]
-            selected_cards = []
-            if len(card_map)> 0:
-                min_card = Card.from_str(card_map[0])
-                max_card = Card.from_str(card_map[1])
-                selected_cards = list(CardIterator(min_card, max_card))
-
-            second = SuitWidget(suit, selected_cards, size_hint=(0.2, 1),
-                                pos_hint={'x': pos_x, 'y': 0.15})
-            pos_x += 0.2
-            layout.add_widget(second)
-        th.content = layout
+        if Log.enabled(DEBUG):
+            log.debug("create_game_widgets", board=game.board_mask, hand=game.me.mask,
+                      current_player=game.current_player_index, state=game.state.value)
+        # the suits are built when the tab is first shown, a frame after the buttons
+        self.state_header = LazyTabHeader(self.build_state_layout, self.discard_state_layout, text='Game State')
+        tp.add_widget(self.state_header)
         self.add_widget(tp)
-        self.state_layout = layout
-        game = GameHandler.get_game_instance()
         self.create_player_widget(game.me)
-        background_color = get_color_from_hex("#FFFFFF" if game.is_your_turn() else "#808080")
         disabled_color = get_color_from_hex("#FFFFFF")
         self.pass_button = pass_button = Button(text="PASS", pos_hint={'x': 0.4, 'y': 0.05}, size_hint=(0.25, 0.05),
-                                                disabled=not game.is_your_turn(),
                                                 background_disabled_normal='')
-        pass_button.background_color = background_color
         pass_button.disabled_color = disabled_color
         pass_button.bind(on_press=self.pass_move)
         self.add_widget(pass_button, index=0)
         self.move_button = move_button = Button(text="Make Move", size_hint=(0.25, 0.05),
                                                 pos_hint={'x': 0.4, 'y': 0.15},
-                                                disabled=not game.is_your_turn(),
                                                 background_disabled_normal='')
-        move_button.background_color = background_color
         move_button.disabled_color = disabled_color
         move_button.bind(on_press=self.on_click)
         self.add_widget(move_button, index=0)
-
-    def update_game_widgets(self):
+        self.hint_button = hint_button = Button(text="Hint", size_hint=(0.2, 0.05), pos_hint={'x': 0.7, 'y': 0.05},
+                                                background_disabled_normal='')
+        hint_button.disabled_color = disabled_color
+        hint_button.bind(on_press=self.start_hint)
+        self.add_widget(hint_button, index=0)
+        # start the workers once the first frames are out so the first hint is quick
+        Clock.schedule_once(self.warm_hints, 1)
+        self.board_mask = game.board_mask
+        self.your_turn = None
+        self.update_turn(game)
+
+    def build_state_layout(self):
+        layout = FloatLayout()
+        pos_x = 0.1
         game = GameHandler.get_game_instance()
-        self.create_player_widget(game.me)
-        background_color = get_color_from_hex("#FFFFFF" if game.is_your_turn() else "#808080")
-        self.pass_button.disabled = game.is_your_turn()
-        self.move_button.disabled = game.is_your_turn()
-        self.pass_button.background_color = background_color
-        self.move_button.background_color = background_color
+        self.suit_widgets = []
+        for index, suit in enumerate(Suit):
+            second = SuitWidget(suit, [], size_hint=(0.2, 1),
+                                pos_hint={'x': pos_x, 'y': 0.15})
+            second.update_cards(game.board_mask & SUIT_MASKS[index])
+            pos_x += 0.2
+            layout.add_widget(second)
+            self.suit_widgets.append(second)
+        return layout
+
+    def discard_state_layout(self, layout):
+        self.suit_widgets = []
+
+    def update_game_widgets(self, game):
+        """Apply the difference between the rendered state and `game`."""
+        changed = self.board_mask ^ game.board_mask
+        if changed:
+            for index, suit_widget in enumerate(self.suit_widgets):
+                if changed & SUIT_MASKS[index]:
+                    suit_widget.update_cards(game.board_mask & SUIT_MASKS[index])
+            self.board_mask = game.board_mask
+        player_widget = self.player_widget
+        moves_changed = self.possible_moves_mask != game.possible_moves_mask
+        if moves_changed:
+            # a hint is only good for the position it was searched on
+            self.stop_hint()
+        if player_widget is not None:
+            if moves_changed or player_widget.hand_mask != game.me.mask:
+                player_widget.update_player(game.me, game.possible_moves_mask)
+            player_widget.resolve_pending(game.pending_moves)
+        self.possible_moves_mask = game.possible_moves_mask
+        self.update_turn(game)
+
+    def update_turn(self, game):
+        your_turn = game.is_your_turn()
+        if your_turn == self.your_turn:
+            return
+        self.your_turn = your_turn
+        background_color = get_color_from_hex("#FFFFFF" if your_turn else "#808080")
+        for button in (self.pass_button, self.move_button, self.hint_button):
+            button.disabled = not your_turn
+            button.background_color = background_color
 
     def create_player_widget(self, player):
         pos_x = 0
         tp = Tab(size_hint=(0.2, 0.75), pos_hint={'x': pos_x, 'y': 0.25})
-        th = TabbedPanelHeader(text=player.player["name"])
+        th = LazyTabHeader(self.build_player_widget, self.discard_player_widget, text=player.player["name"])
         tp.add_widget(th)
-        player_widget = GamePlayerWidget(player=player)
-        player_widget.bind(selected_card=self.on_selected)
-        th.content = player_widget
         self.add_widget(tp)
+        self.possible_moves_mask = GameHandler.get_game_instance().possible_moves_mask
+
+    def build_player_widget(self):
+        game = GameHandler.get_game_instance()
+        player_widget = GamePlayerWidget(player=game.me)
+        player_widget.bind(selected_card=self.on_selected)
         self.player_widget = player_widget
+        return player_widget
+
+    def discard_player_widget(self, player_widget):
+        self.player_widget = None
 
     def on_selected(self, instance, card):
         suit = card.suit
         self.make_move(card)
 
     def on_click(self, instance):
+        self.click_time = telemetry.now()
         game_widget = self.player_widget
-        for child in game_widget.children:
-            if getattr(child, "is_highlighted", False):
-                game_widget.selected_card = child.card
+        if game_widget is None:
+            return
+        card = game_widget.get_highlighted_card()
+        if card is not None:
+            game_widget.selected_card = card
+
+    def warm_hints(self, dt=None):
+        if self.hints is None:
+            from hints import HintEngine
+            self.hints = HintEngine()
+            self.hints.warm()
+
+    def start_hint(self, instance):
+        """Rank my moves in the worker pool; the cards are relabelled as the estimate improves."""
+        game = GameHandler.get_game_instance()
+        if not game.is_your_turn():
+            return
+        self.warm_hints()
+        self.hint_search = self.hints.start(game, on_update=self.on_hint_update)
+
+    def on_hint_update(self, search):
+        # called from the pool's result thread
+        Clock.schedule_once(partial(self.show_hint, search), -1)
+
+    def show_hint(self, search, dt):
+        if search is not self.hint_search or search.cancelled or self.player_widget is None:
+            return
+        self.player_widget.show_hint(search.ranking())
+        self.hint_button.text = "Hint {:.0f}/s".format(search.rollouts_per_s())
+
+    def stop_hint(self):
+        if self.hint_search is not None:
+            self.hint_search.cancel()
+            self.hint_search = None
+            if self.player_widget is not None:
+                self.player_widget.clear_hint()
+            self.hint_button.text = "Hint"
 
     def make_move(self, card=None, pass_move=False):
-        ws = self.ws
         game = GameHandler.get_game_instance()
-        if pass_move:
-            card = "pass"
-        else:
-            card = card.str
-        ws.send(json.dumps({
-            'message': card
+        try:
+            seq = game.apply_optimistic_move(card, pass_move)
+        except ValueError as e:
+            log.info("move_rejected", card=card.str if card else "pass", error=str(e))
+            return
+        log.info("move", card=card.str if card else "pass", seq=seq)
+        Telemetry.start_span(seq, "click", self.click_time)
+        self.click_time = None
+        self.sample_frames()
+        if not pass_move and self.player_widget is not None:
+            self.player_widget.play_card(card, seq)
+        self.update_game_widgets(game)
+        WSHandler.send_message(json.dumps({
+            'message': "pass" if pass_move else card.str
         }))
+        Telemetry.mark(seq, "send")
+
+    def show_winner(self, game):
         def my_callback(instance):
-            print('Popup', instance, 'is being dismissed but is prevented!')
-            ws.close()
+            log.info("winner_popup_dismissed")
+            WSHandler.close()
+            Log.dump(reason="exit")
+            if Telemetry.enabled and Telemetry.histograms:
+                Telemetry.export()
             exit(1)
-        if game.is_ended:
-            popup = Popup(content=Label(text='Player {} wins'.format(game.current_player_index)))
-            popup.bind(on_dismiss=my_callback)
-            popup.open()
+        from kivy.uix.label import Label
+        from kivy.uix.popup import Popup
+        popup = Popup(content=Label(text='Player {} wins'.format(game.current_player_index)))
+        popup.bind(on_dismiss=my_callback)
+        popup.open()
 
     def pass_move(self, instance):
+        self.click_time = telemetry.now()
         self.make_move(pass_move=True)
 
     def delete_all_widgets(self):
-        for widget in self.children:
-            self.remove_widget(widget)
+        if self.hints is not None:
+            self.hints.cancel()
+        self.clear_widgets()
+        self.state_header = None
+        self.suit_widgets = []
+        self.player_widget = None
 
     def update_game(self, dt):
-        print(GameHandler.get_game_data())
+        self.update_pending = False
+        version = GameHandler.get_version()
+        if version == self.rendered_version:
+            return
+        log.debug("render", version=version)
         game = GameHandler.get_game_instance()
         if not game:
             return
-        self.delete_all_widgets()
-        if not game.is_ended:
+        self.rendered_version = version
+        if game.is_ended:
+            self.delete_all_widgets()
+            self.show_winner(game)
+        elif self.state_header is None:
             self.create_game_widgets()
+        else:
+            self.update_game_widgets(game)
+        self.render_pending.extend(seq for seq, span in Telemetry.spans.items() if "applied" in span)
+
+
+class LazyTabHeader(TabbedPanelHeader):
+    """
+    A tab whose content is made by `builder()` when the tab is first shown
+    and can be dropped again with `unload`, after which it is rebuilt the
+    next time it is shown. `discard(content)` is called on unload so the
+    owner can let go of its references into the content.
+    """
+    def __init__(self, builder, discard=None, **kwargs):
+        super(LazyTabHeader, self).__init__(**kwargs)
+        self.builder = builder
+        self.discard = discard
+
+    def build(self):
+        if self.content is None:
+            self.content = self.builder()
+            log.debug("tab_built", tab=self.text)
+        return self.content
+
+    def unload(self):
+        content = self.content
+        if content is None:
+            return False
+        if content.parent is not None:
+            content.parent.remove_widget(content)
+        self.content = None
+        if self.discard is not None:
+            self.discard(content)
+        log.debug("tab_unloaded", tab=self.text)
+        return True
 
 
 class Tab(TabbedPanel):
     def __init__(self, **kwargs):
+        # no default tab: the first lazy tab is shown, and so built, a tick after creation
+        kwargs.setdefault("do_default_tab", False)
         super(Tab, self).__init__(**kwargs)
+        MemoryBudget.register(self)
+
+    def switch_to(self, header, do_scroll=False):
+        if isinstance(header, LazyTabHeader):
+            header.build()
+        super(Tab, self).switch_to(header, do_scroll)
+
+    def lazy_tabs(self):
+        return [header for header in self.tab_list if isinstance(header, LazyTabHeader)]
+
+    def unload_hidden(self):
+        """Drop the content of every lazy tab but the one shown; the number dropped."""
+        return sum(header.unload() for header in self.lazy_tabs() if header is not self.current_tab)
+
+    def unload_all(self):
+        return sum(header.unload() for header in self.lazy_tabs())
+
+    def reload(self):
+        """Rebuild the shown tab if it was unloaded."""
+        header = self.current_tab
+        if isinstance(header, LazyTabHeader) and header.content is None and header in self.tab_list:
+            self.switch_to(header)
 
 
 class PattebaazApp(App):
@@ -284,5 +613,22 @@ class PattebaazApp(App):
         super(PattebaazApp, self).__init__(**kwargs)
 
     def build(self):
+        CardTextures.load_async()
         widget = RootWidget(size=(400, 400))
+        Clock.schedule_interval(MemoryBudget.check, memory.CHECK_INTERVAL)
+        StartupTrace.mark("app_built")
         return widget
+
+    def on_pause(self):
+        # a backgrounded app is killed by its size, so give back what can be rebuilt
+        MemoryBudget.release()
+        return True
+
+    def on_resume(self):
+        MemoryBudget.restore()
+
+    def on_stop(self):
+        if self.root is not None and self.root.hints is not None:
+            self.root.hints.shutdown()
+        if Telemetry.enabled and Telemetry.histograms:
+            log.info("telemetry_exported", path=Telemetry.export())
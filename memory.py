@@ -0,0 +1,111 @@
+"""
+Memory gauge and budget for low end phones.
+
+The Android build runs on 1-2 GB phones, where the OS kills the largest
+background processes first. `MemoryBudget.check` samples the resident set
+size and the card texture memory every few seconds; while the process is
+over budget the tab panels drop the content of their hidden lazy tabs,
+which is built again when the tab is next shown. When the app goes to the
+background every lazy tab and the card textures are dropped, and they are
+brought back on resume once the atlas is decoded again.
+
+PATTA_MEMORY_BUDGET_MB sets the budget (0 turns all of this off; the
+default is off except on Android), PATTA_MEMORY_GAUGE shows the gauge in
+the corner of the window.
+"""
+import gc
+import os
+import weakref
+
+from kivy.utils import platform
+
+import log
+from card_atlas import CardTextures
+
+MB = 1 << 20
+BUDGET_MB = int(os.environ.get("PATTA_MEMORY_BUDGET_MB", 192 if platform == "android" else 0))
+CHECK_INTERVAL = 5
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes():
+    """Resident set size of this process, or None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryBudget(object):
+    budget = BUDGET_MB * MB
+    show_gauge = bool(os.environ.get("PATTA_MEMORY_GAUGE"))
+    panels = weakref.WeakSet()
+    rss = None
+    textures = 0
+    over = False
+    released = False
+
+    @classmethod
+    def register(cls, panel):
+        """`panel` is a main.Tab; its lazy tabs are unloaded when memory runs short."""
+        cls.panels.add(panel)
+
+    @classmethod
+    def sample(cls):
+        cls.rss = rss_bytes()
+        cls.textures = CardTextures.texture_bytes()
+        return cls.rss, cls.textures
+
+    @classmethod
+    def check(cls, dt=None):
+        cls.sample()
+        over = bool(cls.budget) and cls.rss is not None and cls.rss > cls.budget
+        if over != cls.over:
+            cls.over = over
+            log.info("memory_budget", over=over, rss_mb=cls.rss // MB, textures_mb=cls.textures // MB,
+                     budget_mb=cls.budget // MB)
+        if over:
+            unloaded = cls.trim()
+            if unloaded:
+                log.info("tabs_unloaded", count=unloaded, rss_mb=cls.rss // MB)
+
+    @classmethod
+    def trim(cls):
+        """Drop the content of every hidden lazy tab; the number dropped."""
+        unloaded = sum(panel.unload_hidden() for panel in list(cls.panels))
+        if unloaded:
+            gc.collect()
+        return unloaded
+
+    @classmethod
+    def release(cls):
+        """The app went to the background: drop all lazy content and the card textures."""
+        if not cls.budget:
+            return
+        unloaded = sum(panel.unload_all() for panel in list(cls.panels))
+        CardTextures.release()
+        gc.collect()
+        cls.released = True
+        cls.sample()
+        log.info("memory_released", tabs=unloaded, rss_mb=-1 if cls.rss is None else cls.rss // MB)
+
+    @classmethod
+    def restore(cls):
+        if not cls.released:
+            return
+        cls.released = False
+        CardTextures.load_async()
+        # rebuild once the atlas is back, so the cards don't load the full size pngs
+        CardTextures.bind(cls.reload)
+
+    @classmethod
+    def reload(cls):
+        for panel in list(cls.panels):
+            panel.reload()
+
+    @classmethod
+    def gauge(cls):
+        rss = "?" if cls.rss is None else "{:.0f}".format(cls.rss / MB)
+        budget = " / {:.0f}".format(cls.budget / MB) if cls.budget else ""
+        return "rss {}{} MB  textures {:.1f} MB".format(rss, budget, cls.textures / MB)
@@ -0,0 +1,241 @@
+"""
+Many game sessions in one process, on one asyncio loop.
+
+Each TableSession is one player name (one seat, one game) with its own
+decoder, delta state and Game; it is not tied to the GameHandler and
+SocketHandler singletons, so hundreds can live side by side. Every session
+has its own websocket on the shared loop, since the server seats one player
+per connection. A session plays with a policy, or by hand from the UI;
+the server has no spectator seats, so a session without either stalls its
+table.
+
+    python multitable.py --tables 200 --prefix qa --policy random --games 3
+    python multitable.py --tables 8 --ui
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import log
+from app import GameState, Game
+from socket_client import SERVER_URL, GameConnection, SessionHandler
+
+
+def first_move(game, rng):
+    return game.possible_moves[0]
+
+
+def random_move(game, rng):
+    return rng.choice(game.possible_moves)
+
+
+def endgame_move(game, rng):
+    """Random until the hidden hands are small enough to solve, then the move that wins most sampled deals."""
+    from hints import solved_move
+    return solved_move(game, rng) or random_move(game, rng)
+
+
+POLICIES = {
+    "first": first_move,
+    "random": random_move,
+    "endgame": endgame_move,
+}
+
+
+class TableSession(SessionHandler):
+    """
+    One seat. `state` is the Game as this session sees it, rebuilt from each
+    published snapshot with pending optimistic moves reconciled on top.
+    Deltas are applied to `server`, the server's own state without those
+    moves, when they were negotiated. Listeners are called with the session
+    after every change.
+    """
+    def __init__(self, name, url, policy=None, games=1, seed=None, compression="deflate"):
+        super(TableSession, self).__init__()
+        self.name = name
+        self.url = url
+        self.policy = policy
+        self.games = games
+        self.compression = compression
+        self.random = random.Random(seed)
+        self.state = None
+        self.server = None
+        self.message_type = None
+        self.version = 0
+        self.messages = 0
+        self.games_played = 0
+        self.connection = None
+        self.listeners = []
+
+    def bind(self, callback):
+        self.listeners.append(callback)
+
+    def unbind(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def notify(self):
+        self.version += 1
+        for callback in self.listeners:
+            callback(self)
+
+    def publish(self, ws, message_type, game_json, received_ns):
+        if self.delta:
+            self.server = Game.from_json(dict(game_json, players=[dict(player) for player in game_json["players"]]))
+        self.show(ws, message_type, game_json)
+
+    def publish_delta(self, ws, delta, received_ns):
+        if self.server is None:
+            raise ValueError("delta {} before any snapshot".format(delta["seq"]))
+        self.server.apply_delta(delta)
+        self.show(ws, "game_update", self.server.to_json())
+
+    def show(self, ws, message_type, game_json):
+        if self.state is None:
+            self.state = Game.from_json(game_json)
+        else:
+            self.state.update(game_json, message_type)
+            if self.state.pending_moves:
+                self.state.reconcile(message_type)
+        self.message_type = message_type
+        self.messages += 1
+        self.notify()
+        if self.state.state == GameState.ENDED:
+            self.games_played += 1
+            ws.close()
+        elif self.policy is not None and self.state.state == GameState.STARTED and self.state.is_your_turn() \
+                and not self.state.pending_moves:
+            move = self.policy(self.state, self.random) if self.state.possible_moves else None
+            self.make_move(move)
+
+    def make_move(self, card=None):
+        """Play `card` (or pass) optimistically and send it; False if it is not a legal move now."""
+        try:
+            self.state.apply_optimistic_move(card, card is None)
+        except ValueError as e:
+            # e.g. a second tap on a move button before the view caught up
+            log.info("move_rejected", table=self.name, card=card.str if card else "pass", error=str(e))
+            return False
+        # the views drop the move buttons now that it is no longer my turn
+        self.notify()
+        self.connection.send(json.dumps({"message": "pass" if card is None else card.str}))
+        return True
+
+    async def run(self):
+        """Play `games` games, reconnecting for each; a finished game closes its connection."""
+        while self.games_played < self.games:
+            self.state = self.server = None
+            self.connection = GameConnection(self.url, self, compression=self.compression, local=True)
+            await self.connection.run()
+
+    def close(self):
+        self.games = self.games_played
+        if self.connection is not None:
+            self.connection.close()
+
+
+class MultiTableClient(object):
+    """Sessions keyed by player name, all running on the calling event loop."""
+    def __init__(self, url=SERVER_URL, compression="deflate"):
+        self.url = url
+        self.compression = compression
+        self.sessions = {}
+        self.tasks = {}
+
+    def add_table(self, name, policy=None, games=1, seed=None):
+        session = TableSession(name, self.url.format(name), policy, games, seed, self.compression)
+        self.sessions[name] = session
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            self.start(name)
+        return session
+
+    def start(self, name):
+        if name not in self.tasks:
+            self.tasks[name] = asyncio.ensure_future(self.sessions[name].run())
+
+    def remove_table(self, name):
+        session = self.sessions.pop(name)
+        session.close()
+        task = self.tasks.pop(name, None)
+        if task is not None:
+            # a session that cannot reach the server would otherwise keep reconnecting
+            task.cancel()
+
+    async def run(self):
+        for name in self.sessions:
+            self.start(name)
+        while self.tasks:
+            done, _ = await asyncio.wait(list(self.tasks.values()), return_when=asyncio.FIRST_COMPLETED)
+            for name, task in list(self.tasks.items()):
+                if task in done:
+                    del self.tasks[name]
+                    if task.exception() is not None:
+                        log.error("table_failed", table=name, error=repr(task.exception()))
+
+    def stats(self):
+        sessions = self.sessions.values()
+        return {
+            "tables": len(self.sessions),
+            "running": len(self.tasks),
+            "messages": sum(session.messages for session in sessions),
+            "games_played": sum(session.games_played for session in sessions),
+        }
+
+
+async def report_every(client, interval):
+    last = client.stats()
+    last_time = time.perf_counter()
+    while client.tasks:
+        await asyncio.sleep(interval)
+        stats = client.stats()
+        now = time.perf_counter()
+        print("tables {tables}  running {running}  games played {games_played}  messages {messages}".format(**stats),
+              " {:.0f} msg/s".format((stats["messages"] - last["messages"]) / (now - last_time)))
+        last, last_time = stats, now
+
+
+async def run_headless(client, interval):
+    reporter = asyncio.ensure_future(report_every(client, interval))
+    await client.run()
+    reporter.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch and play many tables from one process")
+    parser.add_argument("--tables", type=int, default=4, help="number of sessions (seats)")
+    parser.add_argument("--prefix", default="table", help="session names are <prefix><n>")
+    parser.add_argument("--policy", choices=sorted(POLICIES), default=None,
+                        help="play with this policy (default: first, or by hand with --ui)")
+    parser.add_argument("--games", type=int, default=1, help="games per session")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--url", default=SERVER_URL, help="server url with {} for the session name")
+    parser.add_argument("--no-deflate", action="store_true", help="disable permessage-deflate")
+    parser.add_argument("--interval", type=float, default=2, help="seconds between progress lines")
+    parser.add_argument("--ui", action="store_true", help="show every table in a tab")
+    args = parser.parse_args()
+
+    client = MultiTableClient(args.url, None if args.no_deflate else "deflate")
+    policy = POLICIES.get(args.policy or ("first" if not args.ui else None))
+    for index in range(args.tables):
+        client.add_table("{}{}".format(args.prefix, index), policy, args.games,
+                         None if args.seed is None else args.seed + index)
+    start = time.perf_counter()
+    if args.ui:
+        from multitable_ui import run_ui
+        asyncio.run(run_ui(client))
+    else:
+        asyncio.run(run_headless(client, args.interval))
+    stats = client.stats()
+    wall = time.perf_counter() - start
+    print("done: {} tables, {} games, {} messages in {:.2f}s".format(
+        stats["tables"], stats["games_played"], stats["messages"], wall))
+
+
+if __name__ == "__main__":
+    main()
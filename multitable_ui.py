@@ -0,0 +1,122 @@
+"""
+Tabbed view over a MultiTableClient: one tab per session showing its board,
+whose turn it is and, when the session has no policy, buttons to play its
+legal cards by hand. Kivy runs on the same asyncio loop as the sessions.
+A table's view is only built when its tab is first shown, and hidden views
+are dropped when the process goes over its memory budget.
+"""
+from functools import partial
+
+from kivy.app import App
+from kivy.clock import Clock
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.button import Button
+from kivy.uix.floatlayout import FloatLayout
+from kivy.uix.label import Label
+
+import memory
+from app import GameState, SUIT_MASKS, Suit
+from card_atlas import CardTextures
+from main import LazyTabHeader, SuitWidget, Tab
+from memory import MemoryBudget
+
+
+class TableView(FloatLayout):
+    def __init__(self, session, **kwargs):
+        super(TableView, self).__init__(**kwargs)
+        self.session = session
+        self.rendered_version = None
+        self.update_pending = False
+        self.board_mask = 0
+        self.moves_mask = None
+        self.suit_widgets = []
+        pos_x = 0.1
+        for suit in Suit:
+            suit_widget = SuitWidget(suit, [], size_hint=(0.2, 0.75), pos_hint={'x': pos_x, 'y': 0.2})
+            self.add_widget(suit_widget)
+            self.suit_widgets.append(suit_widget)
+            pos_x += 0.2
+        self.status = Label(size_hint=(1, 0.05), pos_hint={'x': 0, 'y': 0.95})
+        self.add_widget(self.status)
+        self.moves = BoxLayout(size_hint=(1, 0.08), pos_hint={'x': 0, 'y': 0.02})
+        self.add_widget(self.moves)
+        session.bind(self.on_session_changed)
+        self.update_view()
+
+    def close(self):
+        self.session.unbind(self.on_session_changed)
+
+    def on_session_changed(self, session):
+        # coalesce a burst of messages into one update per frame
+        if not self.update_pending:
+            self.update_pending = True
+            Clock.schedule_once(self.update_view, -1)
+
+    def update_view(self, *args):
+        self.update_pending = False
+        session = self.session
+        game = session.state
+        if game is None or session.version == self.rendered_version:
+            return
+        self.rendered_version = session.version
+        changed = self.board_mask ^ game.board_mask
+        for index, suit_widget in enumerate(self.suit_widgets):
+            if changed & SUIT_MASKS[index]:
+                suit_widget.update_cards(game.board_mask & SUIT_MASKS[index])
+        self.board_mask = game.board_mask
+        if game.state == GameState.ENDED:
+            status = "game {} won by {}".format(session.games_played, game.winner.player.get("name"))
+        else:
+            status = "{}  |  {} to play  |  {} cards in hand".format(
+                game.state.value, game.current_player.player.get("name"), len(game.me.cards))
+        self.status.text = "{}: {}".format(session.name, status)
+        self.update_moves(game)
+
+    def update_moves(self, game):
+        moves_mask = game.possible_moves_mask if game.is_your_turn() and game.state == GameState.STARTED else -1
+        if self.session.policy is not None or moves_mask == self.moves_mask:
+            return
+        self.moves_mask = moves_mask
+        self.moves.clear_widgets()
+        if moves_mask == -1:
+            return
+        for card in game.possible_moves:
+            button = Button(text=card.str)
+            button.bind(on_press=lambda instance, card=card: self.session.make_move(card))
+            self.moves.add_widget(button)
+        if not game.possible_moves:
+            button = Button(text="PASS")
+            button.bind(on_press=lambda instance: self.session.make_move(None))
+            self.moves.add_widget(button)
+
+
+class MultiTableApp(App):
+    def __init__(self, client, **kwargs):
+        super(MultiTableApp, self).__init__(**kwargs)
+        self.client = client
+
+    def build(self):
+        CardTextures.load_async()
+        panel = Tab(do_default_tab=False, tab_width=120)
+        for name, session in self.client.sessions.items():
+            panel.add_widget(LazyTabHeader(partial(TableView, session), TableView.close, text=name))
+        Clock.schedule_interval(MemoryBudget.check, memory.CHECK_INTERVAL)
+        return panel
+
+    def on_pause(self):
+        MemoryBudget.release()
+        return True
+
+    def on_resume(self):
+        MemoryBudget.restore()
+
+
+async def run_ui(client):
+    import asyncio
+
+    app = MultiTableApp(client)
+    sessions = asyncio.ensure_future(client.run())
+    await app.async_run(async_lib="asyncio")
+    for name in list(client.sessions):
+        client.remove_table(name)
+    await sessions
@@ -0,0 +1,246 @@
+"""
+Record and replay of the socket message stream.
+
+A recording is an append-only file: an 8 byte magic followed by records of
+(monotonic ns, kind, length) and the raw payload. `open` records carry the
+negotiated subprotocol so replay decodes with the same codec; `in` and
+`out` records carry websocket messages as they were on the wire. Readers
+memory map the file, so a long session streams without being loaded.
+
+    PATTA_RECORD=session.rec python socket_client.py <name>
+    python recording.py session.rec                  # headless, as fast as possible
+    python recording.py session.rec --speed 1 --ui   # through the widgets, at recorded speed
+"""
+import argparse
+import mmap
+import os
+import struct
+import time
+from functools import partial
+
+MAGIC = b"PATTARC1"
+_RECORD = struct.Struct("<QBI")
+
+OPEN = 0
+IN = 1
+OUT = 2
+# set on the kind of records whose payload was bytes rather than text
+BINARY = 0x80
+
+
+class MessageRecorder(object):
+    """
+    Appends records to `path`. The file is opened on the first record, so a
+    recorder created before the socket process is forked is only ever
+    written by that process. Every record is flushed so a crash keeps all
+    but the message being handled.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def write(self, kind, payload, ts=None):
+        if self.fd is None:
+            self.fd = open(self.path, "ab")
+            if self.fd.tell() == 0:
+                self.fd.write(MAGIC)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        else:
+            kind |= BINARY
+        self.fd.write(_RECORD.pack(time.monotonic_ns() if ts is None else ts, kind, len(payload)))
+        self.fd.write(payload)
+        self.fd.flush()
+
+    def on_open(self, subprotocol):
+        self.write(OPEN, subprotocol or "")
+
+    def on_message(self, message):
+        self.write(IN, message)
+
+    def on_send(self, message):
+        self.write(OUT, message)
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+
+class MessageLog(object):
+    """Iterates (ts_ns, kind, payload) over a recording through a read only memory map."""
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, "rb") as fd:
+            if os.fstat(fd.fileno()).st_size <= len(MAGIC):
+                return
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:len(MAGIC)] != MAGIC:
+                    raise ValueError("{} is not a message recording".format(self.path))
+                offset = len(MAGIC)
+                end = len(data)
+                while offset + _RECORD.size <= end:
+                    ts, kind, length = _RECORD.unpack_from(data, offset)
+                    offset += _RECORD.size
+                    if offset + length > end:
+                        # the record being written when the process died
+                        return
+                    payload = data[offset:offset + length]
+                    offset += length
+                    if kind & BINARY:
+                        yield ts, kind & ~BINARY, payload
+                    else:
+                        yield ts, kind, payload.decode("utf-8")
+
+
+class ReplayConnection(object):
+    """Stands in for GameConnection: outgoing messages are counted, not sent."""
+    def __init__(self, subprotocol):
+        self.subprotocol = subprotocol or None
+        self.sent = 0
+
+    def send(self, message):
+        self.sent += 1
+
+    def close(self):
+        pass
+
+
+class Replay(object):
+    """
+    Feeds a recording's inbound messages through SocketHandler.on_message
+    and GameHandler, either as fast as possible (`speed=None`) or paced to
+    the recorded timestamps divided by `speed`. `on_applied` is called with
+    the Game after every message.
+    """
+    def __init__(self, path, speed=None, on_applied=None):
+        from telemetry import Histogram
+
+        self.records = iter(MessageLog(path))
+        self.speed = speed
+        self.on_applied = on_applied
+        self.connection = None
+        self.first_ts = None
+        self.started = None
+        self.messages = 0
+        self.latency = Histogram()
+
+    def delay(self, ts):
+        """Seconds to wait before the record stamped `ts` is due."""
+        if self.speed is None:
+            return 0
+        if self.first_ts is None:
+            self.first_ts, self.started = ts, time.monotonic()
+            return 0
+        due = self.started + (ts - self.first_ts) / 1e9 / self.speed
+        return max(0, due - time.monotonic())
+
+    def next_record(self):
+        return next(self.records, None)
+
+    def apply(self, record):
+        from handler import GameHandler
+        from socket_client import SocketHandler
+
+        ts, kind, payload = record
+        handler = SocketHandler.get_instance()
+        if kind == OPEN:
+            self.connection = ReplayConnection(payload)
+            handler.on_open(self.connection)
+        elif kind == IN:
+            start = time.perf_counter_ns()
+            handler.on_message(self.connection, payload)
+            game = GameHandler.get_game_instance()
+            self.latency.record((time.perf_counter_ns() - start) // 1000)
+            self.messages += 1
+            if self.on_applied is not None and game:
+                self.on_applied(game)
+
+    def run(self):
+        """Replay everything on the calling thread."""
+        wall = time.perf_counter()
+        for record in self.records:
+            wait = self.delay(record[0])
+            if wait:
+                time.sleep(wait)
+            self.apply(record)
+        return time.perf_counter() - wall
+
+
+def setup():
+    from handler import GameHandler
+    from shared_state import SharedGameState
+
+    GameHandler.set_game_data(SharedGameState.create())
+    GameHandler.invalidate()
+
+
+def replay_headless(path, speed):
+    setup()
+    replay = Replay(path, speed)
+    try:
+        wall = replay.run()
+    finally:
+        from handler import GameHandler
+        GameHandler.get_game_data().close()
+    latency = replay.latency
+    print("messages: {}  wall: {:.3f}s  throughput: {:.0f} msg/s".format(
+        replay.messages, wall, replay.messages / wall if wall else 0))
+    print("handling latency ms  p50 {:.3f}  p90 {:.3f}  p99 {:.3f}  max {:.3f}".format(
+        *[latency.percentile(pct) / 1000.0 for pct in (50, 90, 99, 100)]))
+
+
+def replay_ui(path, speed):
+    """Drive the real widget tree from the recording, one message per Clock callback."""
+    from kivy.clock import Clock
+
+    from handler import GameHandler, StateNotifier
+    from main import PattebaazApp
+
+    setup()
+    GameHandler.set_notifier(StateNotifier())
+    replay = Replay(path, speed)
+
+    def feed(dt):
+        # without a speed this is one message per frame, as fast as the widgets keep up
+        record = replay.next_record()
+        if record is None:
+            print("replayed {} messages".format(replay.messages))
+            return
+        Clock.schedule_once(partial(deliver, record), replay.delay(record[0]))
+
+    def deliver(record, dt):
+        replay.apply(record)
+        feed(0)
+
+    # the first state has to be there before the widgets are built
+    while GameHandler.get_game_data().read() is None:
+        record = replay.next_record()
+        if record is None:
+            break
+        replay.delay(record[0])
+        replay.apply(record)
+    Clock.schedule_once(feed, 0)
+    try:
+        PattebaazApp().run()
+    finally:
+        GameHandler.get_game_data().close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded socket message stream")
+    parser.add_argument("path")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="replay at this multiple of the recorded speed; as fast as possible if omitted")
+    parser.add_argument("--ui", action="store_true", help="drive the Kivy widget tree too")
+    args = parser.parse_args()
+    if args.ui:
+        replay_ui(args.path, args.speed)
+    else:
+        replay_headless(args.path, args.speed)
+
+
+if __name__ == "__main__":
+    main()
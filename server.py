@@ -0,0 +1,253 @@
+"""
+Local stand-in for the Patta game server, speaking the same protocol as
+ws://<host>/ws/game/patta/<name>/: every state change is pushed to each
+player as {"type", "game", "me", "possible_moves"} and players answer with
+{"message": "<card>"} or {"message": "pass"}.
+
+Players are seated in arrival order, `players` to a table. Clients that
+offer one of the codec subprotocols get that encoding, others plain JSON;
+`+delta` clients get `game_delta` patches instead of full game updates.
+
+    python server.py --port 8081 --players 4
+"""
+import argparse
+import asyncio
+import json
+import random
+
+import websockets
+
+from app import Card, Deck, GameState, Number, Suit, SUIT_MASKS, NUM_CARDS_PER_SUIT
+from codec import JSON, SUBPROTOCOLS, encode_delta, encode_message, parse_subprotocol
+
+PATH_PREFIX = "/ws/game/patta/"
+FIRST_CARD = Card(Suit.HEART, Number.SEVEN)
+
+
+class Seat(object):
+    def __init__(self, name, ws, index):
+        self.name = name
+        self.ws = ws
+        self.index = index
+        self.hand = 0
+        self.encoding = JSON
+        self.delta = False
+        # hand as of the last broadcast, to diff the next delta against
+        self.sent_hand = 0
+
+    def to_json(self):
+        return {"index": self.index, "name": self.name, "card_count": self.hand.bit_count()}
+
+
+class Table(object):
+    def __init__(self, name, size, seed=None):
+        self.name = name
+        self.size = size
+        self.seats = []
+        self.random = random.Random(seed)
+        self.state = GameState.NOT_STARTED
+        # [low, high] card index per suit, None until the suit's seven is played
+        self.ranges = [None] * len(SUIT_MASKS)
+        self.current = 0
+        self.board = 0
+        self.board_count = 0
+        # bumped by every broadcast; snapshots carry it so deltas can be checked for gaps
+        self.seq = 0
+        self.sent_board = 0
+        self.sent_counts = []
+
+    @property
+    def is_full(self):
+        return len(self.seats) == self.size
+
+    def join(self, name, ws):
+        seat = Seat(name, ws, len(self.seats))
+        self.seats.append(seat)
+        return seat
+
+    def deal(self):
+        deck = Deck()
+        self.random.shuffle(deck.cards)
+        for i, card in enumerate(deck.cards):
+            self.seats[i % self.size].hand |= card.mask
+        self.state = GameState.STARTED
+        self.current = next(seat.index for seat in self.seats if seat.hand & FIRST_CARD.mask)
+
+    def legal_mask(self, seat):
+        if self.state != GameState.STARTED or seat.index != self.current:
+            return 0
+        if self.board_count == 0:
+            return seat.hand & FIRST_CARD.mask
+        mask = 0
+        for suit, suit_range in enumerate(self.ranges):
+            if suit_range is None:
+                mask |= 1 << (suit * NUM_CARDS_PER_SUIT + Number.SEVEN - 1)
+                continue
+            low, high = suit_range
+            if low % NUM_CARDS_PER_SUIT:
+                mask |= 1 << (low - 1)
+            if (high + 1) % NUM_CARDS_PER_SUIT:
+                mask |= 1 << (high + 1)
+        return mask & seat.hand
+
+    def play(self, seat, message):
+        """Apply a move; returns False if it is not legal."""
+        legal = self.legal_mask(seat)
+        if self.state != GameState.STARTED or seat.index != self.current:
+            return False
+        if message == "pass":
+            if legal:
+                return False
+        else:
+            try:
+                card = Card.from_str(message)
+            except (IndexError, ValueError, KeyError):
+                return False
+            if not legal & card.mask:
+                return False
+            seat.hand ^= card.mask
+            suit = card.suit.val
+            if self.ranges[suit] is None:
+                self.ranges[suit] = [card.index, card.index]
+            else:
+                low, high = self.ranges[suit]
+                self.ranges[suit] = [min(low, card.index), max(high, card.index)]
+            self.board |= card.mask
+            self.board_count += 1
+            if not seat.hand:
+                self.state = GameState.ENDED
+                return True
+        self.current = (self.current + 1) % self.size
+        return True
+
+    def game_json(self):
+        """Game fields other than the board, which each encoding writes in its own form."""
+        return {
+            "players": [seat.to_json() for seat in self.seats],
+            "current_player_id": self.current,
+            "state": self.state.value,
+            "card_count": self.board_count,
+        }
+
+    def message_for(self, seat, message_type, game_json=None):
+        return encode_message(message_type, game_json or self.game_json(), {"index": seat.index, "name": seat.name},
+                              seat.hand, self.board, self.legal_mask(seat), seat.encoding, self.seq)
+
+    def delta_for(self, seat, added, counts):
+        return encode_delta(self.seq, self.board, added, seat.sent_hand & ~seat.hand, self.current,
+                            self.state.value, self.board_count, counts, seat.encoding)
+
+    async def broadcast(self, message_type):
+        """Game updates go out as deltas to seats that negotiated them, everything else as snapshots."""
+        self.seq += 1
+        game_json = self.game_json()
+        counts = [seat.hand.bit_count() for seat in self.seats]
+        changed = {index: count for index, count in enumerate(counts)
+                   if index >= len(self.sent_counts) or self.sent_counts[index] != count}
+        added = self.board & ~self.sent_board
+        for seat in self.seats:
+            if seat.delta and message_type == "game_update":
+                message = self.delta_for(seat, added, changed)
+            else:
+                message = self.message_for(seat, message_type, game_json)
+            seat.sent_hand = seat.hand
+            await send_quietly(seat.ws, message)
+        self.sent_board = self.board
+        self.sent_counts = counts
+
+
+def select_subprotocol(connection, subprotocols):
+    """Use the client's preferred codec subprotocol; clients offering none get plain JSON."""
+    for subprotocol in subprotocols:
+        if subprotocol in SUBPROTOCOLS:
+            return subprotocol
+    return None
+
+
+async def send_quietly(ws, message):
+    try:
+        await ws.send(message)
+    except websockets.ConnectionClosed:
+        pass
+
+
+class PattaServer(object):
+    def __init__(self, players=4, seed=None):
+        self.players = players
+        self.seed = seed
+        self.tables = {}
+        self.seated = {}
+        self.open_table = None
+        self.games_started = 0
+        self.games_ended = 0
+
+    def seat_player(self, name, ws):
+        if name in self.seated:
+            # a reconnecting player gets their old seat back
+            table, seat = self.seated[name]
+            if table.state != GameState.ENDED:
+                seat.ws = ws
+                return table, seat
+        table = self.open_table
+        if table is None or table.is_full:
+            seed = None if self.seed is None else self.seed + len(self.tables)
+            table = Table("table-{}".format(len(self.tables)), self.players, seed)
+            self.tables[table.name] = table
+            self.open_table = table
+        seat = table.join(name, ws)
+        self.seated[name] = (table, seat)
+        return table, seat
+
+    async def handler(self, ws, path=None):
+        path = path or ws.request.path
+        if not path.startswith(PATH_PREFIX):
+            await ws.close(code=1008, reason="unknown path")
+            return
+        name = path[len(PATH_PREFIX):].strip("/")
+        table, seat = self.seat_player(name, ws)
+        seat.encoding, seat.delta = parse_subprotocol(ws.subprotocol)
+        if table.state == GameState.STARTED:
+            await send_quietly(ws, table.message_for(seat, "game_update"))
+        elif table.is_full:
+            table.deal()
+            self.games_started += 1
+            await table.broadcast("game_start")
+        else:
+            await table.broadcast("player_joined")
+        async for raw in ws:
+            message = json.loads(raw)
+            if message.get("type") == "sync":
+                await send_quietly(ws, table.message_for(seat, "game_update"))
+                continue
+            if not table.play(seat, message.get("message")):
+                await send_quietly(ws, table.message_for(seat, "invalid_move"))
+                continue
+            if table.state == GameState.ENDED:
+                self.games_ended += 1
+                await table.broadcast("game_end")
+            else:
+                await table.broadcast("game_update")
+
+    async def serve(self, host="127.0.0.1", port=8081, ready=None):
+        async with websockets.serve(self.handler, host, port, select_subprotocol=select_subprotocol):
+            if ready is not None:
+                ready.set()
+            await asyncio.Future()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    server = PattaServer(players=args.players, seed=args.seed)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
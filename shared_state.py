@@ -0,0 +1,238 @@
+"""
+Game state shared between the socket process (the only writer) and the UI
+process, in a fixed layout `multiprocessing.shared_memory` block instead of
+a Manager dict. Readers unpack straight from the mapped memory, so a read is
+a few struct unpacks with no IPC and no syscalls.
+
+Writes are guarded by a seqlock: the version is made odd before the fields
+are written and even again afterwards. A reader that sees an odd version, or
+a different version after reading, raced a write and simply reads again. A
+version that stays odd for STALL_TIMEOUT means the writer died mid write;
+the read then raises WriterStalled rather than spinning forever.
+"""
+import struct
+import time
+from multiprocessing import shared_memory
+
+import log
+from app import GameState, mask_to_cards, mask_to_card_map, playable_mask
+
+MAX_PLAYERS = 8
+NAME_SIZE = 32
+TYPE_SIZE = 16
+# busy retries before a reader starts yielding and watching the clock
+SPINS = 1000
+STALL_TIMEOUT = 0.05
+
+_VERSION = struct.Struct("<Q")
+# type, has_data, state, current player, my index, player count, board card count, seq,
+# monotonic ns the message was received at, hand, board, possible moves, card count per player
+_FIELDS = struct.Struct("<{}s?BbbBHqQQQQ{}b".format(TYPE_SIZE, MAX_PLAYERS))
+_NAMES = struct.Struct("<" + "{}s".format(NAME_SIZE) * (MAX_PLAYERS + 1))
+_FIELDS_OFFSET = _VERSION.size
+_NAMES_OFFSET = _FIELDS_OFFSET + _FIELDS.size
+BLOCK_SIZE = _NAMES_OFFSET + _NAMES.size
+# a snapshot is the block without its version, and only restores into the same layout
+SNAPSHOT_SIZE = BLOCK_SIZE - _FIELDS_OFFSET
+LAYOUT = (_FIELDS.format + _NAMES.format).encode()
+
+_STATES = list(GameState)
+_STATE_CODE = {state: code for code, state in enumerate(_STATES)}
+
+
+class WriterStalled(RuntimeError):
+    """A write has been in progress for longer than STALL_TIMEOUT."""
+
+
+def _truncate(raw, size):
+    """`raw` cut to at most `size` bytes without splitting a UTF-8 character."""
+    if len(raw) <= size:
+        return raw
+    return raw[:size].decode("utf-8", "ignore").encode("utf-8")
+
+
+def _encode_name(name):
+    raw = (name or "").encode("utf-8")
+    if len(raw) > NAME_SIZE:
+        log.debug("name_truncated", name=name, size=NAME_SIZE)
+    return _truncate(raw, NAME_SIZE)
+
+
+def _decode_name(raw):
+    return raw.rstrip(b"\0").decode("utf-8", "ignore")
+
+
+class SharedGameState(object):
+    """
+    `write` publishes a decoded server message and returns the new version;
+    `read` returns (version, message_type, game_json, received_ns) with
+    game_json in the decoded form `Game.from_json` takes, or None before
+    the first write.
+    """
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.buf = shm.buf
+        self.owner = owner
+
+    @classmethod
+    def create(cls):
+        shm = shared_memory.SharedMemory(create=True, size=BLOCK_SIZE)
+        shm.buf[:BLOCK_SIZE] = bytes(BLOCK_SIZE)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name=name))
+
+    def __reduce__(self):
+        # spawned processes attach to the same block by name
+        return (SharedGameState.attach, (self.shm.name,))
+
+    @property
+    def version(self):
+        return _VERSION.unpack_from(self.buf, 0)[0]
+
+    def _stable(self, unpack):
+        """(version, unpack()) from a block no write changed meanwhile."""
+        spins = 0
+        deadline = None
+        while True:
+            version = self.version
+            if not version & 1:
+                result = unpack()
+                if self.version == version:
+                    return version, result
+            spins += 1
+            if spins >= SPINS:
+                now = time.monotonic()
+                if deadline is None:
+                    deadline = now + STALL_TIMEOUT
+                elif now > deadline:
+                    raise WriterStalled("version {} stayed odd for {}s".format(version, STALL_TIMEOUT))
+                time.sleep(0)
+
+    def write(self, message_type, game_json, received_ns=0):
+        """
+        Whatever the layout cannot hold is cut to fit rather than refused, so
+        odd server data never stops the socket process: names and the message
+        type are truncated and players past MAX_PLAYERS are dropped.
+        """
+        players = sorted(game_json.get("players", []), key=lambda player: player["index"])
+        if len(players) > MAX_PLAYERS:
+            log.warning("players_dropped", players=len(players), max_players=MAX_PLAYERS)
+            players = players[:MAX_PLAYERS]
+        message_type = (message_type or "").encode("utf-8")
+        if len(message_type) > TYPE_SIZE:
+            log.warning("message_type_truncated", message_type=message_type.decode("utf-8"), size=TYPE_SIZE)
+            message_type = _truncate(message_type, TYPE_SIZE)
+        counts = [player.get("card_count", -1) for player in players]
+        counts += [-1] * (MAX_PLAYERS - len(counts))
+        me = game_json["me"]
+        possible_moves = 0
+        for card in game_json.get("possible_moves") or []:
+            possible_moves |= card.mask
+        seq = game_json.get("seq")
+        names = [_encode_name(me.get("name"))] + [_encode_name(player.get("name")) for player in players]
+        names += [b""] * (MAX_PLAYERS + 1 - len(names))
+        version = self.version + 1
+        _VERSION.pack_into(self.buf, 0, version)
+        _FIELDS.pack_into(self.buf, _FIELDS_OFFSET, message_type, True,
+                          _STATE_CODE[GameState(game_json["state"])], game_json["current_player_id"],
+                          me["index"], len(players), game_json.get("card_count", 0),
+                          -1 if seq is None else seq, received_ns, me["cards"], game_json["board"], possible_moves,
+                          *counts)
+        _NAMES.pack_into(self.buf, _NAMES_OFFSET, *names)
+        version += 1
+        _VERSION.pack_into(self.buf, 0, version)
+        return version
+
+    def apply_delta(self, delta, received_ns=0):
+        """
+        Patch the state in place with a decoded `game_delta`, published as a
+        `game_update`; returns the new version. Only the fields are rewritten,
+        the names stay. Raises ValueError, leaving the block untouched, if it
+        does not directly follow the seq written last.
+        """
+        # the writer reads its own last write, so no seqlock is needed
+        fields = list(_FIELDS.unpack_from(self.buf, _FIELDS_OFFSET))
+        seq = fields[7]
+        if not fields[1] or seq < 0 or delta["seq"] != seq + 1:
+            raise ValueError("delta {} does not follow {}".format(delta["seq"], None if seq < 0 else seq))
+        state = GameState(delta["state"])
+        my_index, num_players = fields[4], fields[5]
+        hand = fields[9] & ~delta.get("removed", 0)
+        board = fields[10] | delta.get("board", 0)
+        # the server's possible_moves: my playable cards, only on my turn
+        if state == GameState.STARTED and delta["current_player_id"] == my_index:
+            possible_moves = playable_mask(board) & hand
+        else:
+            possible_moves = 0
+        for index, count in delta.get("players", {}).items():
+            if index < num_players:
+                fields[12 + index] = count
+        fields[0] = b"game_update"
+        fields[2] = _STATE_CODE[state]
+        fields[3] = delta["current_player_id"]
+        fields[6] = delta.get("card_count", fields[6])
+        fields[7] = delta["seq"]
+        fields[8] = received_ns
+        fields[9:12] = hand, board, possible_moves
+        version = self.version + 1
+        _VERSION.pack_into(self.buf, 0, version)
+        _FIELDS.pack_into(self.buf, _FIELDS_OFFSET, *fields)
+        version += 1
+        _VERSION.pack_into(self.buf, 0, version)
+        return version
+
+    def snapshot(self):
+        """The current state as SNAPSHOT_SIZE bytes, or None before the first write."""
+        version, data = self._stable(lambda: bytes(self.buf[_FIELDS_OFFSET:BLOCK_SIZE]))
+        return data if version else None
+
+    def restore(self, data):
+        """Publish a state saved by `snapshot` as a new version; returns the version."""
+        if len(data) != SNAPSHOT_SIZE:
+            raise ValueError("snapshot is {} bytes, expected {}".format(len(data), SNAPSHOT_SIZE))
+        version = self.version + 1
+        _VERSION.pack_into(self.buf, 0, version)
+        self.buf[_FIELDS_OFFSET:BLOCK_SIZE] = data
+        # the receive stamp is from another boot of the monotonic clock
+        fields = list(_FIELDS.unpack_from(self.buf, _FIELDS_OFFSET))
+        fields[8] = 0
+        _FIELDS.pack_into(self.buf, _FIELDS_OFFSET, *fields)
+        version += 1
+        _VERSION.pack_into(self.buf, 0, version)
+        return version
+
+    def read(self):
+        version, (fields, names) = self._stable(
+            lambda: (_FIELDS.unpack_from(self.buf, _FIELDS_OFFSET), _NAMES.unpack_from(self.buf, _NAMES_OFFSET)))
+        message_type, has_data, state, current, my_index, num_players, card_count, seq, received_ns, hand, board, \
+            possible = fields[:12]
+        if not has_data:
+            return None
+        counts = fields[12:]
+        players = []
+        for index in range(num_players):
+            player = {"index": index, "name": _decode_name(names[index + 1])}
+            if counts[index] >= 0:
+                player["card_count"] = counts[index]
+            players.append(player)
+        game_json = {
+            "players": players,
+            "me": {"index": my_index, "name": _decode_name(names[0]), "cards": hand},
+            "current_player_id": current,
+            "state": _STATES[state].value,
+            "card_map": mask_to_card_map(board),
+            "board": board,
+            "card_count": card_count,
+            "possible_moves": mask_to_cards(possible),
+            "seq": None if seq < 0 else seq,
+        }
+        return version, _decode_name(message_type), game_json, received_ns
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
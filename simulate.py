@@ -0,0 +1,253 @@
+"""
+Batch simulation of complete games with NumPy, for tuning bot policies.
+
+A batch of games is dealt from independent shuffles into a
+(games x players x 52) boolean hand array, with card bits in the same order
+as `Card.mask`, and every game is advanced in lockstep: one turn of every
+unfinished game per step. The hands are also packed into one 64 bit card mask per hand, and
+every game has a mask of its playable cards, those just outside each
+suit's `card_map` range: playing a card moves its end of the range, so
+only the card beyond it becomes playable, and a seven opens both sides.
+The legal moves of a step are then one and of two uint64 arrays, and the
+(games x 52) form is only unpacked for the games where a policy has a
+choice to make.
+
+A policy is a plain function of (sim, games, legal, rng), where `legal` is
+the uint64 legal card mask of each game, returning either the card index
+to play in each game or a (len(games) x 52) array of scores, in which case
+the highest scoring legal card is played. It is only asked when there is
+a choice: a player with one legal card plays it and one with none passes.
+Each seat can have its own policy.
+
+    python simulate.py --games 200000
+    python simulate.py --games 100000 --policy random --seat 0=extend_own
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app import FIRST_MOVE_CARD, NUM_CARDS_PER_SUIT, NUM_SUITS, Number
+
+NUM_CARDS = NUM_SUITS * NUM_CARDS_PER_SUIT
+SEVEN = Number.SEVEN - 1
+FIRST_CARD = FIRST_MOVE_CARD.mask.bit_length() - 1
+_RANKS = np.arange(NUM_CARDS_PER_SUIT, dtype=np.int8)
+_CARD_RANKS = np.tile(_RANKS, NUM_SUITS)
+_SHIFTS = np.arange(NUM_CARDS, dtype=np.uint64)
+_ONE = np.uint64(1)
+_SEVENS = np.uint64(sum(1 << int(card) for card in np.flatnonzero(_CARD_RANKS == SEVEN)))
+_OTHER_SEVENS = _SEVENS & ~np.uint64(1 << FIRST_CARD)
+
+
+def unpack(masks):
+    """(len(masks) x 52) booleans of uint64 card masks."""
+    return ((masks[:, None] >> _SHIFTS) & _ONE).astype(bool)
+
+
+def lowest_card(masks):
+    """Index of the lowest card of each non empty uint64 card mask."""
+    return np.log2(masks & (~masks + _ONE)).astype(np.int64)
+
+
+def random_policy(sim, games, legal, rng):
+    """A uniformly random legal card: the lowest after dropping a random number of the lowest ones."""
+    skip = (rng.random(len(legal)) * np.bitwise_count(legal)).astype(np.uint8)
+    legal = legal.copy()
+    for _ in range(int(skip.max())):
+        more = skip > 0
+        legal[more] &= legal[more] - _ONE
+        skip[more] -= 1
+    return lowest_card(legal)
+
+
+def first_policy(sim, games, legal, rng):
+    """The lowest card, as multitable's `first` bot plays."""
+    return lowest_card(legal)
+
+
+def hold_sevens_policy(sim, games, legal, rng):
+    """Random, but never open a suit while something else can be played."""
+    others = legal & ~_SEVENS
+    return random_policy(sim, games, np.where(others != 0, others, legal), rng)
+
+
+def extend_own_policy(sim, games, legal, rng):
+    """Prefer cards that uncover the next card of my own hand, then random."""
+    hand = sim.hands[games, sim.current[games]].reshape(len(games), NUM_SUITS, NUM_CARDS_PER_SUIT)
+    below = np.zeros_like(hand)
+    below[:, :, 1:] = hand[:, :, :-1]
+    above = np.zeros_like(hand)
+    above[:, :, :-1] = hand[:, :, 1:]
+    # going outward from the seven, the next card is below for low cards and above for high ones
+    uncovers = np.where(_RANKS < SEVEN, below, np.where(_RANKS > SEVEN, above, below | above))
+    return uncovers.reshape(len(games), NUM_CARDS) + 0.5 * rng.random((len(games), NUM_CARDS), dtype=np.float32)
+
+
+POLICIES = {
+    "random": random_policy,
+    "first": first_policy,
+    "hold_sevens": hold_sevens_policy,
+    "extend_own": extend_own_policy,
+}
+
+
+class BatchSimulation(object):
+    """
+    `games` games of `players` players, one policy per seat. `run` plays
+    them all out and returns the winner and the number of turns (passes
+    included) and of cards played for every game.
+    """
+    def __init__(self, games, players=4, policies=None, seed=None):
+        self.size = games
+        self.players = players
+        self.policies = list(policies or [random_policy] * players)
+        self.rng = np.random.default_rng(seed)
+        self.hands = None
+        self.masks = None
+        self.counts = None
+        self.playable = None
+        self.current = None
+        self.turns = None
+        self.moves = None
+        self.winner = None
+
+    def deal(self):
+        """Deal like `Table.deal`: card i of each shuffled deck to seat i % players; the 7:H holder starts."""
+        games = np.arange(self.size)
+        decks = self.rng.permuted(np.tile(np.arange(NUM_CARDS), (self.size, 1)), axis=1)
+        self.hands = np.zeros((self.size, self.players, NUM_CARDS), dtype=bool)
+        seats = np.arange(NUM_CARDS) % self.players
+        self.hands[games[:, None], seats[None, :], decks] = True
+        self.start()
+
+    def start(self):
+        """Set up the play state from `hands`, for dealt games or hands set directly."""
+        self.counts = self.hands.sum(axis=2, dtype=np.int8)
+        packed = np.packbits(self.hands, axis=2, bitorder="little")
+        padded = np.zeros((self.size, self.players, 8), dtype=np.uint8)
+        padded[:, :, :packed.shape[2]] = packed
+        self.masks = padded.view("<u8")[:, :, 0].astype(np.uint64)
+        # before the first move only the 7:H can be played
+        self.playable = np.full(self.size, 1 << FIRST_CARD, dtype=np.uint64)
+        self.current = self.hands[:, :, FIRST_CARD].argmax(axis=1)
+        self.turns = np.zeros(self.size, dtype=np.int32)
+        self.moves = np.zeros(self.size, dtype=np.int32)
+        self.winner = np.full(self.size, -1, dtype=np.int8)
+
+    def place(self, games, cards):
+        """Put one card on the board in each of `games`, moving the playable end of its suit."""
+        bits = _ONE << cards.astype(np.uint64)
+        ranks = _CARD_RANKS[cards]
+        below = (ranks <= SEVEN) & (ranks > 0)
+        above = (ranks >= SEVEN) & (ranks < NUM_CARDS_PER_SUIT - 1)
+        playable = self.playable[games] & ~bits
+        playable[below] |= bits[below] >> _ONE
+        playable[above] |= bits[above] << _ONE
+        # the first move opens the other sevens too
+        playable[cards == FIRST_CARD] |= _OTHER_SEVENS
+        self.playable[games] = playable
+        return bits
+
+    def choose(self, games, legal):
+        """Card index per game by the mover's seat policy; `legal` is the card mask of each game."""
+        seats = self.current[games]
+        cards = np.empty(len(games), dtype=np.int64)
+        for policy in dict.fromkeys(self.policies):
+            selected = np.isin(seats, [seat for seat, other in enumerate(self.policies) if other is policy])
+            if not selected.any():
+                continue
+            everything = selected.all()
+            chosen = games if everything else games[selected]
+            mask = legal if everything else legal[selected]
+            result = np.asarray(policy(self, chosen, mask, self.rng))
+            if result.ndim == 2:
+                result = np.where(unpack(mask), result, -np.inf).argmax(axis=1)
+            if everything:
+                return result
+            cards[selected] = result
+        return cards
+
+    def step(self, games):
+        """One turn of every game in `games`; returns the games still running."""
+        seats = self.current[games]
+        legal = self.masks[games, seats] & self.playable[games]
+        choices = np.bitwise_count(legal)
+        moved = choices > 0
+        played, seats, legal, choices = games[moved], seats[moved], legal[moved], choices[moved]
+        cards = lowest_card(legal)
+        several = choices > 1
+        if several.any():
+            cards[several] = self.choose(played[several], legal[several])
+        self.hands[played, seats, cards] = False
+        self.masks[played, seats] &= ~self.place(played, cards)
+        self.counts[played, seats] -= 1
+        self.moves[played] += 1
+        self.turns[games] += 1
+        won = self.counts[played, seats] == 0
+        self.winner[played[won]] = seats[won]
+        running = self.winner[games] < 0
+        games = games[running]
+        self.current[games] = (self.current[games] + 1) % self.players
+        return games
+
+    def run(self):
+        self.deal()
+        games = np.arange(self.size)
+        while len(games):
+            games = self.step(games)
+        return self.winner, self.turns, self.moves
+
+
+def simulate(games, players=4, policies=None, seed=None, batch=50000):
+    """Play `games` games in batches of at most `batch`; returns the concatenated (winner, turns, moves)."""
+    rng = np.random.default_rng(seed)
+    results = []
+    remaining = games
+    while remaining > 0:
+        size = min(batch, remaining)
+        sim = BatchSimulation(size, players, policies, rng.integers(1 << 63))
+        results.append(sim.run())
+        remaining -= size
+    return tuple(np.concatenate(column) for column in zip(*results))
+
+
+def report(winner, turns, moves, policy_names, seconds):
+    games = len(winner)
+    print("{} games in {:.2f}s ({:.0f} games/s)".format(games, seconds, games / seconds if seconds else 0))
+    wins = np.bincount(winner, minlength=len(policy_names))
+    for seat, name in enumerate(policy_names):
+        rate = wins[seat] / games
+        # normal approximation of the 95% interval
+        margin = 1.96 * np.sqrt(rate * (1 - rate) / games)
+        print("seat {} {:<12} win rate {:6.2%} +- {:.2%}".format(seat, name, rate, margin))
+    for label, values in (("turns", turns), ("cards played", moves)):
+        print("{:<13} mean {:6.1f}  p50 {:4.0f}  p90 {:4.0f}  min {:4d}  max {:4d}".format(
+            label, values.mean(), np.percentile(values, 50), np.percentile(values, 90), values.min(), values.max()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many complete games with vectorized policies")
+    parser.add_argument("--games", type=int, default=100000)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--policy", choices=sorted(POLICIES), default="random", help="policy of every seat")
+    parser.add_argument("--seat", action="append", default=[], metavar="SEAT=POLICY",
+                        help="policy of one seat, e.g. 0=extend_own")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--batch", type=int, default=50000, help="games simulated at once")
+    args = parser.parse_args()
+
+    names = [args.policy] * args.players
+    for value in args.seat:
+        seat, _, name = value.partition("=")
+        if name not in POLICIES:
+            parser.error("unknown policy {}".format(name))
+        names[int(seat)] = name
+    start = time.perf_counter()
+    winner, turns, moves = simulate(args.games, args.players, [POLICIES[name] for name in names], args.seed,
+                                    args.batch)
+    report(winner, turns, moves, names, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,95 @@
+import abc
 import json
 import multiprocessing
+import os
+import random
 import sys
-from multiprocessing import Manager
-from app import GameState, Game, Card
-from handler import GameHandler, WSHandler
-import websocket
-
-try:
-    import thread
-except ImportError:
-    import _thread as thread
-import time
-class SocketHandler():
+import threading
+import checkpoint
+from handler import GameHandler, WSHandler, StateNotifier
+from codec import GAME_DELTA, MessageDecoder, SUBPROTOCOLS, parse_subprotocol
+from recording import MessageRecorder
+from shared_state import SharedGameState
+import log
+import telemetry
+from log import Log
+from telemetry import StartupTrace
+
+# asyncio and websockets are only imported by the connection process, in
+# GameConnection, so the UI process never pays for them.
+
+
+class SessionHandler(abc.ABC):
+    """
+    Turns one connection's raw messages into decoded game states: picks the
+    codec negotiated on open, hands snapshots to `publish` and deltas to
+    `publish_delta` (asking for a snapshot on a gap) and records traffic
+    when given a recorder.
+    """
+    def __init__(self):
+        self.decoder = MessageDecoder()
+        self.delta = False
+        self.resyncing = False
+        self.recorder = None
+
+    def set_recorder(self, recorder):
+        """Record every inbound and outbound message (see recording)."""
+        self.recorder = recorder
+
+    @abc.abstractmethod
+    def publish(self, ws, message_type, game_json, received_ns):
+        """Take one decoded snapshot; `message_type` is the server's."""
+
+    @abc.abstractmethod
+    def publish_delta(self, ws, delta, received_ns):
+        """Apply a decoded delta to the published state; raise ValueError if it does not follow it."""
+
+    def on_message(self, ws, message):
+        received_ns = telemetry.now()
+        if self.recorder is not None:
+            self.recorder.on_message(message)
+        message_type, game_json = self.decoder.decode(message)
+        log.debug("message", type=message_type, seq=game_json.get("seq"))
+        if message_type == GAME_DELTA:
+            self.apply_delta(ws, game_json, received_ns)
+            return
+        self.resyncing = False
+        self.publish(ws, message_type, game_json, received_ns)
+
+    def apply_delta(self, ws, delta, received_ns):
+        """Publish a delta; on a gap ask once for a snapshot and drop deltas until it comes."""
+        if self.resyncing:
+            return
+        try:
+            self.publish_delta(ws, delta, received_ns)
+        except ValueError as e:
+            log.warning("resync", reason=str(e))
+            self.resyncing = True
+            ws.send(GameConnection.SYNC_MESSAGE)
+
+    def on_error(self, ws, error):
+        log.warning("socket_error", error=repr(error))
+
+    def on_close(self, ws):
+        log.info("socket_closed")
+
+    def on_send(self, ws, message):
+        """Called once `message` has gone out on the socket."""
+        if self.recorder is not None:
+            self.recorder.on_send(message)
+
+    def on_open(self, ws):
+        subprotocol = getattr(ws, "subprotocol", None)
+        if self.recorder is not None:
+            self.recorder.on_open(subprotocol)
+        self.decoder = MessageDecoder.for_subprotocol(subprotocol)
+        self.delta = parse_subprotocol(subprotocol)[1]
+        self.resyncing = False
+        log.info("socket_open", subprotocol=subprotocol)
+
+
+class SocketHandler(SessionHandler):
+    """The app's single session, published to the shared GameHandler state."""
     __instance = None
 
     @staticmethod
@@ -28,55 +106,199 @@ class SocketHandler():
             raise Exception("This class is a singleton!")
         else:
             SocketHandler.__instance = self
+        super(SocketHandler, self).__init__()
+        self.started = multiprocessing.Event()
 
-    def on_message(self, ws, message):
-        message = json.loads(message)
-        print("message received on socket:", message)
-        game_json = message["game"]
-        game_json["me"] = message["me"]
-        game_json["possible_moves"] = [Card.from_str(card) for card in message["possible_moves"] or []]
-        self.update_shared_data("type", message["type"])
-        self.update_shared_data("data", game_json)
-        print(game_json)
-        print(GameHandler.get_game_instance().__dict__)
-        if message["type"] == "game_start" and not GameHandler.get_game_data().get("is_started", False):
-            GameHandler.update_data("is_started", True)
-            ws.close()
-
-    @classmethod
-    def update_shared_data(cls, key, data):
-        GameHandler.update_data(key, data)
-
-
-    def on_error(self, ws, error):
-        print(error)
+    def publish(self, ws, message_type, game_json, received_ns):
+        GameHandler.set_game_state(message_type, game_json, received_ns)
+        if message_type == "game_start" and not self.started.is_set():
+            self.started.set()
 
-    def on_close(self, ws):
-        print("### closed ###")
+    def publish_delta(self, ws, delta, received_ns):
+        # patched straight into the shared block, which is the state deltas follow on
+        GameHandler.apply_delta(delta, received_ns)
 
     def on_open(self, ws):
+        super(SocketHandler, self).on_open(ws)
         WSHandler.set_ws(ws)
-        print(WSHandler.get_ws())
-        print("waiting for game to start")
+        StartupTrace.mark("socket_open")
+
+
+SERVER_URL = "ws://127.0.0.1:8081/ws/game/patta/{}/"
+
+
+class GameConnection(object):
+    """
+    One long lived websocket connection, run on its own asyncio loop by
+    `run_forever` (normally in a separate process). Outgoing messages go
+    through a multiprocessing queue so `send` can be called from any thread
+    or process; anything queued while disconnected is sent after reconnect.
+    Dropped connections are retried with jittered exponential backoff and
+    every reconnect asks the server for a fresh snapshot, as does the first
+    connect with `sync_first` (when resuming from a checkpoint). The wire encoding
+    is negotiated as a subprotocol (see codec) over permessage-deflate.
+
+    With `local=True` the connection lives on the caller's event loop
+    instead: `send` and `close` must then be called from that loop, and no
+    queue or thread is used, so many connections can share one loop.
+    """
+    SYNC_MESSAGE = json.dumps({"type": "sync"})
+
+    def __init__(self, url, handler, heartbeat=20, min_backoff=0.5, max_backoff=30, compression="deflate",
+                 subprotocols=SUBPROTOCOLS, local=False, sync_first=False):
+        self.url = url
+        self.handler = handler
+        self.heartbeat = heartbeat
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.local = local
+        if local:
+            import asyncio
+            self.outbox = None
+            self.pending = asyncio.Queue()
+        else:
+            self.outbox = multiprocessing.Queue()
+            self.pending = None
+        self.compression = compression
+        self.subprotocols = subprotocols
+        self.subprotocol = None
+        self.sync_first = sync_first
+        self.connects = 0
+        self._unsent = None
+
+    def send(self, message):
+        if self.local:
+            self.pending.put_nowait(message)
+        else:
+            self.outbox.put(message)
+
+    def close(self):
+        self.send(None)
+
+    def get_backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.min_backoff * 2 ** attempt))
+
+    def run_forever(self):
+        import asyncio
+
+        try:
+            asyncio.run(self.run())
+        except Exception as e:
+            # multiprocessing reports the traceback itself, bypassing sys.excepthook
+            Log.crashed(e)
+            raise
+        finally:
+            if GameHandler.checkpointer is not None:
+                GameHandler.checkpointer.flush()
+
+    async def run(self):
+        import asyncio
+        import websockets
+
+        pending = self.pending
+        if pending is None:
+            loop = asyncio.get_running_loop()
+            pending = asyncio.Queue()
+            threading.Thread(target=self._drain_outbox, args=(loop, pending), daemon=True).start()
+        attempt = 0
+        while True:
+            try:
+                async with websockets.connect(self.url, ping_interval=self.heartbeat,
+                                              ping_timeout=self.heartbeat, compression=self.compression,
+                                              subprotocols=self.subprotocols) as ws:
+                    attempt = 0
+                    self.subprotocol = ws.subprotocol
+                    self.handler.on_open(self)
+                    if self.connects or self.sync_first:
+                        await ws.send(self.SYNC_MESSAGE)
+                        self.handler.on_send(self, self.SYNC_MESSAGE)
+                    self.connects += 1
+                    if await self._session(ws, pending):
+                        self.handler.on_close(self)
+                        return
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                self.handler.on_error(self, e)
+            self.handler.on_close(self)
+            await asyncio.sleep(self.get_backoff(attempt))
+            attempt += 1
+
+    def _drain_outbox(self, loop, pending):
+        while True:
+            message = self.outbox.get()
+            loop.call_soon_threadsafe(pending.put_nowait, message)
+            if message is None:
+                return
+
+    async def _session(self, ws, pending):
+        """Pump messages both ways until the socket drops (False) or close() is called (True)."""
+        import asyncio
+
+        reader = asyncio.ensure_future(self._read(ws))
+        writer = asyncio.ensure_future(self._write(ws, pending))
+        done, _ = await asyncio.wait([reader, writer], return_when=asyncio.FIRST_COMPLETED)
+        for task in (reader, writer):
+            if task not in done:
+                task.cancel()
+        for task in done:
+            # re-raise connection errors into run()
+            if task.result():
+                return True
+        return False
+
+    async def _read(self, ws):
+        async for message in ws:
+            try:
+                self.handler.on_message(self, message)
+            except Exception as e:
+                # one bad message must not end the session; a missed delta is caught by its seq
+                self.handler.on_error(self, e)
+        return False
+
+    async def _write(self, ws, pending):
+        while True:
+            if self._unsent is None:
+                self._unsent = await pending.get()
+            if self._unsent is None:
+                await ws.close()
+                return True
+            await ws.send(self._unsent)
+            # recorded once sent: a message cut off by a drop is sent again after reconnect
+            self.handler.on_send(self, self._unsent)
+            self._unsent = None
 
 
 if __name__ == "__main__":
-    from main import PattebaazApp
-    manager = Manager()
-    d = manager.dict()
-    game = GameHandler.set_game_data(d)
-    websocket.enableTrace(True)
+    StartupTrace.mark("imports")
     name = sys.argv[1]
-    GameHandler.update_data("name", name)
+    Log.install_crash_hooks()
+    GameHandler.set_game_data(SharedGameState.create())
+    GameHandler.set_notifier(StateNotifier())
+    checkpointer = checkpoint.Checkpointer(checkpoint.checkpoint_path(name))
+    GameHandler.set_checkpointer(checkpointer)
+    # after being killed, show the last known state at once and let the server correct it
+    snapshot = checkpoint.load(checkpointer.path)
+    if snapshot is not None:
+        GameHandler.restore(snapshot)
+        StartupTrace.mark("checkpoint_restored")
     socket_handler = SocketHandler()
-    ws = websocket.WebSocketApp("ws://127.0.0.1:8081/ws/game/patta/{}/".format(name),
-                                on_message=lambda ws, msg: socket_handler.on_message(ws, msg),
-                                on_error=lambda ws, msg: socket_handler.on_error(ws, msg),
-                                on_close=lambda ws: socket_handler.on_close(ws))
-    ws.on_open = lambda ws:socket_handler.on_open(ws)
+    if os.environ.get("PATTA_RECORD"):
+        socket_handler.set_recorder(MessageRecorder(os.environ["PATTA_RECORD"]))
+    connection = GameConnection(SERVER_URL.format(name), socket_handler, sync_first=snapshot is not None)
+    WSHandler.set_ws(connection)
 
-    p1 = multiprocessing.Process(target=ws.run_forever, args=())
+    # start connecting before Kivy is imported, so the forked connection
+    # process stays small and the handshake overlaps the UI's startup
+    p1 = multiprocessing.Process(target=connection.run_forever, args=(), daemon=True)
     p1.start()
-    p1.join()
+    from main import PattebaazApp
+    from card_atlas import CardTextures
+    # decode the card atlas while the handshake is in flight
+    CardTextures.load_async()
+    StartupTrace.mark("ui_imported")
+    if snapshot is None:
+        socket_handler.started.wait()
     app = PattebaazApp()
     app.run()
+    connection.close()
+    p1.join(5)
+    GameHandler.get_game_data().close()
@@ -0,0 +1,308 @@
+"""
+Move latency and frame time telemetry.
+
+Every move I make is a span keyed by its optimistic move seq, stamped at
+each stage it passes through:
+
+    click     "Make Move" / "PASS" pressed (RootWidget)
+    send      move handed to the connection (RootWidget.make_move)
+    echo      the server state that confirms it received (SocketHandler, socket process)
+    applied   that state applied to the UI's Game (GameHandler)
+    rendered  the frame showing it flipped to the screen (RootWidget)
+
+Stamps are `time.monotonic_ns`, which is one clock for every process.
+Durations between consecutive stages and click to rendered go into HDR
+style histograms, as do frame intervals while a move is in flight (an idle
+app schedules no per frame work). `Telemetry.export` writes them as JSON
+and this module checks an export against the latency SLOs:
+
+    python telemetry.py logs/telemetry-*.json
+
+Telemetry is off unless PATTA_TELEMETRY=1.
+"""
+import json
+import os
+import sys
+import time
+
+import log
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_DIR = os.path.join(BASE_DIR, "logs")
+
+STAGES = ("click", "send", "echo", "applied", "rendered")
+MOVE_TOTAL = "move.click_rendered"
+FRAME = "frame.interval"
+
+# histogram: (percentile, limit in ms)
+SLOS = {
+    MOVE_TOTAL: (99, 150),
+    "move.echo_applied": (99, 20),
+    FRAME: (99, 34),
+}
+
+
+def now():
+    return time.monotonic_ns()
+
+
+def process_start_ns():
+    """This process's launch time on the `now` clock, from /proc where available."""
+    try:
+        with open("/proc/self/stat") as fd:
+            # fields after the parenthesised command name start at field 3; starttime is field 22
+            start_ticks = int(fd.read().rpartition(")")[2].split()[19])
+        age_ns = time.clock_gettime_ns(time.CLOCK_BOOTTIME) - start_ticks * 10 ** 9 // os.sysconf("SC_CLK_TCK")
+        return now() - age_ns
+    except (OSError, ValueError, IndexError, AttributeError):
+        return _IMPORTED_NS
+
+
+_IMPORTED_NS = now()
+
+
+class StartupTrace(object):
+    """
+    Milliseconds from process launch to named startup stages. A forked
+    process inherits its parent's launch time, so the connection process's
+    `socket_open` is measured from the app's launch. PATTA_STARTUP_TRACE=1
+    prints each stage as it is reached.
+    """
+    launch_ns = process_start_ns()
+    marks = {}
+
+    @classmethod
+    def reset(cls):
+        """Measure from this process's own launch, e.g. in a freshly forked bot."""
+        cls.launch_ns = process_start_ns()
+        cls.marks = {}
+
+    @classmethod
+    def mark(cls, stage):
+        if stage in cls.marks:
+            return
+        ms = (now() - cls.launch_ns) / 1e6
+        cls.marks[stage] = ms
+        log.info("startup", stage=stage, ms=round(ms, 1))
+        if os.environ.get("PATTA_STARTUP_TRACE"):
+            print("startup {:<12} {:9.1f} ms".format(stage, ms))
+
+
+class Histogram(object):
+    """
+    HDR style histogram of non negative integers (microseconds here). Values
+    below 2 * sub_buckets are counted exactly; every power of two above that
+    is split into `sub_buckets` linear buckets, so a reported value is
+    within 1 / sub_buckets of the recorded one whatever its magnitude.
+    """
+    def __init__(self, sub_buckets=128):
+        self.sub_buckets = sub_buckets
+        self.magnitude = sub_buckets.bit_length()
+        self.counts = [0] * (2 * sub_buckets)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def index_for(self, value):
+        if value < 2 * self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.magnitude
+        return shift * self.sub_buckets + (value >> shift)
+
+    def value_for(self, index):
+        """Highest value counted in bucket `index`."""
+        if index < 2 * self.sub_buckets:
+            return index
+        shift = index // self.sub_buckets - 1
+        return ((index - shift * self.sub_buckets + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        value = max(0, int(value))
+        index = self.index_for(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += count
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0
+        target = max(1, -(-self.count * pct // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.value_for(index), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.record(other.value_for(index), count)
+
+    def to_json(self):
+        return {
+            "unit": "us",
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "percentiles": {str(pct): self.percentile(pct) for pct in (50, 90, 99, 99.9)},
+            "sub_buckets": self.sub_buckets,
+            "buckets": {str(index): count for index, count in enumerate(self.counts) if count},
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        self = cls(data.get("sub_buckets", 128))
+        for index, count in data["buckets"].items():
+            self.record(self.value_for(int(index)), count)
+        return self
+
+
+class Telemetry(object):
+    enabled = os.environ.get("PATTA_TELEMETRY", "0") != "0"
+    histograms = {}
+    counters = {}
+    # move seq -> {stage: monotonic ns}
+    spans = {}
+    max_spans = 64
+    # a span older than this is taken as never answered, so it doesn't keep frame sampling on
+    in_flight_ns = 5 * 10 ** 9
+    last_frame = None
+
+    @classmethod
+    def histogram(cls, name):
+        histogram = cls.histograms.get(name)
+        if histogram is None:
+            histogram = cls.histograms[name] = Histogram()
+        return histogram
+
+    @classmethod
+    def record(cls, name, value_us):
+        if cls.enabled:
+            cls.histogram(name).record(value_us)
+
+    @classmethod
+    def start_span(cls, key, stage="click", ts=None):
+        if not cls.enabled:
+            return
+        if len(cls.spans) >= cls.max_spans:
+            # a span the server never answered; don't let them pile up
+            del cls.spans[min(cls.spans)]
+        cls.spans[key] = {stage: now() if ts is None else ts}
+
+    @classmethod
+    def mark(cls, key, stage, ts=None):
+        span = cls.spans.get(key)
+        if span is not None and stage not in span:
+            span[stage] = now() if ts is None else ts
+        return span
+
+    @classmethod
+    def end_span(cls, key, stage="rendered", ts=None):
+        span = cls.mark(key, stage, ts)
+        if span is None:
+            return
+        del cls.spans[key]
+        stamped = [(name, span[name]) for name in STAGES if name in span]
+        for (first, start), (second, end) in zip(stamped, stamped[1:]):
+            cls.record("move.{}_{}".format(first, second), (end - start) // 1000)
+        if "click" in span and stage in span:
+            cls.record("move.click_{}".format(stage), (span[stage] - span["click"]) // 1000)
+
+    @classmethod
+    def drop_span(cls, key, reason="rejected"):
+        if cls.spans.pop(key, None) is not None:
+            name = "move." + reason
+            cls.counters[name] = cls.counters.get(name, 0) + 1
+
+    @classmethod
+    def frame(cls, ts=None):
+        """Call once per frame; records the interval since the previous one."""
+        ts = now() if ts is None else ts
+        if cls.last_frame is not None:
+            cls.record(FRAME, (ts - cls.last_frame) // 1000)
+        cls.last_frame = ts
+
+    @classmethod
+    def in_flight(cls, ts=None):
+        """Whether a move span was started within `in_flight_ns`."""
+        ts = now() if ts is None else ts
+        return any(ts - min(span.values()) < cls.in_flight_ns for span in cls.spans.values())
+
+    @classmethod
+    def stop_frames(cls):
+        """Frames are no longer sampled; the gap until the next `frame` is not an interval."""
+        cls.last_frame = None
+
+    @classmethod
+    def summary(cls):
+        """{name: (count, p50 ms, p99 ms)} for every histogram."""
+        return {name: (histogram.count, histogram.percentile(50) / 1000.0, histogram.percentile(99) / 1000.0)
+                for name, histogram in sorted(cls.histograms.items())}
+
+    @classmethod
+    def to_json(cls):
+        return {
+            "time": time.time(),
+            "pid": os.getpid(),
+            "counters": dict(cls.counters),
+            "startup_ms": dict(StartupTrace.marks),
+            "histograms": {name: histogram.to_json() for name, histogram in sorted(cls.histograms.items())},
+        }
+
+    @classmethod
+    def export(cls, path=None):
+        if path is None:
+            os.makedirs(LOG_DIR, exist_ok=True)
+            path = os.path.join(LOG_DIR, "telemetry-{}.json".format(os.getpid()))
+        with open(path + ".tmp", "w") as fd:
+            json.dump(cls.to_json(), fd, indent=1)
+        os.replace(path + ".tmp", path)
+        return path
+
+
+def check_slos(histograms, slos=SLOS):
+    """Returns [(name, pct, limit_ms, actual_ms)] for every SLO an export breaks."""
+    violations = []
+    for name, (pct, limit_ms) in sorted(slos.items()):
+        histogram = histograms.get(name)
+        if histogram is None or not histogram.count:
+            continue
+        actual_ms = histogram.percentile(pct) / 1000.0
+        if actual_ms > limit_ms:
+            violations.append((name, pct, limit_ms, actual_ms))
+    return violations
+
+
+def main(paths):
+    histograms = {}
+    for path in paths:
+        with open(path) as fd:
+            for name, data in json.load(fd)["histograms"].items():
+                histogram = Histogram.from_json(data)
+                if name in histograms:
+                    histograms[name].merge(histogram)
+                else:
+                    histograms[name] = histogram
+    print("{:<24} {:>8} {:>9} {:>9} {:>9} {:>9}".format("histogram", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for name, histogram in sorted(histograms.items()):
+        print("{:<24} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            name, histogram.count, *[histogram.percentile(pct) / 1000.0 for pct in (50, 90, 99, 100)]))
+    violations = check_slos(histograms)
+    for name, pct, limit_ms, actual_ms in violations:
+        print("SLO violated: {} p{} {:.2f} ms > {} ms".format(name, pct, actual_ms, limit_ms))
+    return 1 if violations else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,68 @@
+import asyncio
+import random
+
+import pytest
+
+from analytics import GameStats, RecordedSession
+from app import GameState, mask_to_cards
+from recording import IN, OPEN, MessageRecorder
+from server import Table
+
+
+class Socket(object):
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+def lobby(players):
+    """What seat 0 is sent while `players` sit at a table that has not been dealt."""
+    table = Table("lobby", 4, 0)
+    for index in range(players):
+        table.join("player{}".format(index), None)
+    return table.message_for(table.seats[0], "player_joined")
+
+
+def played_game(seed, first_type="game_start"):
+    """(messages seat 0 is sent, turns played) over one game of random legal moves."""
+    rng = random.Random(seed)
+    table = Table("test", 4, seed)
+    socket = Socket()
+    for index in range(4):
+        table.join("player{}".format(index), socket if index == 0 else Socket())
+    table.deal()
+    asyncio.run(table.broadcast(first_type))
+    turns = 0
+    while table.state != GameState.ENDED:
+        seat = table.seats[table.current]
+        legal = mask_to_cards(table.legal_mask(seat))
+        table.play(seat, rng.choice(legal).str if legal else "pass")
+        turns += 1
+        asyncio.run(table.broadcast("game_end" if table.state == GameState.ENDED else "game_update"))
+    return socket.sent, turns
+
+
+@pytest.mark.parametrize("first_type", ["game_start", "game_update"])
+def test_lobby_between_games_adds_no_rows(tmp_path, first_type):
+    first, first_turns = played_game(1)
+    second, second_turns = played_game(2, first_type)
+    path = str(tmp_path / "session.rec")
+    recorder = MessageRecorder(path)
+    recorder.write(OPEN, "")
+    ts = 0
+    for message in first + [lobby(1), lobby(2), lobby(3)] + second:
+        ts += 1000000
+        recorder.write(IN, message, ts=ts)
+    recorder.close()
+
+    rows = list(RecordedSession(path).rows())
+    assert len(rows) == first_turns + second_turns
+    turns = [row[3] for row in rows]
+    assert turns == list(range(1, first_turns + 1)) + list(range(1, second_turns + 1))
+    stats = GameStats().add_file(path).summary()
+    assert stats["games"] == 2
+    assert stats["unknown_moves"] == 0
+    # the second game is timed from its own deal, not from the end of the first
+    assert rows[-1][5] == len(second) * 1000000 - 1000000
@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import hints
+from hints import HintEngine, dealt_game
+
+
+def search_to_end(engine, seed=3):
+    search = engine.start(dealt_game(seed), first_ms=20, think_ms=200)
+    deadline = time.perf_counter() + 10
+    while not search.done and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    engine.shutdown()
+    return search
+
+
+def test_without_processes_rollouts_run_on_a_thread():
+    engine = HintEngine(workers=2, processes=False)
+    assert isinstance(engine.executor(), ThreadPoolExecutor)
+    search = search_to_end(engine)
+    assert search.rollouts > 0
+    assert search.best() is not None or search.candidates == [None]
+
+
+def test_pool_that_cannot_start_falls_back(monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise OSError("no sem_open")
+    monkeypatch.setattr(hints, "ProcessPoolExecutor", unavailable)
+    engine = HintEngine(workers=2, processes=True)
+    search = search_to_end(engine)
+    assert not engine.processes
+    assert search.rollouts > 0
+
+
+class BrokenPool(object):
+    """A process pool whose workers die before running anything."""
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool("worker died"))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+def test_broken_pool_carries_on_in_process(monkeypatch):
+    monkeypatch.setattr(hints, "ProcessPoolExecutor", BrokenPool)
+    engine = HintEngine(workers=2, processes=True)
+    search = search_to_end(engine)
+    assert not engine.processes
+    assert search.rollouts > 0
+
+
+def test_no_spawning_on_android(monkeypatch):
+    monkeypatch.setenv("ANDROID_ARGUMENT", "/data/app")
+    assert not HintEngine().processes
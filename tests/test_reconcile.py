@@ -0,0 +1,88 @@
+import random
+
+from app import Game, mask_to_cards
+from codec import JSON, MessageDecoder
+from server import Table
+
+
+def table_at_my_turn(can_play, seed=0):
+    """A table of 4 after random moves, with seat 0 to play and a legal card (or none)."""
+    for seed in range(seed, seed + 200):
+        rng = random.Random(seed)
+        table = Table("test", 4, seed)
+        for index in range(4):
+            table.join("player{}".format(index), None)
+        table.deal()
+        for _ in range(200):
+            seat = table.seats[table.current]
+            legal = table.legal_mask(seat)
+            if seat.index == 0 and bool(legal) == can_play and table.board_count:
+                return table
+            table.play(seat, rng.choice(mask_to_cards(legal)).str if legal else "pass")
+            table.seq += 1
+    raise AssertionError("no such position")
+
+
+def state(table, message_type="game_update"):
+    return MessageDecoder(JSON).decode(table.message_for(table.seats[0], message_type))[1]
+
+
+def server_update(game, table, message_type="game_update"):
+    game.update(state(table, message_type), message_type)
+    return game.reconcile(message_type)
+
+
+def test_pass_stays_pending_until_the_turn_moves_on():
+    table = table_at_my_turn(can_play=False)
+    game = Game.from_json(state(table))
+    seq = game.apply_optimistic_move(None, pass_move=True)
+    assert not game.is_your_turn()
+    # e.g. the answer to a sync, sent before the server saw the pass
+    assert server_update(game, table) == []
+    assert seq in game.pending_moves
+    assert not game.is_your_turn()
+    table.play(table.seats[0], "pass")
+    table.seq += 1
+    assert server_update(game, table) == []
+    assert not game.pending_moves
+
+
+def test_pass_confirmed_when_the_turn_came_back_round():
+    table = table_at_my_turn(can_play=False)
+    game = Game.from_json(state(table))
+    game.apply_optimistic_move(None, pass_move=True)
+    # every other seat moves before the UI reads the state again
+    table.play(table.seats[0], "pass")
+    for _ in range(3):
+        seat = table.seats[table.current]
+        legal = table.legal_mask(seat)
+        table.play(seat, mask_to_cards(legal)[0].str if legal else "pass")
+    table.seq += 4
+    assert table.current == 0
+    assert server_update(game, table) == []
+    assert not game.pending_moves
+    assert game.is_your_turn()
+
+
+def test_card_confirmed_once_it_left_my_hand():
+    table = table_at_my_turn(can_play=True)
+    game = Game.from_json(state(table))
+    card = mask_to_cards(table.legal_mask(table.seats[0]))[0]
+    seq = game.apply_optimistic_move(card)
+    assert server_update(game, table) == []
+    assert game.pending_moves == {seq: card}
+    assert not game.me.has_card(card)
+    table.play(table.seats[0], card.str)
+    table.seq += 1
+    assert server_update(game, table) == []
+    assert not game.pending_moves
+
+
+def test_refused_move_is_rolled_back():
+    table = table_at_my_turn(can_play=True)
+    game = Game.from_json(state(table))
+    card = mask_to_cards(table.legal_mask(table.seats[0]))[0]
+    seq = game.apply_optimistic_move(card)
+    assert server_update(game, table, "invalid_move") == [(seq, card)]
+    assert game.me.has_card(card)
+    assert game.is_your_turn()
@@ -0,0 +1,47 @@
+import pytest
+
+from shared_state import MAX_PLAYERS, NAME_SIZE, SharedGameState
+
+
+def game_json(names, me_name="me"):
+    return {
+        "players": [{"index": index, "name": name, "card_count": 13} for index, name in enumerate(names)],
+        "me": {"index": 0, "name": me_name, "cards": 0b111},
+        "current_player_id": 0,
+        "state": "STARTED",
+        "board": 0,
+        "card_count": 0,
+        "possible_moves": [],
+        "seq": 1,
+    }
+
+
+@pytest.fixture
+def state():
+    state = SharedGameState.create()
+    yield state
+    state.close()
+
+
+def test_long_name_is_truncated(state):
+    name = "x" * 40
+    state.write("game_update", game_json([name, "bob"], me_name=name))
+    _, _, game, _ = state.read()
+    assert game["me"]["name"] == "x" * NAME_SIZE
+    assert [player["name"] for player in game["players"]] == ["x" * NAME_SIZE, "bob"]
+
+
+def test_truncation_keeps_utf8_characters_whole(state):
+    # 3 bytes each, so 32 bytes end inside the 11th character
+    name = "ख" * 20
+    state.write("game_update", game_json([name]))
+    _, _, game, _ = state.read()
+    assert game["players"][0]["name"] == "ख" * 10
+
+
+def test_extra_players_and_long_type_are_cut(state):
+    version = state.write("a_very_long_message_type", game_json(["p{}".format(i) for i in range(MAX_PLAYERS + 2)]))
+    assert version == 2
+    _, message_type, game, _ = state.read()
+    assert message_type == "a_very_long_mess"
+    assert len(game["players"]) == MAX_PLAYERS
@@ -0,0 +1,47 @@
+import asyncio
+
+from server import Table
+from socket_client import GameConnection, SessionHandler
+
+
+class Session(SessionHandler):
+    def __init__(self):
+        super(Session, self).__init__()
+        self.published = []
+        self.errors = []
+
+    def publish(self, ws, message_type, game_json, received_ns):
+        self.published.append((message_type, game_json["seq"]))
+
+    def publish_delta(self, ws, delta, received_ns):
+        pass
+
+    def on_error(self, ws, error):
+        self.errors.append(error)
+
+
+class Socket(object):
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def __aiter__(self):
+        for message in self.messages:
+            yield message
+
+
+def snapshot():
+    table = Table("test", 4, 0)
+    for index in range(4):
+        table.join("player{}".format(index), None)
+    table.deal()
+    table.seq = 1
+    return table.message_for(table.seats[0], "game_update")
+
+
+def test_bad_message_is_reported_and_reading_goes_on():
+    session = Session()
+    connection = GameConnection("ws://test", session, local=True)
+    closed = asyncio.run(connection._read(Socket(["{not json", snapshot()])))
+    assert closed is False
+    assert len(session.errors) == 1
+    assert session.published == [("game_update", 1)]